@@ -15,31 +15,51 @@ def data_extraction_root(args):
 
     patients = utils.read_patients_table(args.eicu_dir, args.root_path)
     stay_id = utils.cohort_stay_id(patients)
-    utils.break_up_stays_by_unit_stay(patients, args.root_path, stayid=stay_id, verbose=1)
+    if args.in_memory:
+        # no per-stay directories: the time series of all the stays are built from the tables at once
+        lab = utils.read_lab_table(args.eicu_dir, chunksize=args.chunksize)
+        print("reading nurseCharting table, might take some time")
+        nc = utils.read_nc_table(args.eicu_dir, chunksize=args.chunksize)
+        all_df = utils.time_series_from_tables(patients, lab, nc, stayid=stay_id)
+        del patients, lab, nc
+        utils.write_all_data(all_df, args.root_path, file_format=args.all_data_format)
+        return
+
+    utils.break_up_stays_by_unit_stay(patients, args.root_path, stayid=stay_id, verbose=1, workers=args.workers)
     del patients
 
     # print("reading lab table")
-    lab = utils.read_lab_table(args.eicu_dir)
-    utils.break_up_lab_by_unit_stay(lab, args.root_path, stayid=stay_id, verbose=1)
+    lab = utils.read_lab_table(args.eicu_dir, chunksize=args.chunksize)
+    utils.break_up_lab_by_unit_stay(lab, args.root_path, stayid=stay_id, verbose=1, workers=args.workers)
     del lab
 
     print("reading nurseCharting table, might take some time")
-    nc = utils.read_nc_table(args.eicu_dir)
-    utils.break_up_stays_by_unit_stay_nc(nc, args.root_path, stayid=stay_id, verbose=1)
+    nc = utils.read_nc_table(args.eicu_dir, chunksize=args.chunksize)
+    utils.break_up_stays_by_unit_stay_nc(nc, args.root_path, stayid=stay_id, verbose=1, workers=args.workers)
     del nc
 
     #Write the timeseries data into folders
-    utils.extract_time_series_from_subject(args.root_path)
+    utils.extract_time_series_from_subject(args.root_path, workers=args.workers)
     
     utils.delete_wo_timeseries(args.root_path)
     #Write all the data into one dataframe
-    utils.all_df_into_one_df(args.root_path)
+    utils.all_df_into_one_df(args.root_path, file_format=args.all_data_format)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Create data for root")
     parser.add_argument('eicu_dir', type=str, help="Path to root folder containing all the patietns data")
-    parser.add_argument('root_path', type=str, help="Path to root folder containing all_data.csv.")
+    parser.add_argument('root_path', type=str,
+                        help="Path to root folder containing all_data.csv (or all_data.parquet).")
+    parser.add_argument('--in_memory', action='store_true',
+                        help="Build all_data from the tables in memory, without writing a directory per stay.")
+    parser.add_argument('--all_data_format', type=str, default='csv', choices=utils.all_data_formats,
+                        help="Format of the file with the time series of all the stays (all_data.csv or "
+                             "all_data.parquet).")
+    parser.add_argument('--chunksize', type=int, default=1000000,
+                        help="Read the lab and nurseCharting tables in chunks of this many rows.")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="Number of processes writing the per-stay files and converting them to time series.")
     args, _ = parser.parse_known_args()
 
     data_extraction_root(args)
@@ -7,6 +7,7 @@ import pandas as pd
 import numpy as np
 import sys
 import shutil
+from multiprocessing import Pool
 
 from sklearn.preprocessing import MinMaxScaler
 # from sklearn.externals.joblib import dump, load
@@ -16,6 +17,48 @@ def dataframe_from_csv(path, header=0, index_col=False):
     return pd.read_csv(path, header=header, index_col=index_col)
 
 
+def _write_partition_batch(task):
+    rows, keys, starts, ends, output_path, file_name, sort_by, verbose, nb_keys = task
+    for i, (value, start, end) in enumerate(zip(keys, starts, ends)):
+        if verbose:
+            sys.stdout.write('\rStayID {0} of {1}...'.format(i + 1, nb_keys))
+        dn = os.path.join(output_path, str(value))
+        os.makedirs(dn, exist_ok=True)
+        partition = rows.iloc[start:end]
+        if sort_by is not None:
+            partition = partition.sort_values(by=sort_by)
+        partition.to_csv(os.path.join(dn, file_name), index=False)
+    return len(keys)
+
+
+# Write the rows of each value of key into output_path/<value>/file_name. The table is sorted by key once and each
+# file is a slice of it, instead of a scan of the whole table per value. With workers > 1 files are written in parallel.
+def write_partitions(df, key, output_path, file_name, keys=None, sort_by=None, workers=1, verbose=1):
+    keys = np.unique(np.asarray(df[key].unique() if keys is None else keys))
+    df = df.iloc[np.argsort(df[key].values, kind='mergesort')]
+    column = df[key].values
+    starts = np.searchsorted(column, keys, side='left')
+    ends = np.searchsorted(column, keys, side='right')
+
+    if workers > 1:
+        bounds = np.linspace(0, len(keys), num=min(len(keys), workers * 8) + 1, dtype=int)
+        tasks = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            offset = starts[lo]
+            tasks.append((df.iloc[offset:ends[hi - 1]], keys[lo:hi], starts[lo:hi] - offset, ends[lo:hi] - offset,
+                          output_path, file_name, sort_by, 0, 0))
+        with Pool(workers) as pool:
+            done = 0
+            for n in pool.imap_unordered(_write_partition_batch, tasks):
+                done += n
+                if verbose:
+                    sys.stdout.write('\rStayID {0} of {1}...'.format(done, len(keys)))
+    else:
+        _write_partition_batch((df, keys, starts, ends, output_path, file_name, sort_by, verbose, len(keys)))
+    if verbose:
+        sys.stdout.write('DONE!\n')
+
+
 var_to_consider = ['glucose', 'Invasive BP Diastolic', 'Invasive BP Systolic',
                    'O2 Saturation', 'Respiratory Rate', 'Motor', 'Eyes', 'MAP (mmHg)',
                    'Heart Rate', 'GCS Total', 'Verbal', 'pH', 'FiO2', 'Temperature (C)']
@@ -126,22 +169,9 @@ def filter_patients_on_columns(patients):
 
 
 # Write the selected cohort data from patient table into pat.csv for each patient
-def break_up_stays_by_unit_stay(pats, output_path, stayid=None, verbose=1):
-    unit_stays = pats.patientunitstayid.unique() if stayid is None else stayid
-    nb_unit_stays = unit_stays.shape[0]
-    for i, stay_id in enumerate(unit_stays):
-        if verbose:
-            sys.stdout.write('\rStayID {0} of {1}...'.format(i + 1, nb_unit_stays))
-        dn = os.path.join(output_path, str(stay_id))
-        try:
-            os.makedirs(dn)
-        except:
-            pass
-
-        pats.loc[pats.patientunitstayid == stay_id].sort_values(by='hospitaladmitoffset').to_csv(
-            os.path.join(dn, 'pats.csv'), index=False)
-    if verbose:
-        sys.stdout.write('DONE!\n')
+def break_up_stays_by_unit_stay(pats, output_path, stayid=None, verbose=1, workers=1):
+    write_partitions(pats, 'patientunitstayid', output_path, 'pats.csv', keys=stayid, sort_by='hospitaladmitoffset',
+                     workers=workers, verbose=verbose)
 
 
 ## Here we deal with lab table
@@ -164,46 +194,45 @@ def item_name_selected_from_lab(lab, items):
     return lab
 
 
-# Check if the lab measurement is valid
-def check(x):
-    try:
-        x = float(str(x).strip())
-    except:
-        x = np.nan
-    return x
+# Check if the lab measurement is valid, the values which are not numbers are missing
 def check_itemvalue(df):
-    df['itemvalue'] = df['itemvalue'].apply(lambda x: check(x))
-    df['itemvalue'] = df['itemvalue'].astype(float)
+    df['itemvalue'] = pd.to_numeric(df['itemvalue'], errors='coerce').astype(float)
     return df
 
+
+# Read the rows of a table kept by select, chunksize rows at a time: only the columns given are read, with the
+# dtypes given (category for the repeated names select filters on), and only one chunk of the table is in memory.
+# The category columns of the kept rows are given back as strings.
+def read_table_in_chunks(path, columns, dtype, select, chunksize=1000000):
+    chunks = []
+    for chunk in pd.read_csv(path, usecols=columns, dtype=dtype, chunksize=chunksize):
+        chunk = select(chunk[columns])
+        for column in chunk.select_dtypes('category').columns:
+            chunk[column] = chunk[column].astype(object)
+        chunks.append(chunk)
+    return pd.concat(chunks)
+
+
 # extract the lab items for each patient
-def read_lab_table(eicu_path):
-    lab = dataframe_from_csv(os.path.join(eicu_path, 'lab.csv'), index_col=False)
+def read_lab_table(eicu_path, chunksize=1000000):
     items = ['bedside glucose', 'glucose', 'pH', 'FiO2']
-    lab = filter_lab_on_columns(lab)  
-    lab = rename_lab_columns(lab)
-    lab = item_name_selected_from_lab(lab, items)  
+    columns = ['patientunitstayid', 'labresultoffset', 'labname', 'labresult']
+
+    def select(lab):
+        lab = rename_lab_columns(lab)
+        return item_name_selected_from_lab(lab, items)
+
+    lab = read_table_in_chunks(os.path.join(eicu_path, 'lab.csv'), columns,
+                               dtype={'labname': 'category', 'labresult': str}, select=select, chunksize=chunksize)
     lab.loc[lab['itemname'] == 'bedside glucose', 'itemname'] = 'glucose'  # unify bedside glucose and glucose
     lab = check_itemvalue(lab)
     return lab
 
 
 # Write the available lab items of a patient into lab.csv 
-def break_up_lab_by_unit_stay(lab, output_path, stayid=None, verbose=1):
-    unit_stays = lab.patientunitstayid.unique() if stayid is None else stayid
-    nb_unit_stays = unit_stays.shape[0]
-    for i, stay_id in enumerate(unit_stays):
-        if verbose:
-            sys.stdout.write('\rStayID {0} of {1}...'.format(i + 1, nb_unit_stays))
-        dn = os.path.join(output_path, str(stay_id))
-        try:
-            os.makedirs(dn)
-        except:
-            pass
-        lab.loc[lab.patientunitstayid == stay_id].sort_values(by='itemoffset').to_csv(os.path.join(dn, 'lab.csv'),
-                                                                                     index=False)
-    if verbose:
-        sys.stdout.write('DONE!\n')
+def break_up_lab_by_unit_stay(lab, output_path, stayid=None, verbose=1, workers=1):
+    write_partitions(lab, 'patientunitstayid', output_path, 'lab.csv', keys=stayid, sort_by='itemoffset',
+                     workers=workers, verbose=verbose)
 
 
 # Filter the useful columns from nc table
@@ -248,17 +277,23 @@ def replace_itemname_value(nc):
 
 
 # Select the nurseCharting items and save it into nc
-def read_nc_table(eicu_path):
-    # import pdb;pdb.set_trace()
-    nc = dataframe_from_csv(os.path.join(eicu_path, 'nurseCharting.csv'), index_col=False)
-    nc = filter_nc_on_columns(nc)
-    nc = rename_nc_columns(nc)
+def read_nc_table(eicu_path, chunksize=1000000):
     typevallabel = ['Glasgow coma score', 'Heart Rate', 'O2 Saturation', 'Respiratory Rate', 'MAP (mmHg)',
                     'Arterial Line MAP (mmHg)']
     typevalname = ['Non-Invasive BP Systolic', 'Invasive BP Systolic', 'Non-Invasive BP Diastolic',
                    'Invasive BP Diastolic', 'Temperature (C)', 'Temperature (F)']
-    nc = item_name_selected_from_nc(nc, typevallabel, typevalname)
-    nc = check_itemvalue(nc) 
+    columns = ['patientunitstayid', 'nursingchartoffset', 'nursingchartcelltypevallabel',
+               'nursingchartcelltypevalname', 'nursingchartvalue']
+
+    def select(nc):
+        nc = rename_nc_columns(nc)
+        return item_name_selected_from_nc(nc, typevallabel, typevalname)
+
+    nc = read_table_in_chunks(os.path.join(eicu_path, 'nurseCharting.csv'), columns,
+                              dtype={'nursingchartcelltypevallabel': 'category',
+                                     'nursingchartcelltypevalname': 'category', 'nursingchartvalue': str},
+                              select=select, chunksize=chunksize)
+    nc = check_itemvalue(nc)
     nc = conv_far_cel(nc)
     replace_itemname_value(nc)
     del nc['itemlabel']
@@ -266,82 +301,99 @@ def read_nc_table(eicu_path):
 
 
 # Write the nc values of each patient into a nc.csv file
-def break_up_stays_by_unit_stay_nc(nursecharting, output_path, stayid=None, verbose=1):
-    unit_stays = nursecharting.patientunitstayid.unique() if stayid is None else stayid
-    nb_unit_stays = unit_stays.shape[0]
-    for i, stay_id in enumerate(unit_stays):
-        if verbose:
-            sys.stdout.write('\rStayID {0} of {1}...'.format(i + 1, nb_unit_stays))
-        dn = os.path.join(output_path, str(stay_id))
-        try:
-            os.makedirs(dn)
-        except:
-            pass
+def break_up_stays_by_unit_stay_nc(nursecharting, output_path, stayid=None, verbose=1, workers=1):
+    write_partitions(nursecharting, 'patientunitstayid', output_path, 'nc.csv', keys=stayid, sort_by='itemoffset',
+                     workers=workers, verbose=verbose)
 
-        nursecharting.loc[nursecharting.patientunitstayid == stay_id].sort_values(by='itemoffset').to_csv(
-            os.path.join(dn, 'nc.csv'), index=False)
-    if verbose:
-        sys.stdout.write('DONE!\n')
 
+# Convert the events of all the stays to time series at once, without the per-stay files: the same steps as
+# time_series_from_stay, each done with one sort or groupby over the tables of all the stays
+def time_series_from_tables(pats, lab, nc, stayid=None):
+    print("Convert to time series ...")
+    events = pd.concat([nc, lab])
+    if stayid is not None:
+        events = events[events['patientunitstayid'].isin(stayid)]
+    keys = ['patientunitstayid', 'itemoffset']
+    events = events.sort_values(by=keys + ['itemname', 'itemvalue']).drop_duplicates(subset=keys + ['itemname'],
+                                                                                     keep='last')
+    timeseries = events.pivot(index=keys, columns='itemname', values='itemvalue')
+    del events
+    variables = sorted(set(timeseries.columns) | set(var_to_consider))
+    timeseries = timeseries.reindex(columns=variables).reset_index()
+    timeseries = timeseries[['itemoffset'] + variables + ['patientunitstayid']]
+
+    # the types read back from pats.csv
+    nclabpat = pd.merge(timeseries, pats.infer_objects(), on='patientunitstayid')
+    del timeseries
+    df = binning(nclabpat, 60)
+    n_rows = df.groupby('patientunitstayid')['itemoffset'].transform('size')
+    df = df[(15 <= n_rows) & (n_rows <= 200)]
+    df = check_in_range(df.copy())
+    print("Number of patients with less than 15 or more than 200 records:", df['patientunitstayid'].nunique())
+    print('Convereted to time series')
+    return df.reset_index(drop=True)
 
-# Write the time-series data into one csv for each patient
-def extract_time_series_from_subject(t_path):
+
+# Write the time-series of one stay directory into its timeseries.csv, return whether it was written
+def time_series_from_stay(dn):
+    try:
+        pat = dataframe_from_csv(os.path.join(dn, 'pats.csv'))
+        lab = dataframe_from_csv(os.path.join(dn, 'lab.csv'))
+        nc = dataframe_from_csv(os.path.join(dn, 'nc.csv'))
+        nclab = pd.concat([nc, lab]).sort_values(by=['itemoffset'])
+        timeepisode = convert_events_to_timeseries(nclab, variables=var_to_consider)
+        nclabpat = pd.merge(timeepisode, pat, on='patientunitstayid')
+        df = binning(nclabpat, 60)
+        # df = imputer(df, strategy='normal')
+        if 15 <= df.shape[0] <= 200:
+            df = check_in_range(df)
+            df.to_csv(os.path.join(dn, 'timeseries.csv'), index=False)
+            return True
+    except Exception:
+        pass
+    return False
+
+
+# Write the time-series data into one csv for each patient. The stay directories are listed once and, with
+# workers > 1, converted by a pool of processes, each sent chunksize stays at a time.
+def extract_time_series_from_subject(t_path, workers=1, chunksize=64):
     print("Convert to time series ...")
     print("This will take some hours, as the binning and converting time series are done here ...")
 
-    filter_15_200 = 0
+    stay_dirs = [os.path.join(t_path, stay_dir) for stay_dir in os.listdir(t_path)
+                 if stay_dir.isdigit() and os.path.isdir(os.path.join(t_path, stay_dir))]
 
-    for i,stay_dir in enumerate(os.listdir(t_path)):
-        # import pdb;pdb.set_trace()
-        dn = os.path.join(t_path, stay_dir)
-        try:
-            stay_id = int(stay_dir)
-            if not os.path.isdir(dn):
-                raise Exception
-        except:
-            continue
-        try:
-            pat = dataframe_from_csv(os.path.join(t_path, stay_dir, 'pats.csv'))
-            lab = dataframe_from_csv(os.path.join(t_path, stay_dir, 'lab.csv'))
-            nc = dataframe_from_csv(os.path.join(t_path, stay_dir, 'nc.csv'))
-            nclab = pd.concat([nc, lab]).sort_values(by=['itemoffset'])
-            timeepisode = convert_events_to_timeseries(nclab, variables=var_to_consider)
-            nclabpat = pd.merge(timeepisode, pat, on='patientunitstayid')
-            df = binning(nclabpat, 60)
-            # df = imputer(df, strategy='normal')
-            if 15 <= df.shape[0] <= 200:
-                filter_15_200 += 1
-                df = check_in_range(df)
-                df.to_csv(os.path.join(t_path, stay_dir, 'timeseries.csv'), index=False)
-                sys.stdout.write('\rWrite patient {0} / {1}'.format(i, len(os.listdir(t_path))))
-            else:
-                continue
-        except:
-            continue
+    filter_15_200 = 0
+    if workers > 1:
+        with Pool(workers) as pool:
+            written = pool.imap_unordered(time_series_from_stay, stay_dirs, chunksize=chunksize)
+            for i, ok in enumerate(written):
+                filter_15_200 += ok
+                sys.stdout.write('\rWrite patient {0} / {1}'.format(i + 1, len(stay_dirs)))
+    else:
+        for i, dn in enumerate(stay_dirs):
+            filter_15_200 += time_series_from_stay(dn)
+            sys.stdout.write('\rWrite patient {0} / {1}'.format(i + 1, len(stay_dirs)))
     print("Number of patients with less than 15 or more than 200 records:", filter_15_200)
     print('Convereted to time series')
 
 
 ## Convert to time-series
 
+# Valid range of each measurment
+value_ranges = {'Eyes': (0, 5), 'GCS Total': (2, 16), 'Heart Rate': (0, 350), 'Motor': (0, 6),
+                'Invasive BP Diastolic': (0, 375), 'Invasive BP Systolic': (0, 375), 'MAP (mmHg)': (14, 330),
+                'Verbal': (1, 5), 'admissionheight': (100, 240), 'admissionweight': (30, 250), 'glucose': (33, 1200),
+                'pH': (6.3, 10), 'FiO2': (15, 110), 'O2 Saturation': (0, 100), 'Respiratory Rate': (0, 100),
+                'Temperature (C)': (26, 45)}
+
+
 # Check the range of each measurment
 def check_in_range(df):
-    df['Eyes'].clip(0, 5, inplace=True)
-    df['GCS Total'].clip(2, 16, inplace=True)
-    df['Heart Rate'].clip(0, 350, inplace=True)
-    df['Motor'].clip(0, 6, inplace=True)
-    df['Invasive BP Diastolic'].clip(0, 375, inplace=True)
-    df['Invasive BP Systolic'].clip(0, 375, inplace=True)
-    df['MAP (mmHg)'].clip(14, 330, inplace=True)
-    df['Verbal'].clip(1, 5, inplace=True)
-    df['admissionheight'].clip(100, 240, inplace=True)
-    df['admissionweight'].clip(30, 250, inplace=True)
-    df['glucose'].clip(33, 1200, inplace=True)
-    df['pH'].clip(6.3, 10, inplace=True)
-    df['FiO2'].clip(15, 110, inplace=True)
-    df['O2 Saturation'].clip(0, 100, inplace=True)
-    df['Respiratory Rate'].clip(0, 100, inplace=True)
-    df['Temperature (C)'].clip(26, 45, inplace=True)
+    columns = list(value_ranges)
+    lower, upper = zip(*value_ranges.values())
+    df[columns] = df[columns].clip(lower=pd.Series(lower, index=columns), upper=pd.Series(upper, index=columns),
+                                   axis=1)
     return df
 
 
@@ -363,18 +415,20 @@ def convert_events_to_timeseries(events, variable_column='itemname', variables=[
     return timeseries
 
 
-# Bin all the values of one hour, into one bin
+# Bin all the values of one hour, into one bin. df holds the rows of one or several stays, sorted by itemoffset
+# within each stay
 def binning(df, x=60):
     null_columns = ['glucose', 'Invasive BP Diastolic', 'Invasive BP Systolic',
                     'O2 Saturation', 'Respiratory Rate', 'Motor', 'Eyes', 'MAP (mmHg)',
                     'Heart Rate', 'GCS Total', 'Verbal', 'pH', 'FiO2', 'Temperature (C)']
+    keys = ['patientunitstayid', 'itemoffset']
 
-    df['glucose'] = df['glucose'].shift(-1)
+    df['glucose'] = df.groupby('patientunitstayid')['glucose'].shift(-1)
     df.dropna(how='all', subset=null_columns, inplace=True)
     df['itemoffset'] = (df['itemoffset'] / x).astype(int)
-    df = df.groupby('itemoffset').apply(lambda x: x.fillna(x.mean()))
-    df = df.droplevel(0, axis=0)
-    df.drop_duplicates(subset=['itemoffset'], keep='last', inplace=True)
+    # the missing values of a bin are filled with the mean of the bin, whose last row is kept
+    df = df.fillna(df.groupby(keys).transform('mean'))
+    df.drop_duplicates(subset=keys, keep='last', inplace=True)
     return df
 
 
@@ -423,7 +477,7 @@ def delete_wo_timeseries(t_path):
 
 
 # Write all the extracted data into one csv file
-def all_df_into_one_df(output_path):
+def all_df_into_one_df(output_path, file_format='csv'):
     all_filenames = []
     unit_stays = pd.Series(os.listdir(output_path))
     unit_stays = list((filter(str.isdigit, unit_stays)))
@@ -432,7 +486,32 @@ def all_df_into_one_df(output_path):
         all_filenames.append(df_file)
 
     combined_csv = pd.concat([pd.read_csv(f) for f in all_filenames])
-    combined_csv.to_csv(os.path.join(output_path, 'all_data.csv'), index=False)
+    write_all_data(combined_csv, output_path, file_format=file_format)
+
+
+all_data_formats = ('csv', 'parquet')
+
+
+# Write the time series of all the stays into all_data.csv or all_data.parquet
+def write_all_data(df, output_path, file_format='csv'):
+    if file_format not in all_data_formats:
+        raise ValueError("file format of all_data is invalid")
+    if file_format == 'parquet':
+        df.to_parquet(os.path.join(output_path, 'all_data.parquet'), index=False)
+    else:
+        df.to_csv(os.path.join(output_path, 'all_data.csv'), index=False)
+
+
+# Read all_data.csv or all_data.parquet, the most recently written one if both are there
+def read_all_data(root_dir):
+    paths = [os.path.join(root_dir, 'all_data.' + file_format) for file_format in all_data_formats]
+    paths = [path for path in paths if os.path.isfile(path)]
+    if not paths:
+        raise FileNotFoundError("no all_data.csv or all_data.parquet in {}".format(root_dir))
+    path = max(paths, key=os.path.getmtime)
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
 
 
 # Convert categorical variables into number from 0 to 429
@@ -447,7 +526,7 @@ def prepare_categorical_variables(root_dir):
                    'hospitaladmitoffset',
                    'hospitaldischargestatus', 'unitdischargeoffset',
                    'unitdischargestatus']
-    all_df = pd.read_csv(os.path.join(root_dir, 'all_data.csv'))
+    all_df = read_all_data(root_dir)
   
     all_df = all_df[all_df.gender != 2]  # unknown gender is dropped
     all_df = all_df[all_df.hospitaldischargestatus != 2]  # unknown hospital discharge is dropped
@@ -540,13 +619,25 @@ def embedding(root_dir):
     return all_df
 
 
-def df_to_list(df):
-    grp_df  = df.groupby('patientunitstayid')
-    df_arr = []
-    for idx, frame in grp_df:
-        df_arr.append(frame)
-    
-    return df_arr
+# Group the rows of df by stay (in increasing stay id, keeping the order of the rows of a stay) into one
+# (N, max_len, F) array, zero after the last row of each stay, filled with one scatter of all the rows. Returns the
+# array, the number of rows and the id of each stay. With ragged=True the rows are not padded: the array is
+# (number of rows, F), the rows of the i-th stay being data[offsets[i]:offsets[i + 1]], and the offsets are returned
+# instead of the numbers of rows.
+def pad_stays(df, max_len=200, ragged=False, dtype=np.float32):
+    stays = df['patientunitstayid'].values
+    order = np.argsort(stays, kind='mergesort')
+    values = df.values[order].astype(dtype)
+    stay_ids, starts, nrows = np.unique(stays[order], return_index=True, return_counts=True)
+    if ragged:
+        return values, np.append(starts, len(values)), stay_ids
+
+    if len(stay_ids) and nrows.max() > max_len:
+        raise ValueError("a stay has {} rows, more than max_len={}".format(nrows.max(), max_len))
+    padded_data = np.zeros((len(stay_ids), max_len, values.shape[1]), dtype=dtype)
+    positions = np.arange(len(values)) - np.repeat(starts, nrows)
+    padded_data[np.repeat(np.arange(len(stay_ids)), nrows), positions] = values
+    return padded_data, nrows, stay_ids
 
 
 def normalize_data_dec(config, data, train_idx, test_idx):
@@ -567,10 +658,8 @@ def normalize_data_dec(config, data, train_idx, test_idx):
     elif config.cat:
         col_used += config.dec_cat
         col_used += ['unitdischargestatus']
-        train = df_to_list(train[col_used])
-        test = df_to_list(test[col_used])
-        train, nrows_train = pad(train)
-        test, nrows_test = pad(test)
+        train, nrows_train, _ = pad_stays(train[col_used])
+        test, nrows_test, _ = pad_stays(test[col_used])
         return (train, nrows_train), (test, nrows_test)
 
     train = train[col_used]
@@ -589,28 +678,12 @@ def normalize_data_dec(config, data, train_idx, test_idx):
     feat_test_minmax = scaler_minmax.transform(feat_test_minmax.values)
     test[cols_normalize] = feat_test_minmax
 
-    train = df_to_list(train)
-    test = df_to_list(test)
-
-    train, nrows_train = pad(train)
-    test, nrows_test = pad(test)
+    train, nrows_train, _ = pad_stays(train)
+    test, nrows_test, _ = pad_stays(test)
 
     return (train, nrows_train), (test, nrows_test)
 
 
-def pad(data, max_len=200):
-    padded_data = []
-    nrows = []
-    for item in data:
-        tmp = np.zeros((max_len, item.shape[1]))
-        tmp[:item.shape[0], :item.shape[1]] = item
-        padded_data.append(tmp)
-        nrows.append(item.shape[0])
-    padded_data = np.array(padded_data)
-    
-    return padded_data, nrows
-
-
 # Mortality
 def filter_mortality_data(all_df):
     all_df = all_df[all_df.gender != 0]
@@ -649,10 +722,8 @@ def normalize_data_mort(config, data, train_idx, test_idx):
     elif config.cat:
         col_used += config.dec_cat
         col_used += ['hospitaldischargestatus']
-        train = df_to_list(train[col_used])
-        test = df_to_list(test[col_used])
-        train, nrows_train = pad(train)
-        test, nrows_test = pad(test)
+        train, nrows_train, _ = pad_stays(train[col_used])
+        test, nrows_test, _ = pad_stays(test[col_used])
         return (train, nrows_train), (test, nrows_test)
     
     train = train[col_used]
@@ -671,11 +742,8 @@ def normalize_data_mort(config, data, train_idx, test_idx):
     feat_test_minmax = scaler_minmax.transform(feat_test_minmax.values)
     test[cols_normalize] = feat_test_minmax
 
-    train = df_to_list(train)
-    test = df_to_list(test)
-
-    train, nrows_train = pad(train)
-    test, nrows_test = pad(test)
+    train, nrows_train, _ = pad_stays(train)
+    test, nrows_test, _ = pad_stays(test)
 
     return (train, nrows_train), (test, nrows_test)
 
@@ -697,10 +765,8 @@ def normalize_data_phe(config, data, train_idx, test_idx):
     elif config.cat:
         col_used += config.dec_cat
         col_used += config.col_phe
-        train = df_to_list(train[col_used])
-        test = df_to_list(test[col_used])
-        train, nrows_train = pad(train)
-        test, nrows_test = pad(test)
+        train, nrows_train, _ = pad_stays(train[col_used])
+        test, nrows_test, _ = pad_stays(test[col_used])
         return (train, nrows_train), (test, nrows_test)
     
     train = train[col_used]
@@ -718,11 +784,8 @@ def normalize_data_phe(config, data, train_idx, test_idx):
     feat_test_minmax = scaler_minmax.transform(feat_test_minmax.values)
     test[cols_normalize] = feat_test_minmax
 
-    train = df_to_list(train)
-    test = df_to_list(test)
-
-    train, nrows_train = pad(train)
-    test, nrows_test = pad(test)
+    train, nrows_train, _ = pad_stays(train)
+    test, nrows_test, _ = pad_stays(test)
 
     return (train, nrows_train), (test, nrows_test)
 
@@ -860,10 +923,8 @@ def normalize_data_rlos(config, data, train_idx, test_idx):
     elif config.cat:
         col_used += config.dec_cat
         col_used += ['RLOS']
-        train = df_to_list(train[col_used])
-        test = df_to_list(test[col_used])
-        train, nrows_train = pad(train)
-        test, nrows_test = pad(test)
+        train, nrows_train, _ = pad_stays(train[col_used])
+        test, nrows_test, _ = pad_stays(test[col_used])
         return (train, nrows_train), (test, nrows_test)
     
     train = train[col_used]
@@ -879,49 +940,54 @@ def normalize_data_rlos(config, data, train_idx, test_idx):
     feat_test_minmax = scaler_minmax.transform(feat_test_minmax.values)
     test[cols_normalize] = feat_test_minmax
 
-    train = df_to_list(train)
-    test = df_to_list(test)
-
-    train, nrows_train = pad(train)
-    test, nrows_test = pad(test)
+    train, nrows_train, _ = pad_stays(train)
+    test, nrows_test, _ = pad_stays(test)
 
     return (train, nrows_train), (test, nrows_test)
 
 
+# Index of every possible value of a categorical channel, the first one of a repeated value (as list.index)
+def category_index(values):
+    value_to_id = {}
+    for i, value in enumerate(values):
+        value_to_id.setdefault(value, i)
+    return value_to_id
+
+
+# Indexes of values in the possible values of their channel, raises ValueError if one is not there
+def to_category_ids(values, value_to_id):
+    category_ids = pd.Series(values).map(value_to_id)
+    unknown = category_ids.isnull().values
+    if unknown.any():
+        raise ValueError('{} is not in list'.format(repr(np.asarray(values)[unknown].tolist()[0])))
+    return category_ids.values.astype(int)
+
+
+# One-hot rows of category_ids, all NaN for the rows whose id is -1 (missing value)
+def one_hot(category_ids, n_values):
+    data = np.full([len(category_ids), n_values], np.nan)
+    rows = np.flatnonzero(category_ids >= 0)
+    data[rows] = 0
+    data[rows, category_ids[rows]] = 1
+    return data
+
+
+# One-hot encode the categorical channels of resources/categorical.json, one column per channel and possible value
 def write_one_hot(df):
     import json
     cate_channels = json.load(open('resources/categorical.json'))
-    channels = list(cate_channels.keys())
-    cur_len = 0
-    begin_pos = [0 for i in range(len(cate_channels))]
-    end_pos = [0 for i in range(len(cate_channels))]
-    for i in range(len(cate_channels)):
-        begin_pos[i] = cur_len
-        end_pos[i] = begin_pos[i] + len(cate_channels[channels[i]])
-        cur_len = end_pos[i]
-
-
-    data = np.full([df.shape[0], cur_len], np.nan)
-
-    for i in range(df.shape[0]):
-        row = df.iloc[i, :]
-        for j in range(len(channels)):
-            channel = channels[j]
-            if np.isnan(row[channel]):
-                continue
-            n_values = len(cate_channels[channel])
-            one_hot = np.zeros((n_values,))
-            category_id = cate_channels[channel].index(int(row[channel]))
-            one_hot[category_id] = 1
-            for pos in range(n_values):
-                data[i, begin_pos[j] + pos] = one_hot[pos]
 
+    blocks = []
     new_header = []
-    for channel in channels:
-        values = cate_channels[channel]
-        for value in values:
-            new_header.append(channel + "->" + str(value))
-
+    for channel, values in cate_channels.items():
+        column = df[channel].values.astype(float)
+        present = ~np.isnan(column)
+        category_ids = np.full(len(column), -1)
+        category_ids[present] = to_category_ids(column[present].astype(int), category_index(values))
+        blocks.append(one_hot(category_ids, len(values)))
+        new_header += [channel + "->" + str(value) for value in values]
+
+    data = np.concatenate(blocks, axis=1)
     cate_df = pd.DataFrame(data, columns=new_header)
 
     return cate_df, new_header
@@ -90,7 +90,8 @@ def extract_to_csv(args):
 def main():
     parser = argparse.ArgumentParser(description="Create data for root")
     parser.add_argument('eicu_dir', type=str, help="Path to root folder containing all the patietns data")
-    parser.add_argument('root_path', type=str, help="Path to root folder containing all_data.csv.")
+    parser.add_argument('root_path', type=str,
+                        help="Path to root folder containing all_data.csv (or all_data.parquet).")
     parser.add_argument('out_path', type=str, help="Path to store formatted dataset.csv")
     args, _ = parser.parse_known_args()
     
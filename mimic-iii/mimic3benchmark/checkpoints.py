@@ -0,0 +1,175 @@
+import hashlib
+import json
+import os
+import pandas as pd
+from contextlib import contextmanager
+
+
+# directory of the stage markers and of the file digests (see StageRunner) inside the output path of a pipeline
+CHECKPOINT_DIR = '.checkpoints'
+
+# suffix of the files being written, which are renamed to their final name once complete
+PARTIAL_SUFFIX = '.partial'
+
+
+def partial_name(file_name):
+    return file_name + PARTIAL_SUFFIX
+
+
+@contextmanager
+def atomic_write(path, mode='w', **kwargs):
+    """ Opens a temporary file next to path and renames it to path once the block completes, so that path never holds
+    a partly written file. The temporary file is removed if the block raises.
+    """
+    tmp_path = partial_name('{}.{}'.format(path, os.getpid()))
+    try:
+        with open(tmp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def write_json(path, obj):
+    with atomic_write(path) as f:
+        json.dump(obj, f)
+
+
+def read_json(path):
+    """ :return: the object stored in path, None if there is no such file. """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def file_digest(path, block_size=2 ** 20):
+    """ SHA-1 hex digest of the content of a file, None if it does not exist. """
+    if not os.path.isfile(path):
+        return None
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def frame_digest(df):
+    """ SHA-1 hex digest of the columns and the values of a DataFrame. """
+    digest = hashlib.sha1(json.dumps([str(c) for c in df.columns]).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+
+def combine_digests(items):
+    """ Digest of a list of digests and JSON serializable parameters, e.g. of the inputs of a stage. """
+    return hashlib.sha1(json.dumps(items, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+class DigestCache(object):
+    """ Content digests of files, stored in a json file with the size and modification time of every file, so that a
+    file is hashed again only once it changes. This keeps reruns from reading the raw MIMIC tables again.
+    """
+    def __init__(self, path):
+        self._path = path
+        self._digests = read_json(path) or {}
+
+    def __call__(self, path):
+        if not os.path.isfile(path):
+            return None
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        entry = self._digests.get(key)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'digest': file_digest(path)}
+            self._digests[key] = entry
+            write_json(self._path, self._digests)
+        return entry['digest']
+
+
+class StageRunner(object):
+    """ Runs the stages of a pipeline writing to output_path, each of them once per content of its inputs.
+
+    A completed stage leaves <output_path>/.checkpoints/<stage>.json with the digest of its inputs (the content of its
+    input files and its parameters). A later run skips the stage while this digest is unchanged and reruns it when the
+    inputs change, when it did not complete or with force. The marker of a stage is removed before it runs, so an
+    interrupted stage is never taken for a completed one.
+    """
+    def __init__(self, output_path, force=False):
+        self._path = os.path.join(output_path, CHECKPOINT_DIR)
+        os.makedirs(self._path, exist_ok=True)
+        self.force = force
+        self.file_digest = DigestCache(os.path.join(self._path, 'digests.json'))
+
+    def _marker_path(self, stage):
+        return os.path.join(self._path, stage + '.json')
+
+    def inputs_digest(self, files=(), params=None):
+        """ Digest of the content of files (missing files included) and of params. """
+        return combine_digests([[self.file_digest(path) for path in files], params])
+
+    def digest(self, stage):
+        """ :return: the inputs digest of a completed stage, None if it has not completed. Later stages include it in
+                     their parameters to be rerun after it.
+        """
+        marker = read_json(self._marker_path(stage))
+        return None if marker is None else marker['inputs']
+
+    def is_done(self, stage, inputs):
+        return not self.force and self.digest(stage) == inputs
+
+    def run(self, stage, fn, files=(), params=None):
+        """ Calls fn unless stage already completed with the same files and params.
+
+        :return: True if fn was called.
+        """
+        inputs = self.inputs_digest(files, params)
+        if self.is_done(stage, inputs):
+            print('Skipping {}: completed with the same inputs.'.format(stage))
+            return False
+        if os.path.exists(self._marker_path(stage)):
+            os.remove(self._marker_path(stage))
+        fn()
+        write_json(self._marker_path(stage), {'stage': stage, 'inputs': inputs})
+        return True
+
+
+def subject_marker_path(subject_path, stage):
+    return os.path.join(subject_path, '.{}.json'.format(stage))
+
+
+def read_subject_marker(subject_path, stage):
+    """ :return: what write_subject_marker stored for the subject after stage, None if nothing is stored. """
+    return read_json(subject_marker_path(subject_path, stage))
+
+
+def write_subject_marker(subject_path, stage, marker):
+    """ Records that stage completed for the subject. marker holds the digests of the files the stage read and
+    wrote, which tell a later run whether the subject must be processed again, and what the stage returned.
+    """
+    write_json(subject_marker_path(subject_path, stage), marker)
+
+
+def subject_dirs(output_path):
+    return sorted(x for x in os.listdir(output_path) if x.isdigit() and os.path.isdir(os.path.join(output_path, x)))
+
+
+def clear_partial_files(output_path, file_name):
+    """ Removes the partial file_name files that an interrupted run left in the subject directories of output_path. """
+    for subject_dir in subject_dirs(output_path):
+        path = os.path.join(output_path, subject_dir, partial_name(file_name))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def commit_partial_files(output_path, file_name):
+    """ Renames the partial file_name files of the subject directories of output_path to file_name, once all of them are
+    complete. The file_name files of subjects without a partial file come from a previous run and are removed.
+    """
+    for subject_dir in subject_dirs(output_path):
+        path = os.path.join(output_path, subject_dir, file_name)
+        if os.path.exists(partial_name(path)):
+            os.replace(partial_name(path), path)
+        elif os.path.exists(path):
+            os.remove(path)
@@ -0,0 +1,162 @@
+import json
+import os
+import random
+import numpy as np
+import pandas as pd
+
+
+def compact_floats(values):
+    """ Stores values as float32 when that keeps every value exactly, float64 otherwise. """
+    values = np.asarray(values, dtype=np.float64)
+    values32 = values.astype(np.float32)
+    if np.array_equal(values32.astype(np.float64), values):
+        return values32
+    return values
+
+
+def pack_lists(lists, dtype):
+    """ CSR-packs a list of lists: the items of lists[i] are values[indptr[i]:indptr[i+1]]. """
+    indptr = np.zeros(len(lists) + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum([len(x) for x in lists])
+    values = np.fromiter((v for x in lists for v in x), dtype=np.float64, count=indptr[-1])
+    if dtype is None:
+        return indptr, compact_floats(values)
+    return indptr, values.astype(dtype)
+
+
+def intern_names(names):
+    """ :return: (sorted unique names, position of every name in them). """
+    names, positions = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+    return names, positions.astype(np.int32)
+
+
+class ListfileIndex(object):
+    """ Array-backed rows of a listfile, built once and stored as .npy files in <listfile without .csv>_index/, which
+    later readers memory-map instead of parsing the listfile. The index is rebuilt when the listfile changes size or
+    modification time.
+
+    Subclasses give the arrays of a listfile (_build) and the row tuple the readers use (_row). Stay names are interned:
+    names holds every timeseries file once and the stay array the position of the name of every row.
+    """
+    def __init__(self, listfile_path):
+        index_dir = os.path.splitext(listfile_path)[0] + '_index'
+        listfile_stat = os.stat(listfile_path)
+        signature = {'size': listfile_stat.st_size, 'mtime': listfile_stat.st_mtime}
+        meta_path = os.path.join(index_dir, 'index.json')
+        meta = None
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                meta = json.load(f)
+            if meta['listfile'] != signature:
+                meta = None
+        if meta is None:
+            meta = self._save(index_dir, listfile_path, signature)
+
+        self.header = meta['header']
+        self._arrays = dict((key, np.load(os.path.join(index_dir, key + '.npy'), mmap_mode='r'))
+                            for key in meta['arrays'])
+        self.names = [str(x) for x in self._arrays['names']]
+        self._rows = np.arange(len(self._arrays['stay']))
+
+    def _save(self, index_dir, listfile_path, signature):
+        with open(listfile_path, 'r') as lfile:
+            header = lfile.readline()
+        arrays = self._build(listfile_path)
+        os.makedirs(index_dir, exist_ok=True)
+        # index.json is written last, so an interrupted build is never opened
+        if os.path.exists(os.path.join(index_dir, 'index.json')):
+            os.remove(os.path.join(index_dir, 'index.json'))
+        for key, values in arrays.items():
+            np.save(os.path.join(index_dir, key + '.npy'), values)
+        meta = {'listfile': signature, 'header': header, 'arrays': sorted(arrays)}
+        with open(os.path.join(index_dir, 'index.json'), 'w') as f:
+            json.dump(meta, f)
+        return meta
+
+    def _build(self, listfile_path):
+        raise NotImplementedError()
+
+    def _row(self, row):
+        raise NotImplementedError()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __getitem__(self, index):
+        if index < 0 or index >= len(self._rows):
+            raise IndexError("Index must be from 0 (inclusive) to number of examples (exclusive).")
+        return self._row(self._rows[index])
+
+    def shuffle(self):
+        """ Shuffles the rows with the random module, giving the same order as random.shuffle of a list of the rows. """
+        order = list(range(len(self._rows)))
+        random.shuffle(order)
+        self._rows = self._rows[order]
+
+
+class DecompensationListfileIndex(ListfileIndex):
+    def _build(self, listfile_path):
+        listfile = pd.read_csv(listfile_path, dtype={'stay': str}, float_precision='round_trip')
+        names, stay = intern_names(listfile['stay'].values)
+        return {'names': names,
+                'stay': stay,
+                'period_length': compact_floats(listfile['period_length'].values),
+                'y_true': listfile['y_true'].values.astype(np.int8)}
+
+    def _row(self, row):
+        return (self.names[self._arrays['stay'][row]],
+                float(self._arrays['period_length'][row]),
+                int(self._arrays['y_true'][row]))
+
+
+class MultitaskListfileIndex(ListfileIndex):
+    def _build(self, listfile_path):
+        with open(listfile_path, 'r') as lfile:
+            lines = lfile.readlines()[1:]
+        fnames, ts, ihms, los_masks, los_labels, phenos, decomp_masks, decomp_labels = [], [], [], [], [], [], [], []
+        for line in lines:
+            fname, t, ihm, los, pheno, decomp = line.split(',')
+            fnames.append(fname)
+            ts.append(float(t))
+            ihms.append(list(map(int, ihm.split(';'))))
+            los = los.split(';')
+            if los[0] == '':
+                los = []
+            los_masks.append(list(map(int, los[:len(los)//2])))
+            los_labels.append(list(map(float, los[len(los)//2:])))
+            phenos.append(list(map(int, pheno.split(';'))))
+            decomp = decomp.split(';')
+            if decomp[0] == '':
+                decomp = []
+            decomp_masks.append(list(map(int, decomp[:len(decomp)//2])))
+            decomp_labels.append(list(map(int, decomp[len(decomp)//2:])))
+
+        # the header does not name the phenotypes, so a listfile without rows gives (0, 0) labels
+        n_pheno = len(phenos[0]) if phenos else 0
+        names, stay = intern_names(fnames)
+        los_indptr, los_masks = pack_lists(los_masks, np.int8)
+        _, los_labels = pack_lists(los_labels, None)
+        decomp_indptr, decomp_masks = pack_lists(decomp_masks, np.int8)
+        _, decomp_labels = pack_lists(decomp_labels, np.int8)
+        return {'names': names,
+                'stay': stay,
+                'period_length': compact_floats(ts),
+                'ihm': np.array(ihms, dtype=np.int32).reshape((len(ihms), 3)),
+                'pheno': np.array(phenos, dtype=np.int8).reshape((len(phenos), n_pheno)),
+                'los_indptr': los_indptr,
+                'los_masks': los_masks,
+                'los_labels': los_labels,
+                'decomp_indptr': decomp_indptr,
+                'decomp_masks': decomp_masks,
+                'decomp_labels': decomp_labels}
+
+    def _row(self, row):
+        arrays = self._arrays
+        los = slice(arrays['los_indptr'][row], arrays['los_indptr'][row + 1])
+        decomp = slice(arrays['decomp_indptr'][row], arrays['decomp_indptr'][row + 1])
+        return (self.names[arrays['stay'][row]],
+                float(arrays['period_length'][row]),
+                arrays['ihm'][row].tolist(),
+                (arrays['los_masks'][los].tolist(), arrays['los_labels'][los].tolist()),
+                arrays['pheno'][row].tolist(),
+                (arrays['decomp_masks'][decomp].tolist(), arrays['decomp_labels'][decomp].tolist()))
@@ -2,33 +2,50 @@ import csv
 import numpy as np
 import os
 import pandas as pd
+from collections import OrderedDict
 from tqdm import tqdm
 
-from mimic3benchmark.util import dataframe_from_csv
+from mimic3benchmark.util import dataframe_from_csv, write_partitions
+
+
+# format of the times of the MIMIC-III tables
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def parse_times(values, time_format=TIME_FORMAT):
+    """ pd.to_datetime of values with their known format, parsing every distinct time once. Tables whose times are
+    in another format are parsed as pd.to_datetime would without one.
+    """
+    try:
+        return pd.to_datetime(values, format=time_format, cache=True)
+    except ValueError:
+        return pd.to_datetime(values, cache=True)
+
+
+def read_table_columns(path, columns, time_columns):
+    """ Reads only the columns of a table, with the time columns parsed by parse_times. """
+    table = pd.read_csv(path, usecols=columns, dtype=dict((c, str) for c in time_columns))[columns]
+    for column in time_columns:
+        table[column] = parse_times(table[column])
+    return table
 
 
 def read_patients_table(mimic3_path):
-    pats = dataframe_from_csv(os.path.join(mimic3_path, 'PATIENTS.csv'))
-    pats = pats[['SUBJECT_ID', 'GENDER', 'DOB', 'DOD']]
-    pats.DOB = pd.to_datetime(pats.DOB)
-    pats.DOD = pd.to_datetime(pats.DOD)
-    return pats
+    return read_table_columns(os.path.join(mimic3_path, 'PATIENTS.csv'), ['SUBJECT_ID', 'GENDER', 'DOB', 'DOD'],
+                              ['DOB', 'DOD'])
 
 
 def read_admissions_table(mimic3_path):
-    admits = dataframe_from_csv(os.path.join(mimic3_path, 'ADMISSIONS.csv'))
-    admits = admits[['SUBJECT_ID', 'HADM_ID', 'ADMITTIME', 'DISCHTIME', 'DEATHTIME', 'ETHNICITY', 'DIAGNOSIS']]
-    admits.ADMITTIME = pd.to_datetime(admits.ADMITTIME)
-    admits.DISCHTIME = pd.to_datetime(admits.DISCHTIME)
-    admits.DEATHTIME = pd.to_datetime(admits.DEATHTIME)
-    return admits
+    return read_table_columns(os.path.join(mimic3_path, 'ADMISSIONS.csv'),
+                              ['SUBJECT_ID', 'HADM_ID', 'ADMITTIME', 'DISCHTIME', 'DEATHTIME', 'ETHNICITY', 'DIAGNOSIS'],
+                              ['ADMITTIME', 'DISCHTIME', 'DEATHTIME'])
 
 
 def read_icustays_table(mimic3_path):
-    stays = dataframe_from_csv(os.path.join(mimic3_path, 'ICUSTAYS.csv'))
-    stays.INTIME = pd.to_datetime(stays.INTIME)
-    stays.OUTTIME = pd.to_datetime(stays.OUTTIME)
-    return stays
+    return read_table_columns(os.path.join(mimic3_path, 'ICUSTAYS.csv'),
+                              ['SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'DBSOURCE', 'FIRST_CAREUNIT', 'LAST_CAREUNIT',
+                               'FIRST_WARDID', 'LAST_WARDID', 'INTIME', 'OUTTIME', 'LOS'],
+                              ['INTIME', 'OUTTIME'])
 
 
 def read_icd_diagnoses_table(mimic3_path):
@@ -73,9 +90,16 @@ def merge_on_subject_admission(table1, table2):
 
 
 def add_age_to_icustays(stays):
-    stays['AGE'] = stays.apply(lambda e: (e['INTIME'].to_pydatetime()
-                                          - e['DOB'].to_pydatetime()).total_seconds() / 3600.0 / 24.0 / 365.0,
-                               axis=1)
+    """ Adds the AGE in years (of 365 days) at INTIME, 90 for the patients older than 89 whose DOB is shifted 300 years
+    back. Such differences overflow the nanosecond timedeltas of pandas, so they are taken on integer microseconds.
+    """
+    intime = stays.INTIME.values.astype('datetime64[us]').astype(np.int64)
+    dob = stays.DOB.values.astype('datetime64[us]').astype(np.int64)
+    microseconds = intime - dob
+    # whole seconds are exact as floats, so the ages are those of timedelta.total_seconds()
+    age = ((microseconds // 10 ** 6) + (microseconds % 10 ** 6) / 1e6) / 3600.0 / 24.0 / 365.0
+    age[(stays.INTIME.isnull() | stays.DOB.isnull()).values] = np.nan
+    stays['AGE'] = age
     stays.loc[stays.AGE < 0, 'AGE'] = 90
     return stays
 
@@ -112,36 +136,18 @@ def filter_diagnoses_on_stays(diagnoses, stays):
                            left_on=['SUBJECT_ID', 'HADM_ID'], right_on=['SUBJECT_ID', 'HADM_ID'])
 
 
-def break_up_stays_by_subject(stays, output_path, subjects=None):
-    subjects = stays.SUBJECT_ID.unique() if subjects is None else subjects
-    nb_subjects = subjects.shape[0]
-    for subject_id in tqdm(subjects, total=nb_subjects, desc='Breaking up stays by subjects'):
-        dn = os.path.join(output_path, str(subject_id))
-        try:
-            os.makedirs(dn)
-        except:
-            pass
-
-        stays[stays.SUBJECT_ID == subject_id].sort_values(by='INTIME').to_csv(os.path.join(dn, 'stays.csv'),
-                                                                              index=False)
-
+def break_up_stays_by_subject(stays, output_path, subjects=None, workers=1):
+    write_partitions(stays, 'SUBJECT_ID', output_path, 'stays.csv', keys=subjects, sort_by='INTIME', workers=workers,
+                     desc='Breaking up stays by subjects')
 
-def break_up_diagnoses_by_subject(diagnoses, output_path, subjects=None):
-    subjects = diagnoses.SUBJECT_ID.unique() if subjects is None else subjects
-    nb_subjects = subjects.shape[0]
-    for subject_id in tqdm(subjects, total=nb_subjects, desc='Breaking up diagnoses by subjects'):
-        dn = os.path.join(output_path, str(subject_id))
-        try:
-            os.makedirs(dn)
-        except:
-            pass
 
-        diagnoses[diagnoses.SUBJECT_ID == subject_id].sort_values(by=['ICUSTAY_ID', 'SEQ_NUM'])\
-                                                     .to_csv(os.path.join(dn, 'diagnoses.csv'), index=False)
+def break_up_diagnoses_by_subject(diagnoses, output_path, subjects=None, workers=1):
+    write_partitions(diagnoses, 'SUBJECT_ID', output_path, 'diagnoses.csv', keys=subjects, sort_by=['ICUSTAY_ID', 'SEQ_NUM'],
+                     workers=workers, desc='Breaking up diagnoses by subjects')
 
 
 def read_events_table_and_break_up_by_subject(mimic3_path, table, output_path,
-                                              items_to_keep=None, subjects_to_keep=None):
+                                              items_to_keep=None, subjects_to_keep=None, file_name='events.csv'):
     obs_header = ['SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'CHARTTIME', 'ITEMID', 'VALUE', 'VALUEUOM']
     if items_to_keep is not None:
         items_to_keep = set([str(s) for s in items_to_keep])
@@ -161,13 +167,14 @@ def read_events_table_and_break_up_by_subject(mimic3_path, table, output_path,
             os.makedirs(dn)
         except:
             pass
-        fn = os.path.join(dn, 'events.csv')
+        fn = os.path.join(dn, file_name)
         if not os.path.exists(fn) or not os.path.isfile(fn):
             f = open(fn, 'w')
             f.write(','.join(obs_header) + '\n')
             f.close()
-        w = csv.DictWriter(open(fn, 'a'), fieldnames=obs_header, quoting=csv.QUOTE_MINIMAL)
-        w.writerows(data_stats.curr_obs)
+        with open(fn, 'a') as f:
+            w = csv.DictWriter(f, fieldnames=obs_header, quoting=csv.QUOTE_MINIMAL)
+            w.writerows(data_stats.curr_obs)
         data_stats.curr_obs = []
 
     nb_rows_dict = {'chartevents': 330712484, 'labevents': 27854056, 'outputevents': 4349219}
@@ -195,3 +202,101 @@ def read_events_table_and_break_up_by_subject(mimic3_path, table, output_path,
 
     if data_stats.curr_subject_id != '':
         write_current_observations()
+
+
+class SubjectEventsFiles(object):
+    """ Appends rows to per-subject file_name files, keeping at most max_open_files of them open.
+
+    The least recently used file is closed when the limit is reached. A file gets the header when it is created.
+    """
+    def __init__(self, output_path, header, max_open_files=256, file_name='events.csv'):
+        self._output_path = output_path
+        self._header = header
+        self._max_open_files = max_open_files
+        self._file_name = file_name
+        self._files = OrderedDict()
+
+    def writer(self, subject_id):
+        if subject_id in self._files:
+            self._files.move_to_end(subject_id)
+            return self._files[subject_id][1]
+        if len(self._files) >= self._max_open_files:
+            _, (f, _) = self._files.popitem(last=False)
+            f.close()
+        dn = os.path.join(self._output_path, str(subject_id))
+        os.makedirs(dn, exist_ok=True)
+        fn = os.path.join(dn, self._file_name)
+        is_new = not os.path.isfile(fn)
+        f = open(fn, 'a')
+        if is_new:
+            f.write(','.join(self._header) + '\n')
+        w = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        self._files[subject_id] = (f, w)
+        return w
+
+    def close(self):
+        for f, _ in self._files.values():
+            f.close()
+        self._files.clear()
+
+
+def read_events_table_in_chunks(mimic3_path, table, items_to_keep=None, subjects_to_keep=None, chunksize=1000000):
+    """ Reads an event table with pandas in chunks and yields the rows kept, with the columns of the per-subject
+    events.csv files. All fields are kept as the strings found in the csv file.
+    """
+    obs_header = ['SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'CHARTTIME', 'ITEMID', 'VALUE', 'VALUEUOM']
+    if items_to_keep is not None:
+        items_to_keep = set([str(s) for s in items_to_keep])
+    if subjects_to_keep is not None:
+        subjects_to_keep = set([str(s) for s in subjects_to_keep])
+
+    nb_rows_dict = {'chartevents': 330712484, 'labevents': 27854056, 'outputevents': 4349219}
+    nb_rows = nb_rows_dict[table.lower()]
+
+    reader = pd.read_csv(os.path.join(mimic3_path, table.upper() + '.csv'), usecols=lambda c: c in obs_header,
+                         dtype=str, keep_default_na=False, na_filter=False, chunksize=chunksize)
+    with tqdm(total=nb_rows, desc='Processing {} table'.format(table)) as pbar:
+        for chunk in reader:
+            pbar.update(chunk.shape[0])
+            if subjects_to_keep is not None:
+                chunk = chunk[chunk.SUBJECT_ID.isin(subjects_to_keep)]
+            if items_to_keep is not None:
+                chunk = chunk[chunk.ITEMID.isin(items_to_keep)]
+            if 'ICUSTAY_ID' not in chunk:
+                chunk = chunk.assign(ICUSTAY_ID='')
+            yield chunk[obs_header]
+
+
+def read_events_table_in_chunks_and_break_up_by_subject(mimic3_path, table, output_path, items_to_keep=None,
+                                                        subjects_to_keep=None, chunksize=1000000, max_open_files=256,
+                                                        file_name='events.csv'):
+    """ Same output as read_events_table_and_break_up_by_subject, but the table is read with pandas in chunks.
+
+    Rows are filtered with isin and each chunk is written subject by subject, in the order of the table.
+    """
+    obs_header = ['SUBJECT_ID', 'HADM_ID', 'ICUSTAY_ID', 'CHARTTIME', 'ITEMID', 'VALUE', 'VALUEUOM']
+    files = SubjectEventsFiles(output_path, obs_header, max_open_files=max_open_files, file_name=file_name)
+    for chunk in read_events_table_in_chunks(mimic3_path, table, items_to_keep=items_to_keep,
+                                             subjects_to_keep=subjects_to_keep, chunksize=chunksize):
+        for subject_id, rows in chunk.groupby('SUBJECT_ID', sort=False):
+            files.writer(subject_id).writerows(rows.values.tolist())
+    files.close()
+
+
+def write_stays_to_store(stays, store, subjects=None):
+    subjects = stays.SUBJECT_ID.unique() if subjects is None else subjects
+    store.append('stays', stays[stays.SUBJECT_ID.isin(subjects)].sort_values(by='INTIME'))
+
+
+def write_diagnoses_to_store(diagnoses, store, subjects=None):
+    subjects = diagnoses.SUBJECT_ID.unique() if subjects is None else subjects
+    store.append('diagnoses', diagnoses[diagnoses.SUBJECT_ID.isin(subjects)].sort_values(by=['ICUSTAY_ID', 'SEQ_NUM']))
+
+
+def read_events_table_into_store(mimic3_path, table, store, items_to_keep=None, subjects_to_keep=None,
+                                 chunksize=1000000):
+    """ Appends the events of a table to the Parquet store. Call store.compact('events') once all tables are read. """
+    from mimic3benchmark.parquet_store import EVENTS_SCHEMA, events_chunk_to_store
+    for chunk in read_events_table_in_chunks(mimic3_path, table, items_to_keep=items_to_keep,
+                                             subjects_to_keep=subjects_to_keep, chunksize=chunksize):
+        store.append('events', events_chunk_to_store(chunk), schema=EVENTS_SCHEMA)
@@ -1,5 +1,5 @@
 import numpy as np
-import re
+import pandas as pd
 
 from pandas import DataFrame, Series
 
@@ -146,55 +146,79 @@ def remove_outliers_for_variable(events, variable, ranges):
     return events
 
 
+# numbers without sign or exponent, the only strings kept by clean_lab and clean_o2sat
+NUMBER_PATTERN = r'^(\d+(\.\d*)?|\.\d+)$'
+BLOOD_PRESSURE_PATTERN = r'^(\d+)/(\d+)$'
+
+
+def to_float(values):
+    """ float values of a Series of numbers and numeric strings, NaN for the values that are not numbers. """
+    return pd.to_numeric(values, errors='coerce').astype(float)
+
+
+def map_distinct(values, fn):
+    """ Computes the vectorized fn on the distinct values of the Series values only and maps the result back to every
+    row. The VALUE and VALUEUOM columns of a variable hold few distinct values, so the string operations are done once
+    per value (as on a categorical) instead of once per row.
+    """
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    return Series(np.asarray(fn(Series(uniques, dtype=object)))[codes], index=values.index)
+
+
+def contains_lower(values, substring):
+    return map_distinct(values, lambda x: x.str.lower().str.contains(substring, regex=False))
+
+
+def non_numeric_strings(values):
+    """ Mask of the strings of values that do not match NUMBER_PATTERN (e.g. ERROR). """
+    def mask(uniques):
+        is_str = np.array([type(x) is str for x in uniques], dtype=bool)
+        result = np.zeros(len(uniques), dtype=bool)
+        result[is_str] = ~uniques[is_str].str.match(NUMBER_PATTERN).astype(bool)
+        return result
+    return map_distinct(values, mask)
+
+
+def blood_pressure(values, group):
+    """ The values as floats, with group 0 (systolic) or 1 (diastolic) of the strings of type SBP/DBP. """
+    def pressure(uniques):
+        uniques = uniques.astype(str)
+        pairs = uniques.str.extract(BLOOD_PRESSURE_PATTERN)
+        return to_float(uniques.mask(uniques.str.contains('/', regex=False), pairs[group]))
+    return map_distinct(values, pressure)
+
+
 # SBP: some are strings of type SBP/DBP
 def clean_sbp(df):
-    v = df.VALUE.astype(str).copy()
-    idx = v.apply(lambda s: '/' in s)
-    v.loc[idx] = v[idx].apply(lambda s: re.match('^(\d+)/(\d+)$', s).group(1))
-    return v.astype(float)
+    return blood_pressure(df.VALUE, 0)
 
 
 def clean_dbp(df):
-    v = df.VALUE.astype(str).copy()
-    idx = v.apply(lambda s: '/' in s)
-    v.loc[idx] = v[idx].apply(lambda s: re.match('^(\d+)/(\d+)$', s).group(2))
-    return v.astype(float)
+    return blood_pressure(df.VALUE, 1)
 
 
 # CRR: strings with brisk, <3 normal, delayed, or >3 abnormal
-def clean_crr(df):
-    v = Series(np.zeros(df.shape[0]), index=df.index)
-    v[:] = np.nan
+crr_map = {'Normal <3 secs': 0., 'Brisk': 0., 'Abnormal >3 secs': 1., 'Delayed': 1.}
+
 
+def clean_crr(df):
     # when df.VALUE is empty, dtype can be float and comparision with string
     # raises an exception, to fix this we change dtype to str
-    df_value_str = df.VALUE.astype(str)
-
-    v.loc[(df_value_str == 'Normal <3 secs') | (df_value_str == 'Brisk')] = 0
-    v.loc[(df_value_str == 'Abnormal >3 secs') | (df_value_str == 'Delayed')] = 1
-    return v
+    return df.VALUE.astype(str).map(crr_map).astype(float)
 
 
 # FIO2: many 0s, some 0<x<0.2 or 1<x<20
 def clean_fio2(df):
-    v = df.VALUE.astype(float).copy()
-
-    ''' The line below is the correct way of doing the cleaning, since we will not compare 'str' to 'float'.
-    If we use that line it will create mismatches from the data of the paper in ~50 ICU stays.
-    The next releases of the benchmark should use this line.
+    v = to_float(df.VALUE)
+
+    ''' The benchmark dataset of the paper was meant to divide by 100 the values whose unit is not torr and that are
+    strings or > 1.0. The previous implementation tested the strings with
+        is_str = np.array(map(lambda x: type(x) == str, list(df.VALUE)), dtype=bool)
+    which in python 3 is a single True (the map object itself), so every value whose unit is not torr was divided by
+    100, whatever its value. This is kept to produce the same data. The next releases of the benchmark should use
+        idx = ~contains_lower(df.VALUEUOM.fillna(''), 'torr') & (v > 1.0)
     '''
-    # idx = df.VALUEUOM.fillna('').apply(lambda s: 'torr' not in s.lower()) & (v>1.0)
-
-    ''' The line below was used to create the benchmark dataset that the paper used. Note this line will not work
-    in python 3, since it may try to compare 'str' to 'float'.
-    '''
-    # idx = df.VALUEUOM.fillna('').apply(lambda s: 'torr' not in s.lower()) & (df.VALUE > 1.0)
-
-    ''' The two following lines implement the code that was used to create the benchmark dataset that the paper used.
-    This works with both python 2 and python 3.
-    '''
-    is_str = np.array(map(lambda x: type(x) == str, list(df.VALUE)), dtype=bool)
-    idx = df.VALUEUOM.fillna('').apply(lambda s: 'torr' not in s.lower()) & (is_str | (~is_str & (v > 1.0)))
+    idx = ~contains_lower(df.VALUEUOM.fillna(''), 'torr')
 
     v.loc[idx] = v[idx] / 100.
     return v
@@ -202,20 +226,13 @@ def clean_fio2(df):
 
 # GLUCOSE, PH: sometimes have ERROR as value
 def clean_lab(df):
-    v = df.VALUE.copy()
-    idx = v.apply(lambda s: type(s) is str and not re.match('^(\d+(\.\d*)?|\.\d+)$', s))
-    v.loc[idx] = np.nan
-    return v.astype(float)
+    return to_float(df.VALUE.mask(non_numeric_strings(df.VALUE)))
 
 
 # O2SAT: small number of 0<x<=1 that should be mapped to 0-100 scale
 def clean_o2sat(df):
     # change "ERROR" to NaN
-    v = df.VALUE.copy()
-    idx = v.apply(lambda s: type(s) is str and not re.match('^(\d+(\.\d*)?|\.\d+)$', s))
-    v.loc[idx] = np.nan
-
-    v = v.astype(float)
+    v = clean_lab(df)
     idx = (v <= 1)
     v.loc[idx] = v[idx] * 100.
     return v
@@ -223,8 +240,9 @@ def clean_o2sat(df):
 
 # Temperature: map Farenheit to Celsius, some ambiguous 50<x<80
 def clean_temperature(df):
-    v = df.VALUE.astype(float).copy()
-    idx = df.VALUEUOM.fillna('').apply(lambda s: 'F' in s.lower()) | df.MIMIC_LABEL.apply(lambda s: 'F' in s.lower()) | (v >= 79)
+    v = to_float(df.VALUE)
+    # the unit and label tests look for 'F' in lowercased strings, so they never hold: only x >= 79 is converted
+    idx = contains_lower(df.VALUEUOM.fillna(''), 'F') | contains_lower(df.MIMIC_LABEL, 'F') | (v >= 79)
     v.loc[idx] = (v[idx] - 32) * 5. / 9
     return v
 
@@ -232,12 +250,13 @@ def clean_temperature(df):
 # Weight: some really light/heavy adults: <50 lb, >450 lb, ambiguous oz/lb
 # Children are tough for height, weight
 def clean_weight(df):
-    v = df.VALUE.astype(float).copy()
+    v = to_float(df.VALUE)
+    units = df.VALUEUOM.fillna('')
     # ounces
-    idx = df.VALUEUOM.fillna('').apply(lambda s: 'oz' in s.lower()) | df.MIMIC_LABEL.apply(lambda s: 'oz' in s.lower())
+    idx = contains_lower(units, 'oz') | contains_lower(df.MIMIC_LABEL, 'oz')
     v.loc[idx] = v[idx] / 16.
     # pounds
-    idx = idx | df.VALUEUOM.fillna('').apply(lambda s: 'lb' in s.lower()) | df.MIMIC_LABEL.apply(lambda s: 'lb' in s.lower())
+    idx = idx | contains_lower(units, 'lb') | contains_lower(df.MIMIC_LABEL, 'lb')
     v.loc[idx] = v[idx] * 0.453592
     return v
 
@@ -245,8 +264,8 @@ def clean_weight(df):
 # Height: some really short/tall adults: <2 ft, >7 ft)
 # Children are tough for height, weight
 def clean_height(df):
-    v = df.VALUE.astype(float).copy()
-    idx = df.VALUEUOM.fillna('').apply(lambda s: 'in' in s.lower()) | df.MIMIC_LABEL.apply(lambda s: 'in' in s.lower())
+    v = to_float(df.VALUE)
+    idx = contains_lower(df.VALUEUOM.fillna(''), 'in') | contains_lower(df.MIMIC_LABEL, 'in')
     v.loc[idx] = np.round(v[idx] * 2.54)
     return v
 
@@ -276,16 +295,26 @@ clean_fns = {
 
 
 def clean_events(events):
+    """ Cleans the values of the variables of clean_fns. The rows of every variable are found in one groupby pass and
+    the cleaned values are written back at once.
+    """
     global clean_fns
+    rows = events.groupby('VARIABLE', sort=False).indices
+    positions = []
+    values = []
     for var_name, clean_fn in clean_fns.items():
-        idx = (events.VARIABLE == var_name)
+        if var_name not in rows:
+            continue
         try:
-            events.loc[idx, 'VALUE'] = clean_fn(events[idx])
+            values.append(np.asarray(clean_fn(events.iloc[rows[var_name]])))
         except Exception as e:
             import traceback
             print("Exception in clean_events:", clean_fn.__name__, e)
             print(traceback.format_exc())
-            print("number of rows:", np.sum(idx))
-            print("values:", events[idx])
+            print("number of rows:", len(rows[var_name]))
+            print("values:", events.iloc[rows[var_name]])
             exit()
+        positions.append(rows[var_name])
+    if len(positions) > 0:
+        events.iloc[np.concatenate(positions), events.columns.get_loc('VALUE')] = np.concatenate(values)
     return events.loc[events.VALUE.notnull()]
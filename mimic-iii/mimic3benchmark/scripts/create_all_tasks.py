@@ -0,0 +1,286 @@
+import os
+import argparse
+import shutil
+import numpy as np
+import pandas as pd
+import yaml
+import random
+from tqdm import tqdm
+
+
+TASKS = ['in-hospital-mortality', 'decompensation', 'length-of-stay', 'phenotyping', 'multitask']
+
+# every task shuffles its train listfile with a generator seeded like the former single-task scripts
+SEED = 49297
+
+
+def read_phenotype_definitions(phenotype_definitions):
+    with open(phenotype_definitions) as definitions_file:
+        definitions = yaml.safe_load(definitions_file)
+
+    code_to_group = {}
+    for group in definitions:
+        codes = definitions[group]['codes']
+        for code in codes:
+            if code not in code_to_group:
+                code_to_group[code] = group
+            else:
+                assert code_to_group[code] == group
+
+    id_to_group = sorted(definitions.keys())
+    group_to_id = dict((x, i) for (i, x) in enumerate(id_to_group))
+    return definitions, code_to_group, id_to_group, group_to_id
+
+
+def write_timeseries(path, header, ts_lines):
+    # the path may be a hardlink left by a previous run, which must not be truncated in place
+    if os.path.lexists(path):
+        os.remove(path)
+    with open(path, "w") as outfile:
+        outfile.write(header)
+        for line in ts_lines:
+            outfile.write(line)
+
+
+def link_timeseries(source, path):
+    """ Hardlinks the timeseries written for another task, or copies it if the file system has no hardlinks. """
+    if os.path.lexists(path):
+        os.remove(path)
+    try:
+        os.link(source, path)
+    except OSError:
+        shutil.copyfile(source, path)
+
+
+def get_lived_time(stays_df, icustay):
+    stay = stays_df[stays_df.ICUSTAY_ID == icustay]
+    deathtime = pd.to_datetime(stay['DEATHTIME'].iloc[0])
+    intime = pd.to_datetime(stay['INTIME'].iloc[0])
+    if pd.isnull(deathtime):
+        return 1e18
+    # conversion to pydatetime is needed to avoid overflow issues when subtracting
+    return (deathtime.to_pydatetime() - intime.to_pydatetime()).total_seconds() / 3600.0
+
+
+def get_phenotype_labels(diagnoses_df, icustay, phenotypes):
+    definitions, code_to_group, id_to_group, group_to_id = phenotypes
+    cur_labels = [0 for i in range(len(id_to_group))]
+    diagnoses_df = diagnoses_df[(diagnoses_df.ICUSTAY_ID == icustay) & diagnoses_df.USE_IN_BENCHMARK.astype(bool)]
+    for code in diagnoses_df.ICD9_CODE:
+        cur_labels[group_to_id[code_to_group[code]]] = 1
+    return [x for (i, x) in enumerate(cur_labels) if definitions[id_to_group[i]]['use_in_benchmark']]
+
+
+def get_sample_times(end_time, first_event_time, sample_rate, shortest_length, eps):
+    sample_times = np.arange(0.0, end_time + eps, sample_rate)
+    sample_times = list(filter(lambda x: x > shortest_length, sample_times))
+    # at least one measurement
+    return list(filter(lambda x: x > first_event_time, sample_times))
+
+
+def get_multitask_sample(output_ts_filename, los, mortality, lived_time, event_times, phenotype_labels,
+                         sample_rate, shortest_length, eps, future_time_interval, fixed_hours):
+    # in-hospital mortality
+    ihm_mask = 1
+    if los < fixed_hours - eps:
+        ihm_mask = 0
+    if event_times[0] > fixed_hours + eps:
+        ihm_mask = 0
+    ihm_position = 47 if ihm_mask == 1 else 0
+
+    # length of stay
+    sample_times = np.arange(0.0, los + eps, sample_rate)
+    sample_times = np.array([int(x+eps) for x in sample_times])
+    los_masks = list(map(int, (sample_times > shortest_length) & (sample_times > event_times[0])))
+    los_labels = los - sample_times
+
+    # decompensation
+    sample_times = np.arange(0.0, min(los, lived_time) + eps, sample_rate)
+    sample_times = np.array([int(x+eps) for x in sample_times])
+    decomp_masks = list(map(int, (sample_times > shortest_length) & (sample_times > event_times[0])))
+    decomp_labels = [(mortality & int(lived_time - t < future_time_interval)) for t in sample_times]
+
+    return (output_ts_filename, los, (ihm_position, ihm_mask, mortality), (los_masks, los_labels),
+            phenotype_labels, (decomp_masks, decomp_labels))
+
+
+def order_samples(task, partition, samples):
+    """ Orders the samples of a listfile the way the single-task scripts did: train is shuffled and test is sorted,
+    except for phenotyping, which sorts train after shuffling it and keeps test in listing order.
+    """
+    if partition == "train":
+        random.Random(SEED).shuffle(samples)
+        if task == 'phenotyping':
+            samples = sorted(samples)
+    if partition == "test" and task != 'phenotyping':
+        samples = sorted(samples, key=lambda x: x[:2])
+    return samples
+
+
+def write_listfile(task, output_dir, samples, phenotypes):
+    with open(os.path.join(output_dir, "listfile.csv"), "w") as listfile:
+        if task == 'in-hospital-mortality':
+            listfile.write('stay,y_true\n')
+            for (x, y) in samples:
+                listfile.write('{},{:d}\n'.format(x, y))
+        elif task == 'decompensation':
+            listfile.write('stay,period_length,y_true\n')
+            for (x, t, y) in samples:
+                listfile.write('{},{:.6f},{:d}\n'.format(x, t, y))
+        elif task == 'length-of-stay':
+            listfile.write('stay,period_length,y_true\n')
+            for (x, t, y) in samples:
+                listfile.write('{},{:.6f},{:.6f}\n'.format(x, t, y))
+        elif task == 'phenotyping':
+            definitions, _, id_to_group, _ = phenotypes
+            codes_in_benchmark = [x for x in id_to_group if definitions[x]['use_in_benchmark']]
+            listfile.write("stay,period_length," + ",".join(codes_in_benchmark) + "\n")
+            for (x, t, y) in samples:
+                listfile.write('{},{:.6f},{}\n'.format(x, t, ','.join(map(str, y))))
+        elif task == 'multitask':
+            header = ','.join(['filename', 'length of stay', 'in-hospital mortality task (pos;mask;label)',
+                               'length of stay task (masks;labels)', 'phenotyping task (labels)',
+                               'decompensation task (masks;labels)'])
+            listfile.write(header + "\n")
+            for (x, los, ihm, (los_masks, los_labels), pheno, (decomp_masks, decomp_labels)) in samples:
+                ihm_task = '{:d};{:d};{:d}'.format(*ihm)
+                los_task = '{};{}'.format(";".join(map(str, los_masks)),
+                                          ";".join(map(lambda v: '{:.6f}'.format(v), los_labels)))
+                pheno_task = ';'.join(map(str, pheno))
+                decomp_task = '{};{}'.format(";".join(map(str, decomp_masks)), ";".join(map(str, decomp_labels)))
+                listfile.write(','.join([x, '{:.6f}'.format(los), ihm_task, los_task, pheno_task, decomp_task]) + "\n")
+
+
+def process_partition(root_path, output_paths, phenotypes, partition, sample_rate=1.0, shortest_length=4.0,
+                      eps=1e-6, future_time_interval=24.0, n_hours=48.0):
+    """ Builds the listfiles of several tasks from one pass over the episodes of a partition.
+
+    Every episode is read once. Its timeseries cut to the ICU stay is written once, to the directory of the first task
+    that uses it, and hardlinked into the directories of the others. In-hospital mortality uses the first n_hours only,
+    so it gets its own file unless the two cuts are the same.
+
+    :param output_paths: dict from task name (see TASKS) to the directory where its partitions are created.
+    :param phenotypes: the result of read_phenotype_definitions, only used by phenotyping and multitask.
+    """
+    tasks = [task for task in TASKS if task in output_paths]
+    stay_tasks = [task for task in tasks if task != 'in-hospital-mortality']
+    output_dirs = {}
+    for task in tasks:
+        output_dirs[task] = os.path.join(output_paths[task], partition)
+        os.makedirs(output_dirs[task], exist_ok=True)
+    samples = dict((task, []) for task in tasks)
+
+    patients = list(filter(str.isdigit, os.listdir(os.path.join(root_path, partition))))
+    for patient in tqdm(patients, desc='Iterating over patients in {}'.format(partition)):
+        patient_folder = os.path.join(root_path, partition, patient)
+        patient_ts_files = list(filter(lambda x: x.find("timeseries") != -1, os.listdir(patient_folder)))
+        stays_df = None
+        diagnoses_df = None
+        if 'decompensation' in tasks or 'multitask' in tasks:
+            stays_df = pd.read_csv(os.path.join(patient_folder, "stays.csv"))
+        if 'phenotyping' in tasks or 'multitask' in tasks:
+            diagnoses_df = pd.read_csv(os.path.join(patient_folder, "diagnoses.csv"), dtype={"ICD9_CODE": str})
+
+        for ts_filename in patient_ts_files:
+            lb_filename = ts_filename.replace("_timeseries", "")
+            label_df = pd.read_csv(os.path.join(patient_folder, lb_filename))
+
+            # empty label file
+            if label_df.shape[0] == 0:
+                print("\n\t(empty label file)", patient, ts_filename)
+                continue
+
+            los = 24.0 * label_df.iloc[0]['Length of Stay']  # in hours
+            if pd.isnull(los):
+                print("\n\t(length of stay is missing)", patient, ts_filename)
+                continue
+
+            mortality = int(label_df.iloc[0]["Mortality"])
+            icustay = label_df['Icustay'].iloc[0]
+
+            with open(os.path.join(patient_folder, ts_filename)) as tsfile:
+                ts_lines = tsfile.readlines()
+            header = ts_lines[0]
+            ts_lines = ts_lines[1:]
+            event_times = [float(line.split(',')[0]) for line in ts_lines]
+            output_ts_filename = patient + "_" + ts_filename
+
+            stay_lines = [line for (line, t) in zip(ts_lines, event_times) if -eps < t < los + eps]
+            stay_times = [t for t in event_times if -eps < t < los + eps]
+            if len(stay_lines) == 0:
+                print("\n\t(no events in ICU) ", patient, ts_filename)
+            elif len(stay_tasks) > 0:
+                source = os.path.join(output_dirs[stay_tasks[0]], output_ts_filename)
+                write_timeseries(source, header, stay_lines)
+                for task in stay_tasks[1:]:
+                    link_timeseries(source, os.path.join(output_dirs[task], output_ts_filename))
+
+            if 'in-hospital-mortality' in tasks and los >= n_hours - eps:
+                ihm_lines = [line for (line, t) in zip(ts_lines, event_times) if -eps < t < n_hours + eps]
+                if len(ihm_lines) > 0:
+                    path = os.path.join(output_dirs['in-hospital-mortality'], output_ts_filename)
+                    if len(stay_tasks) > 0 and ihm_lines == stay_lines:
+                        link_timeseries(os.path.join(output_dirs[stay_tasks[0]], output_ts_filename), path)
+                    else:
+                        write_timeseries(path, header, ihm_lines)
+                    samples['in-hospital-mortality'].append((output_ts_filename, mortality))
+
+            # no measurements in ICU
+            if len(stay_lines) == 0:
+                continue
+
+            lived_time = None
+            if stays_df is not None:
+                lived_time = get_lived_time(stays_df, icustay)
+            phenotype_labels = None
+            if diagnoses_df is not None:
+                phenotype_labels = get_phenotype_labels(diagnoses_df, icustay, phenotypes)
+
+            if 'decompensation' in tasks:
+                for t in get_sample_times(min(los, lived_time), stay_times[0], sample_rate, shortest_length, eps):
+                    cur_mortality = 0 if mortality == 0 else int(lived_time - t < future_time_interval)
+                    samples['decompensation'].append((output_ts_filename, t, cur_mortality))
+            if 'length-of-stay' in tasks:
+                for t in get_sample_times(los, stay_times[0], sample_rate, shortest_length, eps):
+                    samples['length-of-stay'].append((output_ts_filename, t, los - t))
+            if 'phenotyping' in tasks:
+                samples['phenotyping'].append((output_ts_filename, los, phenotype_labels))
+            if 'multitask' in tasks:
+                samples['multitask'].append(get_multitask_sample(
+                    output_ts_filename, los, mortality, lived_time, stay_times, phenotype_labels, sample_rate,
+                    shortest_length, eps, future_time_interval, n_hours))
+
+    for task in tasks:
+        print("Number of created samples for {}:".format(task), len(samples[task]))
+        write_listfile(task, output_dirs[task], order_samples(task, partition, samples[task]), phenotypes)
+
+
+def create_tasks(root_path, output_paths, phenotype_definitions=None, partitions=("test", "train")):
+    phenotypes = None
+    if 'phenotyping' in output_paths or 'multitask' in output_paths:
+        if phenotype_definitions is None:
+            phenotype_definitions = os.path.join(os.path.dirname(__file__),
+                                                 '../resources/hcup_ccs_2015_definitions.yaml')
+        phenotypes = read_phenotype_definitions(phenotype_definitions)
+    for partition in partitions:
+        process_partition(root_path, output_paths, phenotypes, partition)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create the data of all the prediction tasks in one pass over "
+                                                 "the episodes.")
+    parser.add_argument('root_path', type=str, help="Path to root folder containing train and test sets.")
+    parser.add_argument('output_path', type=str, help="Directory where one sub-directory per task is created.")
+    parser.add_argument('--tasks', type=str, nargs='+', choices=TASKS, default=TASKS,
+                        help='Tasks whose data is created.')
+    parser.add_argument('--phenotype_definitions', '-p', type=str,
+                        default=os.path.join(os.path.dirname(__file__), '../resources/hcup_ccs_2015_definitions.yaml'),
+                        help='YAML file with phenotype definitions.')
+    args, _ = parser.parse_known_args()
+
+    create_tasks(args.root_path, dict((task, os.path.join(args.output_path, task)) for task in args.tasks),
+                 args.phenotype_definitions)
+
+
+if __name__ == '__main__':
+    main()
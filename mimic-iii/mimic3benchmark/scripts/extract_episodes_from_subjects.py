@@ -1,46 +1,86 @@
 import argparse
 import os
-import sys
+from multiprocessing import Pool
 from tqdm import tqdm
 
-from mimic3benchmark.subject import read_stays, read_diagnoses, read_events, get_events_for_stay,\
-    add_hours_elpased_to_events
-from mimic3benchmark.subject import convert_events_to_timeseries, get_first_valid_from_timeseries
+from mimic3benchmark.checkpoints import atomic_write, combine_digests, file_digest, read_subject_marker
+from mimic3benchmark.checkpoints import write_subject_marker
+from mimic3benchmark.subject import read_stays, read_diagnoses, read_events, add_hours_elpased_to_events
+from mimic3benchmark.subject import SubjectTimeseries, get_first_valid_from_timeseries
 from mimic3benchmark.preprocessing import read_itemid_to_variable_map, map_itemids_to_variables, clean_events
 from mimic3benchmark.preprocessing import assemble_episodic_data
+from mimic3benchmark.util import has_store
 
 
-parser = argparse.ArgumentParser(description='Extract episodes from per-subject data.')
-parser.add_argument('subjects_root_path', type=str, help='Directory containing subject sub-directories.')
-parser.add_argument('--variable_map_file', type=str,
-                    default=os.path.join(os.path.dirname(__file__), '../resources/itemid_to_variable_map.csv'),
-                    help='CSV containing ITEMID-to-VARIABLE map.')
-parser.add_argument('--reference_range_file', type=str,
-                    default=os.path.join(os.path.dirname(__file__), '../resources/variable_ranges.csv'),
-                    help='CSV containing reference ranges for VARIABLEs.')
-args, _ = parser.parse_known_args()
+# ITEMID-to-VARIABLE map shared by the subjects handled in this process
+var_map = None
+variables = None
+var_map_digest = None
+# whether the subjects already extracted from the same inputs are extracted again
+force = False
 
-var_map = read_itemid_to_variable_map(args.variable_map_file)
-variables = var_map.VARIABLE.unique()
 
-for subject_dir in tqdm(os.listdir(args.subjects_root_path), desc='Iterating over subjects'):
-    dn = os.path.join(args.subjects_root_path, subject_dir)
-    try:
-        subject_id = int(subject_dir)
-        if not os.path.isdir(dn):
-            raise Exception
-    except:
-        continue
+def init_worker(variable_map_file, force_extraction=False):
+    global var_map, variables, var_map_digest, force
+    var_map = read_itemid_to_variable_map(variable_map_file)
+    variables = var_map.VARIABLE.unique()
+    var_map_digest = file_digest(variable_map_file)
+    force = force_extraction
+
+
+def is_subject_folder(subjects_root_path, subject_dir):
+    return subject_dir.isdigit() and os.path.isdir(os.path.join(subjects_root_path, subject_dir))
+
+
+def process_subject(subjects_root_path, subject_dir):
+    """ Extracts the episodes of one subject directory.
+
+    With per-subject csv files, a subject is skipped when a previous run extracted it from the same stays, diagnoses,
+    events and variable map, which the marker written after its episodes records with their digests.
+
+    :return: (subject_id, episodes, error) where episodes is the list of (episode number, ICUSTAY_ID, number of
+             timeseries rows) written for this subject and error is None or the reason the subject was skipped.
+    """
+    subject_id = int(subject_dir)
+    dn = os.path.join(subjects_root_path, subject_dir)
+    if has_store(subjects_root_path):
+        episodes, error = extract_episodes(dn)
+        return subject_id, episodes, error
 
+    inputs = combine_digests([file_digest(os.path.join(dn, name))
+                              for name in ('stays.csv', 'diagnoses.csv', 'events.csv')] + [var_map_digest])
+    marker = None if force else read_subject_marker(dn, 'episodes')
+    if marker is not None and marker['inputs'] == inputs and all(
+            os.path.isfile(os.path.join(dn, 'episode{}_timeseries.csv'.format(n))) for n, _, _ in marker['episodes']):
+        return subject_id, [tuple(episode) for episode in marker['episodes']], None
+    episodes, error = extract_episodes(dn)
+    if error is None:
+        write_subject_marker(dn, 'episodes', {'inputs': inputs, 'episodes': episodes})
+    return subject_id, episodes, error
+
+
+def extract_episodes(dn):
+    """ Writes the episodes of the subject of directory dn.
+
+    :return: (episodes, error), see process_subject.
+    """
     try:
         # reading tables of this subject
-        stays = read_stays(os.path.join(args.subjects_root_path, subject_dir))
-        diagnoses = read_diagnoses(os.path.join(args.subjects_root_path, subject_dir))
-        events = read_events(os.path.join(args.subjects_root_path, subject_dir))
-    except:
-        sys.stderr.write('Error reading from disk for subject: {}\n'.format(subject_id))
-        continue
+        stays = read_stays(dn)
+        diagnoses = read_diagnoses(dn)
+        events = read_events(dn)
+    except Exception as e:
+        return [], 'Error reading from disk: {}'.format(repr(e))
+
+    try:
+        return write_episodes(dn, stays, diagnoses, events), None
+    except Exception as e:
+        # a subject whose episodes cannot be extracted is recorded in episodes_errors.csv instead of ending the run
+        return [], 'Error extracting episodes: {}'.format(repr(e))
+
 
+def write_episodes(dn, stays, diagnoses, events):
+    """ :return: the list of (episode number, stay id, number of timeseries rows) written for this subject. """
     episodic_data = assemble_episodic_data(stays, diagnoses)
 
     # cleaning and converting to time series
@@ -48,29 +88,93 @@ for subject_dir in tqdm(os.listdir(args.subjects_root_path), desc='Iterating ove
     events = clean_events(events)
     if events.shape[0] == 0:
         # no valid events for this subject
-        continue
-    timeseries = convert_events_to_timeseries(events, variables=variables)
+        return []
+    timeseries = SubjectTimeseries(events, variables=variables)
 
     # extracting separate episodes
+    episodes = []
     for i in range(stays.shape[0]):
         stay_id = stays.ICUSTAY_ID.iloc[i]
         intime = stays.INTIME.iloc[i]
         outtime = stays.OUTTIME.iloc[i]
 
-        episode = get_events_for_stay(timeseries, stay_id, intime, outtime)
+        episode = timeseries.get_stay(stay_id, intime, outtime)
         if episode.shape[0] == 0:
             # no data for this episode
             continue
 
+        # with the Parquet store, subject directories only hold the episodes
+        os.makedirs(dn, exist_ok=True)
         episode = add_hours_elpased_to_events(episode, intime).set_index('HOURS').sort_index(axis=0)
         if stay_id in episodic_data.index:
             episodic_data.loc[stay_id, 'Weight'] = get_first_valid_from_timeseries(episode, 'Weight')
             episodic_data.loc[stay_id, 'Height'] = get_first_valid_from_timeseries(episode, 'Height')
-        episodic_data.loc[episodic_data.index == stay_id].to_csv(os.path.join(args.subjects_root_path, subject_dir,
-                                                                              'episode{}.csv'.format(i+1)),
+        episodic_data.loc[episodic_data.index == stay_id].to_csv(os.path.join(dn, 'episode{}.csv'.format(i+1)),
                                                                  index_label='Icustay')
         columns = list(episode.columns)
         columns_sorted = sorted(columns, key=(lambda x: "" if x == "Hours" else x))
         episode = episode[columns_sorted]
-        episode.to_csv(os.path.join(args.subjects_root_path, subject_dir, 'episode{}_timeseries.csv'.format(i+1)),
-                       index_label='Hours')
+        episode.to_csv(os.path.join(dn, 'episode{}_timeseries.csv'.format(i+1)), index_label='Hours')
+        episodes.append((i+1, int(stay_id), int(episode.shape[0])))
+    return episodes
+
+
+def process_subject_star(task):
+    return process_subject(*task)
+
+
+def write_manifest(subjects_root_path, results):
+    """ Writes the episodes and the errors of all subjects, ordered by SUBJECT_ID and episode number. """
+    results = sorted(results, key=lambda x: x[0])
+    with atomic_write(os.path.join(subjects_root_path, 'episodes_manifest.csv')) as manifest:
+        manifest.write('SUBJECT_ID,EPISODE,ICUSTAY_ID,N_ROWS\n')
+        for subject_id, episodes, _ in results:
+            for n_episode, stay_id, n_rows in episodes:
+                manifest.write('{},{},{},{}\n'.format(subject_id, n_episode, stay_id, n_rows))
+
+    errors = [(subject_id, error) for subject_id, _, error in results if error is not None]
+    with atomic_write(os.path.join(subjects_root_path, 'episodes_errors.csv')) as error_file:
+        error_file.write('SUBJECT_ID,ERROR\n')
+        for subject_id, error in errors:
+            error_file.write('{},"{}"\n'.format(subject_id, error.replace('"', "'")))
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Extract episodes from per-subject data.')
+    parser.add_argument('subjects_root_path', type=str, help='Directory containing subject sub-directories.')
+    parser.add_argument('--variable_map_file', type=str,
+                        default=os.path.join(os.path.dirname(__file__), '../resources/itemid_to_variable_map.csv'),
+                        help='CSV containing ITEMID-to-VARIABLE map.')
+    parser.add_argument('--reference_range_file', type=str,
+                        default=os.path.join(os.path.dirname(__file__), '../resources/variable_ranges.csv'),
+                        help='CSV containing reference ranges for VARIABLEs.')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes extracting subjects.')
+    parser.add_argument('--chunksize', type=int, default=16, help='Number of subjects sent to a worker at once.')
+    parser.add_argument('--force', action='store_true',
+                        help='Extract again the subjects already extracted from the same inputs by a previous run.')
+    args, _ = parser.parse_known_args()
+
+    if has_store(args.subjects_root_path):
+        from mimic3benchmark.parquet_store import SubjectStore
+        subject_dirs = [str(subject_id) for subject_id in SubjectStore(args.subjects_root_path).subjects()]
+    else:
+        subject_dirs = sorted(filter(lambda x: is_subject_folder(args.subjects_root_path, x),
+                                     os.listdir(args.subjects_root_path)), key=int)
+    tasks = [(args.subjects_root_path, subject_dir) for subject_dir in subject_dirs]
+
+    if args.workers > 1:
+        with Pool(args.workers, initializer=init_worker, initargs=(args.variable_map_file, args.force)) as pool:
+            results = list(tqdm(pool.imap_unordered(process_subject_star, tasks, chunksize=args.chunksize),
+                                total=len(tasks), desc='Iterating over subjects'))
+    else:
+        init_worker(args.variable_map_file, args.force)
+        results = [process_subject_star(task) for task in tqdm(tasks, desc='Iterating over subjects')]
+
+    errors = write_manifest(args.subjects_root_path, results)
+    print('Extracted {} episodes from {} subjects, {} subjects skipped because of errors.'.format(
+        sum(len(episodes) for _, episodes, _ in results), len(results), len(errors)))
+
+
+if __name__ == '__main__':
+    main()
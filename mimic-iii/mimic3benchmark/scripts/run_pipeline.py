@@ -0,0 +1,56 @@
+import argparse
+import os
+import subprocess
+import sys
+
+from mimic3benchmark.checkpoints import StageRunner, combine_digests
+
+
+# directory of preprocess_mimic3, which the modules of the pipeline are run from
+BENCHMARK_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+
+def run_module(module, *args):
+    command = [sys.executable, '-m', module] + [str(x) for x in args]
+    print(' '.join(command))
+    subprocess.check_call(command, cwd=BENCHMARK_DIR)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the steps that build the per-subject data and the episodes, '
+                                                 'skipping those already completed with the same inputs.')
+    parser.add_argument('mimic3_path', type=str, help='Directory containing MIMIC-III CSV files.')
+    parser.add_argument('subjects_root_path', type=str, help='Directory where per-subject data should be written.')
+    parser.add_argument('--ehr_output_path', type=str, default=None,
+                        help='Directory where preprocess_mimic3 writes the formatted EHR csv file (not run if not '
+                             'given).')
+    parser.add_argument('--events_chunksize', type=int, default=1000000,
+                        help='Read event tables with pandas in chunks of this many rows (0: read row by row).')
+    parser.add_argument('--workers', type=int, default=1, help='Number of processes of the steps that have some.')
+    parser.add_argument('--force', action='store_true', help='Run every step again, ignoring the completed ones.')
+    args, _ = parser.parse_known_args()
+
+    force = ['--force'] if args.force else []
+    root = os.path.abspath(args.subjects_root_path)
+
+    # extract_subjects skips its own completed stages, so it always runs; the digests of these stages then tell the
+    # later steps whether the per-subject files changed
+    run_module('mimic3benchmark.scripts.extract_subjects', os.path.abspath(args.mimic3_path), root,
+               '--events_chunksize', args.events_chunksize, '--workers', args.workers, *force)
+    runner = StageRunner(root, force=args.force)
+    subjects_digest = combine_digests([runner.digest('subject_tables'), runner.digest('events')])
+
+    runner.run('validate_events', lambda: run_module('mimic3benchmark.scripts.validate_events', root, *force),
+               params=[subjects_digest])
+    runner.run('extract_episodes',
+               lambda: run_module('mimic3benchmark.scripts.extract_episodes_from_subjects', root,
+                                  '--workers', args.workers, *force),
+               params=[runner.digest('validate_events')])
+    if args.ehr_output_path is not None:
+        ehr_output_path = os.path.abspath(args.ehr_output_path)
+        runner.run('preprocess', lambda: run_module('preprocess_mimic3', root, ehr_output_path),
+                   files=[os.path.join(root, 'episodes_manifest.csv')], params=[ehr_output_path])
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,90 @@
+import numpy as np
+import os
 import pandas as pd
+from multiprocessing import Pool
+from tqdm import tqdm
+
+
+# directory of the Parquet store (see mimic3benchmark/parquet_store.py) inside the subjects root path
+STORE_DIR = 'parquet'
 
 
 def dataframe_from_csv(path, header=0, index_col=0):
     return pd.read_csv(path, header=header, index_col=index_col)
+
+
+def has_store(subjects_root_path):
+    return os.path.isfile(os.path.join(subjects_root_path, STORE_DIR, 'store.json'))
+
+
+def _write_partition_batch(task):
+    rows, keys, starts, ends, output_path, file_name, sort_by = task
+    for value, start, end in zip(keys, starts, ends):
+        dn = os.path.join(output_path, str(value))
+        os.makedirs(dn, exist_ok=True)
+        partition = rows.iloc[start:end]
+        if sort_by is not None:
+            partition = partition.sort_values(by=sort_by)
+        partition.to_csv(os.path.join(dn, file_name), index=False)
+    return len(keys)
+
+
+def write_partitions(df, key, output_path, file_name, keys=None, sort_by=None, workers=1, desc=None):
+    """ Writes the rows of df with each value of key to output_path/<value>/file_name, sorted by sort_by.
+
+    df is sorted by key once and every partition is a slice of it, instead of one scan of df per value. Values in keys
+    without rows get a file with the header only. With workers > 1 the partitions are written by a process pool.
+    """
+    keys = np.unique(np.asarray(df[key].unique() if keys is None else keys))
+    df = df.iloc[np.argsort(df[key].values, kind='mergesort')]
+    column = df[key].values
+    starts = np.searchsorted(column, keys, side='left')
+    ends = np.searchsorted(column, keys, side='right')
+
+    if workers > 1:
+        bounds = np.linspace(0, len(keys), num=min(len(keys), workers * 8) + 1, dtype=int)
+        tasks = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            offset = starts[lo]
+            tasks.append((df.iloc[offset:ends[hi - 1]], keys[lo:hi], starts[lo:hi] - offset, ends[lo:hi] - offset,
+                          output_path, file_name, sort_by))
+        with Pool(workers) as pool, tqdm(total=len(keys), desc=desc) as pbar:
+            for n in pool.imap_unordered(_write_partition_batch, tasks):
+                pbar.update(n)
+    else:
+        _write_partition_batch((df, tqdm(keys, desc=desc), starts, ends, output_path, file_name, sort_by))
+
+
+class CsvAppender:
+    """ Writes DataFrames to one csv file, buffering them until they take max_memory bytes. Each flush concatenates
+    the buffered frames and appends them to the file, so the time is linear in the number of frames.
+    """
+    def __init__(self, path, columns, max_memory=1024 * 2**20):
+        self._path = path
+        self._columns = columns
+        self._max_memory = max_memory
+        self._buffer = []
+        self._buffer_size = 0
+        self._header_written = False
+
+    def append(self, df):
+        self._buffer.append(df)
+        self._buffer_size += df.memory_usage(deep=True).sum()
+        if self._buffer_size >= self._max_memory:
+            self.flush()
+
+    def flush(self):
+        if len(self._buffer) > 0:
+            df = pd.concat(self._buffer, ignore_index=True)[self._columns]
+        elif not self._header_written:
+            df = pd.DataFrame(columns=self._columns)
+        else:
+            return
+        df.to_csv(self._path, mode='a' if self._header_written else 'w', header=not self._header_written,
+                  index=False)
+        self._header_written = True
+        self._buffer = []
+        self._buffer_size = 0
+
+    def close(self):
+        self.flush()
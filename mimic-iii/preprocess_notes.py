@@ -6,6 +6,8 @@ import numpy as np
 from tqdm import tqdm
 import pickle
 
+from mimic3benchmark.util import CsvAppender
+
 
 def diff(time1, time2):
     # compute time2-time1
@@ -41,7 +43,9 @@ def extract_to_csv(args, partition, eps=1e-6):
     text_fixed_dir = os.path.join(args.root_path, f'{partition}_text_fixed')
     text_reader = TextReader(text_fixed_dir)
     filenames = os.listdir(text_fixed_dir)
-    notes_df = pd.DataFrame(columns=['PatientID', 'Recordtime', 'AdmissionTime', 'DischargeTime', 'Text'])
+    notes_writer = CsvAppender(os.path.join(output_dir, f"{partition}.csv"),
+                               ['PatientID', 'Recordtime', 'AdmissionTime', 'DischargeTime', 'Text'],
+                               max_memory=int(args.max_memory * 2**20))
     for filename in tqdm(filenames, desc='Iterating over notes in {}'.format(partition)):
         patient_id, episode_num = filename.split('_')[:2]
         if not episode_num.isdigit():
@@ -63,15 +67,17 @@ def extract_to_csv(args, partition, eps=1e-6):
         time, text = text_reader.read_all_text(filename, intime)
         text_df = pd.DataFrame({'PatientID': patient_id, 'Recordtime': time, 'AdmissionTime': intime, 
                                 'DischargeTime': outtime, 'Text': text})
-        notes_df = pd.concat([notes_df, text_df], ignore_index=True)
-    
-    notes_df.to_csv(os.path.join(output_dir, f"{partition}.csv"), index=False)
+        notes_writer.append(text_df)
+
+    notes_writer.close()
         
 
 def main():
     parser = argparse.ArgumentParser(description="Create data for in-hospital mortality prediction task.")
     parser.add_argument('root_path', type=str, help="Path to root folder containing train and test sets.")
     parser.add_argument('output_path', type=str, help="Directory where the created data should be stored.")
+    parser.add_argument('--max_memory', type=float, default=1024,
+                        help='Megabytes of notes kept in memory before they are appended to the csv file.')
     args, _ = parser.parse_known_args()
 
     if not os.path.exists(args.output_path):
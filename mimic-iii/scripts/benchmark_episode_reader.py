@@ -0,0 +1,83 @@
+import argparse
+import os
+import time
+import numpy as np
+import pandas as pd
+
+from preprocess_mimic3 import read_episode_timeseries
+
+
+def read_episode_timeseries_by_row(tsfile, los, eps=1e-6):
+    """ The previous reader of extract_to_csv, which adds the rows to the DataFrame one by one with .loc """
+    ts_lines = tsfile.read().splitlines()
+    header = ts_lines[0]
+    ts_lines = ts_lines[1:]
+    event_times = [float(line.split(',')[0]) for line in ts_lines]
+
+    ts_lines = [line for (line, t) in zip(ts_lines, event_times)
+                if -eps < t < los + eps]
+    event_times = [t for t in event_times
+                   if -eps < t < los + eps]
+
+    ts_df = pd.DataFrame(columns=header.split(','))
+    for i in range(len(ts_lines)):
+        ts_df.loc[i] = ts_lines[i].split(',')
+    return ts_df, event_times
+
+
+def list_episodes(root_path):
+    episodes = []
+    for patient in filter(str.isdigit, os.listdir(root_path)):
+        patient_folder = os.path.join(root_path, patient)
+        for ts_filename in os.listdir(patient_folder):
+            if ts_filename.find("timeseries") == -1:
+                continue
+            label_df = pd.read_csv(os.path.join(patient_folder, ts_filename.replace("_timeseries", "")))
+            if label_df.shape[0] == 0 or pd.isnull(label_df.iloc[0]['Length of Stay']):
+                continue
+            episodes.append((os.path.join(patient_folder, ts_filename), 24.0 * label_df.iloc[0]['Length of Stay']))
+    return sorted(episodes)
+
+
+def time_reader(reader, episodes):
+    latencies = []
+    results = []
+    for path, los in episodes:
+        start = time.perf_counter()
+        with open(path) as tsfile:
+            results.append(reader(tsfile, los))
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies) * 1000.0, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the per-episode latency of the episode timeseries readers '
+                                                 'of extract_to_csv.')
+    parser.add_argument('root_path', type=str, help='Directory containing the subject directories with episodes.')
+    parser.add_argument('--n_episodes', type=int, default=200, help='Number of episodes sampled.')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    episodes = list_episodes(args.root_path)
+    if len(episodes) > args.n_episodes:
+        rng = np.random.RandomState(args.seed)
+        episodes = [episodes[i] for i in sorted(rng.choice(len(episodes), args.n_episodes, replace=False))]
+
+    by_row, by_row_results = time_reader(read_episode_timeseries_by_row, episodes)
+    bulk, bulk_results = time_reader(read_episode_timeseries, episodes)
+
+    for (row_df, row_times), (bulk_df, bulk_times) in zip(by_row_results, bulk_results):
+        assert row_times == bulk_times
+        if row_df.shape[0] > 0:
+            pd.testing.assert_frame_equal(row_df, bulk_df, check_index_type=False)
+
+    n_rows = np.array([df.shape[0] for df, _ in bulk_results])
+    print('{} episodes, {:.1f} rows per episode on average'.format(len(episodes), n_rows.mean()))
+    for name, latencies in [('row by row (.loc)', by_row), ('bulk read_csv', bulk)]:
+        print('{:>18}: mean {:.2f} ms, median {:.2f} ms, max {:.2f} ms per episode'.format(
+            name, latencies.mean(), np.median(latencies), latencies.max()))
+    print('speedup: {:.1f}x'.format(by_row.sum() / bulk.sum()))
+
+
+if __name__ == '__main__':
+    main()
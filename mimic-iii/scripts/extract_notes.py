@@ -171,10 +171,13 @@ def extract_notes(args, partition):
     sentence_lens = []
     hadm_id2index = {}
 
+    # notes of each subject, instead of a scan of all the notes per subject
+    notes_by_subject = dict(list(df2.groupby('SUBJECT_ID')))
+
     for folder in all_folders:
         try:
             patient_id = int(folder)
-            sliced = df2[df2.SUBJECT_ID == patient_id]
+            sliced = notes_by_subject.get(patient_id, df2.iloc[:0])
             if sliced.shape[0] == 0:
                 print("No notes for PATIENT_ID : {}".format(patient_id))
                 failed += 1
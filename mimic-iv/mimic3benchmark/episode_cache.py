@@ -0,0 +1,204 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+try:
+    import fcntl
+except ImportError:  # no lock between the processes building a cache where fcntl is not available (Windows)
+    fcntl = None
+
+
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(__file__), '../resources/discretizer_config.json')
+
+
+def read_discretizer_config(config_path=DEFAULT_CONFIG_PATH):
+    """ :return: (is_categorical_channel, value_to_id) where value_to_id maps every channel to a dict from its possible
+             values to their index.
+    """
+    with open(config_path) as f:
+        config = json.load(f)
+    value_to_id = dict((channel, dict((value, i) for (i, value) in enumerate(values)))
+                       for (channel, values) in config['possible_values'].items())
+    return config['is_categorical_channel'], value_to_id
+
+
+class TimeseriesEncoder(object):
+    """ Converts timeseries read as strings to float64: numbers for continuous channels, the index of the value for
+    categorical channels and NaN for missing values. The columns and value lookups of header are resolved once.
+    """
+    def __init__(self, header, is_categorical_channel, value_to_id):
+        self.header = list(header)
+        self.categorical_columns = np.array([j for (j, channel) in enumerate(header)
+                                             if is_categorical_channel.get(channel, False)], dtype=np.int64)
+        self.continuous_columns = np.array([j for (j, channel) in enumerate(header)
+                                            if not is_categorical_channel.get(channel, False)], dtype=np.int64)
+        self._value_to_id = [value_to_id[header[j]] for j in self.categorical_columns]
+
+    def encode(self, X, name=None):
+        values = np.full(X.shape, np.nan)
+        continuous = X[:, self.continuous_columns]
+        try:
+            values[:, self.continuous_columns] = np.where(continuous != '', continuous, 'nan').astype(np.float64)
+        except ValueError as e:
+            raise ValueError("Continuous channel of {} is not numeric: {}".format(name, e))
+        for j, lookup in zip(self.categorical_columns, self._value_to_id):
+            column = X[:, j]
+            present = column != ''
+            if not present.any():
+                continue
+            unique_values, inverse = np.unique(column[present], return_inverse=True)
+            try:
+                codes = np.array([lookup[x] for x in unique_values], dtype=np.float64)
+            except KeyError as e:
+                raise ValueError("Unknown value {} of channel {} in {}".format(e, self.header[j], name))
+            values[present, j] = codes[inverse]
+        return values
+
+    def categorical_codes(self, values):
+        """ Integer codes of the categorical channels of encoded values, -1 where the value is missing. """
+        codes = values[:, self.categorical_columns]
+        return np.where(np.isnan(codes), -1, codes).astype(np.int32)
+
+
+def file_signature(path):
+    """ Size and mtime of a file, which change when it is written again. """
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime]
+
+
+class EpisodeCache(object):
+    """ Episode timeseries of a dataset directory compiled into one memory-mapped float64 array.
+
+    The rows of all the episodes are stacked in <cache_dir>/values.bin, <cache_dir>/offsets.npy gives the first row of
+    every episode and <cache_dir>/index.json the episode names, the size and mtime of their files and the header.
+    Continuous channels keep their values, categorical channels hold the index of the value in the possible values of
+    the discretizer config and missing values are NaN.
+
+    Episodes missing from a cache, or whose file changed since it was cached, are appended to values.bin, whose rows
+    already written never change, and the new offsets.npy and index.json replace the old ones, so caches opened before
+    keep reading their episodes. An episode appended again is read from its last rows; remove cache_dir to drop the
+    rows of the older versions.
+    """
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.header = index['header']
+        # one entry per episode appended to values.bin, with the size and mtime of its file then
+        self._entries = index['names']
+        self._signatures = index.get('signatures', [None] * len(self._entries))
+        self._positions = dict((name, i) for (i, name) in enumerate(self._entries))
+        self.names = list(self._positions)
+        self._offsets = np.load(os.path.join(cache_dir, 'offsets.npy'))
+        self._values = np.memmap(os.path.join(cache_dir, 'values.bin'), dtype=np.float64, mode='r',
+                                 shape=(int(self._offsets[-1]), len(self.header)))
+
+    @classmethod
+    def build(cls, dataset_dir, names, cache_dir, config_path=DEFAULT_CONFIG_PATH):
+        """ Compiles the timeseries files names of dataset_dir into the cache in cache_dir, appending to it only the
+        names it does not hold yet or whose file changed. Builders of the same cache_dir run one after the other.
+        """
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, 'build.lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            cls._extend(dataset_dir, names, cache_dir, config_path)
+        return cls(cache_dir)
+
+    @staticmethod
+    def _extend(dataset_dir, names, cache_dir, config_path):
+        if os.path.exists(os.path.join(cache_dir, 'index.json')):
+            # another builder may have added some of the names while this one waited for the lock
+            cache = EpisodeCache(cache_dir)
+            new_names = cache.outdated(dataset_dir, names)
+            header, entries, signatures = cache.header, cache._entries, cache._signatures
+            offsets = list(cache._offsets)
+            del cache
+        else:
+            new_names = list(dict.fromkeys(names))
+            header, entries, signatures, offsets = None, [], [], [0]
+        if not new_names:
+            return
+
+        is_categorical_channel, value_to_id = read_discretizer_config(config_path)
+        encoder = None if header is None else TimeseriesEncoder(header, is_categorical_channel, value_to_id)
+        values_path = os.path.join(cache_dir, 'values.bin')
+        with open(values_path, 'r+b' if os.path.exists(values_path) else 'wb') as values_file:
+            # drop the rows an interrupted build wrote after the last episode of the index, which no mapping covers
+            values_file.truncate(offsets[-1] * 8 * (0 if header is None else len(header)))
+            values_file.seek(0, os.SEEK_END)
+            for name in tqdm(new_names, desc='Caching timeseries of {}'.format(dataset_dir)):
+                # taken before reading, so a file changed while it is read is seen as outdated by the next open
+                signatures.append(file_signature(os.path.join(dataset_dir, name)))
+                ts = pd.read_csv(os.path.join(dataset_dir, name), dtype=str, keep_default_na=False)
+                if header is None:
+                    header = list(ts.columns)
+                    assert header[0] == "Hours"
+                    encoder = TimeseriesEncoder(header, is_categorical_channel, value_to_id)
+                elif list(ts.columns) != header:
+                    raise ValueError("Timeseries {} has another header than {}".format(name, header))
+                values = encoder.encode(ts.values, name)
+                values.tofile(values_file)
+                offsets.append(offsets[-1] + values.shape[0])
+            values_file.flush()
+            os.fsync(values_file.fileno())
+
+        # offsets.npy before index.json: an index read before the swap only names episodes of both offsets
+        offsets_tmp = os.path.join(cache_dir, 'offsets.npy.tmp')
+        with open(offsets_tmp, 'wb') as f:
+            np.save(f, np.array(offsets, dtype=np.int64))
+        os.replace(offsets_tmp, os.path.join(cache_dir, 'offsets.npy'))
+        index_tmp = os.path.join(cache_dir, 'index.json.tmp')
+        with open(index_tmp, 'w') as f:
+            json.dump({'header': header, 'names': entries + new_names, 'signatures': signatures}, f)
+        os.replace(index_tmp, os.path.join(cache_dir, 'index.json'))
+
+    def __getstate__(self):
+        # a pickled cache (e.g. sent to a worker process) maps the files again instead of copying the array
+        state = self.__dict__.copy()
+        state['_values'] = (self._values.filename, self._values.shape)
+        return state
+
+    def __setstate__(self, state):
+        filename, shape = state['_values']
+        state['_values'] = np.memmap(filename, dtype=np.float64, mode='r', shape=shape)
+        self.__dict__.update(state)
+
+    def __contains__(self, name):
+        return name in self._positions
+
+    def outdated(self, dataset_dir, names):
+        """ :return: the names, without repetitions, which the cache does not hold or whose file in dataset_dir
+                 changed since it was cached.
+        """
+        outdated = []
+        for name in dict.fromkeys(names):
+            position = self._positions.get(name)
+            if position is None or self._signatures[position] != file_signature(os.path.join(dataset_dir, name)):
+                outdated.append(name)
+        return outdated
+
+    def read(self, name, time_bound=None):
+        """ Returns the rows of the timeseries name as a read-only view of the cache, cut to the rows whose Hours is at
+        most time_bound (up to 1e-6) if it is given.
+        """
+        position = self._positions[name]
+        start, end = self._offsets[position], self._offsets[position + 1]
+        if time_bound is not None:
+            end = start + np.searchsorted(self._values[start:end, 0], time_bound + 1e-6, side='right')
+        return self._values[start:end]
+
+
+def open_episode_cache(dataset_dir, names, cache_dir, config_path=DEFAULT_CONFIG_PATH):
+    """ Opens the cache of cache_dir, building it first if it does not exist yet or adding the names it misses and
+    those whose file changed since they were cached.
+    """
+    if os.path.exists(os.path.join(cache_dir, 'index.json')):
+        cache = EpisodeCache(cache_dir)
+        if not cache.outdated(dataset_dir, names):
+            return cache
+    return EpisodeCache.build(dataset_dir, names, cache_dir, config_path)
@@ -0,0 +1,230 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+from multiprocessing import Pool
+import numpy as np
+
+
+# bounds (in hours) of the length of stay bins of the kappa score: < 1 day, 1-2 days, ..., 7-8 days, 8-14 days, > 14 days
+LOS_BIN_EDGES = 24.0 * np.array([1, 2, 3, 4, 5, 6, 7, 8, 14])
+N_LOS_BINS = len(LOS_BIN_EDGES) + 1
+
+# number of (replicate, sample, cell) entries counted at once, which bounds the memory of a batch of replicates
+BATCH_ENTRIES = 2 ** 22
+
+worker_scores = None
+
+
+def draw_resamples(random_state, n_samples, n_replicates):
+    """ Draws n_replicates bootstrap resamples of n_samples samples (n_samples draws with replacement, as
+    sklearn.utils.resample) at once.
+
+    :return: (n_replicates, n_samples) array of the indices of the drawn samples.
+    """
+    return random_state.randint(n_samples, size=(n_replicates, n_samples))
+
+
+class CellCounter(object):
+    """ Counts how many drawn samples fall in each of n_cells cells, for many replicates at once with one np.bincount.
+
+    :param sample_cells: (n_samples,) cell of every sample, or (n_samples, k) cells when every sample is counted in k
+                         cells (e.g. once per task).
+    """
+    def __init__(self, sample_cells, n_cells):
+        self._sample_cells = np.asarray(sample_cells, dtype=np.int64)
+        self.n_cells = n_cells
+
+    def __call__(self, draws):
+        n_replicates = draws.shape[0]
+        cells = self._sample_cells[draws].reshape((n_replicates, -1))
+        cells += self.n_cells * np.arange(n_replicates)[:, None]
+        counts = np.bincount(cells.ravel(), minlength=n_replicates * self.n_cells)
+        return counts.reshape((n_replicates, self.n_cells)).astype(np.float64)
+
+
+def binary_cells(y_true, predictions):
+    """ Assigns the samples to the cells binary_curve_scores works on. Only the thresholds (distinct predictions) with
+    a positive sample change the recall, so the curves are followed on these: for the j-th of them (in decreasing
+    order) cell 3j holds the negative samples between it and the previous one, cell 3j+1 the negative samples tied
+    with it and cell 3j+2 its positive samples. Cell 3J holds the negative samples below the last of the J thresholds.
+
+    :return: (cell of every sample, J).
+    """
+    y_true = np.asarray(y_true) > 0.5
+    thresholds = np.unique(-np.asarray(predictions, dtype=np.float64), return_inverse=True)[1].reshape(y_true.shape)
+    positive_thresholds = np.unique(thresholds[y_true])
+    j = np.searchsorted(positive_thresholds, thresholds)
+    tied = np.isin(thresholds, positive_thresholds)
+    return 3 * j + tied + y_true, len(positive_thresholds)
+
+
+def binary_curve_scores(cells):
+    """ AUROC, AUPRC and min(+P, Se) of weighted samples, as computed by roc_auc_score and by the area and the maximum
+    of min(precision, recall) of precision_recall_curve.
+
+    :param cells: (n_replicates, 3J + 1) weights of the cells of binary_cells.
+    :return: dict of (n_replicates,) arrays, NaN for replicates with a single class.
+    """
+    if cells.shape[1] == 1:
+        nan = np.full(cells.shape[0], np.nan)
+        return {'auroc': nan, 'auprc': nan.copy(), 'minpse': nan.copy()}
+    between = cells[:, 0:-1:3]
+    tied = cells[:, 1:-1:3]
+    pos = cells[:, 2:-1:3]
+    tps = np.cumsum(pos, axis=1)
+    fps = np.cumsum(between + tied, axis=1)
+    n_pos = tps[:, -1]
+    n_neg = fps[:, -1] + cells[:, -1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # every positive sample is above the negative samples below its threshold and half above the tied ones
+        auroc = (pos * (n_neg[:, None] - fps + tied / 2.0)).sum(axis=1) / (n_pos * n_neg)
+        recall = tps / n_pos[:, None]
+        # the precision at each threshold and just above it, where the curve was before the recall rose; with nothing
+        # drawn above a threshold the curve starts at (recall 0, precision 1)
+        precision = np.where(tps > 0, tps / (tps + fps), 0.0)
+        tps_above = tps - pos
+        fps_above = fps - tied
+        precision_above = np.where(tps_above + fps_above > 0, tps_above / (tps_above + fps_above), 1.0)
+        auprc = (pos * (precision + precision_above)).sum(axis=1) / (2.0 * n_pos)
+        minpse = np.minimum(precision, recall).max(axis=1, initial=0.0)
+    single_class = (n_pos == 0) | (n_neg == 0)
+    auroc[single_class] = np.nan
+    auprc[single_class] = np.nan
+    minpse[single_class] = np.nan
+    return {'auroc': auroc, 'auprc': auprc, 'minpse': minpse}
+
+
+class BinaryScores(object):
+    """ The auroc, auprc and minpse of print_metrics_binary for many bootstrap replicates at once. """
+    def __init__(self, y_true, predictions):
+        self.n_samples = len(y_true)
+        sample_cells, n_thresholds = binary_cells(y_true, predictions)
+        self._cells = CellCounter(sample_cells, 3 * n_thresholds + 1)
+        self.n_entries = self.n_samples
+
+    def __call__(self, draws):
+        return binary_curve_scores(self._cells(draws))
+
+
+class MultilabelScores(object):
+    """ The auc_scores, ave_auc_micro, ave_auc_macro and ave_auc_weighted of print_metrics_multilabel for many bootstrap
+    replicates at once. Every sample is counted in the cells of each task and in those of the micro average, which
+    treats all the (sample, task) pairs as one binary task, with a single counter.
+    """
+    def __init__(self, y_true, predictions):
+        y_true = np.asarray(y_true)
+        predictions = np.asarray(predictions, dtype=np.float64)
+        self.n_samples, n_tasks = y_true.shape
+
+        sample_cells = []
+        self._tasks = []
+        offset = 0
+        for task in range(n_tasks + 1):
+            if task < n_tasks:
+                cells, n_thresholds = binary_cells(y_true[:, task], predictions[:, task])
+                cells = cells[:, None]
+            else:
+                cells, n_thresholds = binary_cells(y_true, predictions)
+            sample_cells.append(offset + cells)
+            self._tasks.append(slice(offset, offset + 3 * n_thresholds + 1))
+            offset += 3 * n_thresholds + 1
+        self._cells = CellCounter(np.concatenate(sample_cells, axis=1), offset)
+        self.n_entries = self.n_samples * 2 * n_tasks
+
+    def __call__(self, draws):
+        cells = self._cells(draws)
+        auc_scores = np.stack([binary_curve_scores(cells[:, task])['auroc'] for task in self._tasks[:-1]], axis=1)
+        supports = np.stack([cells[:, task][:, 2:-1:3].sum(axis=1) for task in self._tasks[:-1]], axis=1)
+        return {'auc_scores': auc_scores,
+                'ave_auc_micro': binary_curve_scores(cells[:, self._tasks[-1]])['auroc'],
+                'ave_auc_macro': auc_scores.mean(axis=1),
+                'ave_auc_weighted': (auc_scores * supports).sum(axis=1) / supports.sum(axis=1)}
+
+
+def linear_kappa(confusion):
+    """ cohen_kappa_score(..., weights='linear') of (n_replicates, n_bins, n_bins) weighted confusion matrices. As in
+    sklearn the weights are the distances between the positions of the bins among the bins that occur in a replicate.
+    """
+    true_sums = confusion.sum(axis=2)
+    pred_sums = confusion.sum(axis=1)
+    ranks = np.cumsum((true_sums + pred_sums) > 0, axis=1)
+    weights = np.abs(ranks[:, :, None] - ranks[:, None, :])
+    expected = true_sums[:, :, None] * pred_sums[:, None, :] / confusion.sum(axis=(1, 2))[:, None, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return 1.0 - (weights * confusion).sum(axis=(1, 2)) / (weights * expected).sum(axis=(1, 2))
+
+
+class RegressionScores(object):
+    """ The kappa, mad, mse and mape of print_metrics_regression for many bootstrap replicates at once. Negative
+    predictions are clipped to 0 and the kappa is computed on the length of stay bins of LOS_BIN_EDGES.
+    """
+    def __init__(self, y_true, predictions):
+        y_true = np.asarray(y_true, dtype=np.float64)
+        predictions = np.maximum(np.asarray(predictions, dtype=np.float64), 0)
+        self.n_samples = len(y_true)
+        errors = y_true - predictions
+        self._errors = np.stack([np.abs(errors), errors ** 2, np.abs(errors / (y_true + 0.1)) * 100], axis=1)
+        true_bins = np.searchsorted(LOS_BIN_EDGES, y_true, side='right')
+        prediction_bins = np.searchsorted(LOS_BIN_EDGES, predictions, side='right')
+        self._cells = CellCounter(true_bins * N_LOS_BINS + prediction_bins, N_LOS_BINS * N_LOS_BINS)
+        self.n_entries = self.n_samples * 4
+
+    def __call__(self, draws):
+        mad, mse, mape = self._errors[draws].mean(axis=1).T
+        confusion = self._cells(draws).reshape((draws.shape[0], N_LOS_BINS, N_LOS_BINS))
+        return {'kappa': linear_kappa(confusion), 'mad': mad, 'mse': mse, 'mape': mape}
+
+
+def score_batch(scores, batch, batch_size, seed):
+    random_state = np.random.RandomState(None if seed is None else [seed, batch])
+    return scores(draw_resamples(random_state, scores.n_samples, batch_size))
+
+
+def init_bootstrap_worker(scores):
+    global worker_scores
+    worker_scores = scores
+
+
+def score_batch_in_worker(args):
+    return score_batch(worker_scores, *args)
+
+
+def evaluate(scores, n_iters, seed=None, workers=1):
+    """ Computes the scores of all the samples and of n_iters bootstrap resamples of them.
+
+    The replicates are drawn and scored in batches, each batch with its own random state derived from seed, so with a
+    seed the runs do not depend on the number of workers. Batches are spread over a pool of worker processes when
+    workers > 1.
+
+    :param scores: BinaryScores, MultilabelScores or RegressionScores of the samples.
+    :return: (value, runs) where value maps every metric to its value on the samples and runs maps every metric to its
+             (n_iters, ...) array of values on the resamples.
+    """
+    value = dict((k, v[0]) for (k, v) in scores(np.arange(scores.n_samples)[None, :]).items())
+
+    batch_size = max(1, min(n_iters, BATCH_ENTRIES // max(scores.n_entries, 1)))
+    batches = [(batch, min(batch_size, n_iters - start), seed)
+               for (batch, start) in enumerate(range(0, n_iters, batch_size))]
+    if workers > 1:
+        pool = Pool(workers, initializer=init_bootstrap_worker, initargs=(scores,))
+        try:
+            results = pool.map(score_batch_in_worker, batches)
+        finally:
+            pool.terminate()
+    else:
+        results = [score_batch(scores, *args) for args in batches]
+
+    runs = dict((k, np.concatenate([result[k] for result in results])) for k in value)
+    return value, runs
+
+
+def summarize(value, runs):
+    """ :return: the dict stored for a metric in the results file. The resamples on which the metric is undefined (NaN,
+             e.g. an AUC of a resample with a single class) are left out of the statistics of the runs.
+    """
+    return {'value': float(value),
+            'mean': float(np.nanmean(runs)),
+            'median': float(np.nanmedian(runs)),
+            'std': float(np.nanstd(runs)),
+            '2.5% percentile': float(np.nanpercentile(runs, 2.5)),
+            '97.5% percentile': float(np.nanpercentile(runs, 97.5))}
@@ -1,8 +1,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from mimic3models.metrics import print_metrics_regression
-import sklearn.utils as sk_utils
+from mimic3benchmark.evaluation.bootstrap import RegressionScores, evaluate, summarize
 import numpy as np
 import pandas as pd
 import argparse
@@ -17,6 +16,10 @@ def main():
                         default=os.path.join(os.path.dirname(__file__), '../../data/length-of-stay/test/listfile.csv'))
     parser.add_argument('--n_iters', type=int, default=1000)
     parser.add_argument('--save_file', type=str, default='los_results.json')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the bootstrap resamples, the resamples differ from run to run without it.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes scoring batches of bootstrap resamples.')
     args = parser.parse_args()
 
     pred_df = pd.read_csv(args.prediction, index_col=False, dtype={'period_length': np.float32,
@@ -38,28 +41,13 @@ def main():
     data[:, 0] = np.array(df['prediction'])
     data[:, 1] = np.array(df['y_true_l'])
 
+    value, runs = evaluate(RegressionScores(data[:, 1], data[:, 0]), args.n_iters,
+                           seed=args.seed, workers=args.workers)
+
     results = dict()
     results['n_iters'] = args.n_iters
-    ret = print_metrics_regression(data[:, 1], data[:, 0], verbose=0)
-    for (m, k) in metrics:
-        results[m] = dict()
-        results[m]['value'] = ret[k]
-        results[m]['runs'] = []
-
-    for i in range(args.n_iters):
-        cur_data = sk_utils.resample(data, n_samples=len(data))
-        ret = print_metrics_regression(cur_data[:, 1], cur_data[:, 0], verbose=0)
-        for (m, k) in metrics:
-            results[m]['runs'].append(ret[k])
-
     for (m, k) in metrics:
-        runs = results[m]['runs']
-        results[m]['mean'] = np.mean(runs)
-        results[m]['median'] = np.median(runs)
-        results[m]['std'] = np.std(runs)
-        results[m]['2.5% percentile'] = np.percentile(runs, 2.5)
-        results[m]['97.5% percentile'] = np.percentile(runs, 97.5)
-        del results[m]['runs']
+        results[m] = summarize(value[k], runs[k])
 
     print("Saving the results in {} ...".format(args.save_file))
     with open(args.save_file, 'w') as f:
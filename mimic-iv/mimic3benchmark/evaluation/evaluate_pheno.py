@@ -1,8 +1,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from mimic3models.metrics import print_metrics_multilabel, print_metrics_binary
-import sklearn.utils as sk_utils
+from mimic3benchmark.evaluation.bootstrap import MultilabelScores, evaluate, summarize
 import numpy as np
 import pandas as pd
 import argparse
@@ -17,6 +16,10 @@ def main():
                         default=os.path.join(os.path.dirname(__file__), '../../data/phenotyping/test/listfile.csv'))
     parser.add_argument('--n_iters', type=int, default=10000)
     parser.add_argument('--save_file', type=str, default='pheno_results.json')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Seed of the bootstrap resamples, the resamples differ from run to run without it.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes scoring batches of bootstrap resamples.')
     args = parser.parse_args()
 
     pred_df = pd.read_csv(args.prediction, index_col=False, dtype={'period_length': np.float32})
@@ -41,41 +44,17 @@ def main():
         data[:, i - 1] = df['pred_{}'.format(i)]
         data[:, 25 + i - 1] = df['label_{}_l'.format(i)]
 
+    value, runs = evaluate(MultilabelScores(data[:, 25:], data[:, :25]), args.n_iters,
+                           seed=args.seed, workers=args.workers)
+
     results = dict()
     results['n_iters'] = args.n_iters
-    ret = print_metrics_multilabel(data[:, 25:], data[:, :25], verbose=0)
     for (m, k) in metrics:
-        results[m] = dict()
-        results[m]['value'] = ret[k]
-        results[m]['runs'] = []
+        results[m] = summarize(value[k], runs[k])
 
     for i in range(1, n_tasks + 1):
         m = 'ROC AUC of task {}'.format(i)
-        results[m] = dict()
-        results[m]['value'] = print_metrics_binary(data[:, 25 + i - 1], data[:, i - 1], verbose=0)['auroc']
-        results[m]['runs'] = []
-
-    for iteration in range(args.n_iters):
-        cur_data = sk_utils.resample(data, n_samples=len(data))
-        ret = print_metrics_multilabel(cur_data[:, 25:], cur_data[:, :25], verbose=0)
-        for (m, k) in metrics:
-            results[m]['runs'].append(ret[k])
-        for i in range(1, n_tasks + 1):
-            m = 'ROC AUC of task {}'.format(i)
-            cur_auc = print_metrics_binary(cur_data[:, 25 + i - 1], cur_data[:, i - 1], verbose=0)['auroc']
-            results[m]['runs'].append(cur_auc)
-
-    reported_metrics = [m for m, k in metrics]
-    reported_metrics += ['ROC AUC of task {}'.format(i) for i in range(1, n_tasks + 1)]
-
-    for m in reported_metrics:
-        runs = results[m]['runs']
-        results[m]['mean'] = np.mean(runs)
-        results[m]['median'] = np.median(runs)
-        results[m]['std'] = np.std(runs)
-        results[m]['2.5% percentile'] = np.percentile(runs, 2.5)
-        results[m]['97.5% percentile'] = np.percentile(runs, 97.5)
-        del results[m]['runs']
+        results[m] = summarize(value['auc_scores'][i - 1], runs['auc_scores'][:, i - 1])
 
     print("Saving the results (including task specific metrics) in {} ...".format(args.save_file))
     with open(args.save_file, 'w') as f:
@@ -5,38 +5,53 @@ import csv
 import numpy as np
 import os
 import pandas as pd
+from collections import OrderedDict
 from tqdm import tqdm
 
-from mimic3benchmark.util import dataframe_from_csv
+from mimic3benchmark.util import dataframe_from_csv, write_partitions
 
 
-def read_patients_table(path):
-    pats = pd.read_csv(path) # dataframe_from_csv(path)  
-    columns = ['subject_id', 'gender', 'anchor_age', 'dod']  
-    pats = pats[columns]
+# paths of the event tables in the MIMIC-IV directory
+EVENTS_CSV_FILES = {'chartevents': 'icu/chartevents.csv', 'labevents': 'hosp/labevents.csv',
+                    'outputevents': 'icu/outputevents.csv'}
 
-    # pats = pats[columns]
-    pats.dod = pd.to_datetime(pats.dod)
-    return pats
+# formats of the times and of the dates of the MIMIC-IV tables
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+DATE_FORMAT = '%Y-%m-%d'
 
 
-def read_admissions_table(path):
+def parse_times(values, time_format=TIME_FORMAT):
+    """ pd.to_datetime of values with their known format, parsing every distinct time once. Tables whose times are
+    in another format are parsed as pd.to_datetime would without one.
+    """
+    try:
+        return pd.to_datetime(values, format=time_format, cache=True)
+    except ValueError:
+        return pd.to_datetime(values, cache=True)
+
+
+def read_table_columns(path, columns, time_formats):
+    """ Reads only the columns of a table, with the time columns of time_formats parsed by parse_times. """
+    table = pd.read_csv(path, usecols=columns, dtype=dict((c, str) for c in time_formats))[columns]
+    for column, time_format in time_formats.items():
+        table[column] = parse_times(table[column], time_format)
+    return table
+
+
+def read_patients_table(path):
+    return read_table_columns(path, ['subject_id', 'gender', 'anchor_age', 'dod'], {'dod': DATE_FORMAT})
+
 
-    # admits = dataframe_from_csv(path)
-    admits = pd.read_csv(path) #header=header, index_col=index_col
-    admits = admits[['subject_id', 'hadm_id', 'admittime', 'dischtime', 'deathtime']] # missing DIAGNOSIS
-    admits.admittime = pd.to_datetime(admits.admittime)
-    admits.dischtime = pd.to_datetime(admits.dischtime)
-    admits.deathtime = pd.to_datetime(admits.deathtime)
-    return admits
+def read_admissions_table(path):
+    # missing DIAGNOSIS
+    return read_table_columns(path, ['subject_id', 'hadm_id', 'admittime', 'dischtime', 'deathtime'],
+                              {'admittime': TIME_FORMAT, 'dischtime': TIME_FORMAT, 'deathtime': TIME_FORMAT})
 
 
 def read_icustays_table(path):
-    stays = pd.read_csv(path)#dataframe_from_csv(os.path.join(mimic3_path, 'ICUSTAYS.csv'))
-    
-    stays.intime = pd.to_datetime(stays.intime)
-    stays.outtime = pd.to_datetime(stays.outtime)
-    return stays
+    return read_table_columns(path, ['subject_id', 'hadm_id', 'stay_id', 'first_careunit', 'last_careunit', 'intime',
+                                     'outtime', 'los'],
+                              {'intime': TIME_FORMAT, 'outtime': TIME_FORMAT})
 
 
 def read_icd_diagnoses_table(path):
@@ -52,9 +67,8 @@ def read_icd_diagnoses_table(path):
 
 def read_events_table_by_row(mimic3_path, table):
     nb_rows = {'chartevents': 329499788, 'labevents': 122103667, 'outputevents': 4457381}
-    csv_files = {'chartevents': 'icu/chartevents.csv', 'labevents': 'hosp/labevents.csv', 'outputevents': 'icu/outputevents.csv'}
     # nb_rows = {'chartevents': 330712484, 'labevents': 27854056, 'outputevents': 4349219}
-    reader = csv.DictReader(open(os.path.join(mimic3_path, csv_files[table.lower()]), 'r'))
+    reader = csv.DictReader(open(os.path.join(mimic3_path, EVENTS_CSV_FILES[table.lower()]), 'r'))
     for i, row in enumerate(reader):
         if 'stay_id' not in row:
             row['stay_id'] = ''
@@ -137,36 +151,18 @@ def filter_diagnoses_on_stays(diagnoses, stays):
                            left_on=['subject_id', 'hadm_id'], right_on=['subject_id', 'hadm_id'])
 
 
-def break_up_stays_by_subject(stays, output_path, subjects=None):
-    subjects = stays.subject_id.unique() if subjects is None else subjects
-    nb_subjects = subjects.shape[0]
-    for subject_id in tqdm(subjects, total=nb_subjects, desc='Breaking up stays by subjects'):
-        dn = os.path.join(output_path, str(subject_id))
-        try:
-            os.makedirs(dn)
-        except:
-            pass
-
-        stays[stays.subject_id == subject_id].sort_values(by='intime').to_csv(os.path.join(dn, 'stays.csv'),
-                                                                              index=False)
-
+def break_up_stays_by_subject(stays, output_path, subjects=None, workers=1):
+    write_partitions(stays, 'subject_id', output_path, 'stays.csv', keys=subjects, sort_by='intime', workers=workers,
+                     desc='Breaking up stays by subjects')
 
-def break_up_diagnoses_by_subject(diagnoses, output_path, subjects=None):
-    subjects = diagnoses.subject_id.unique() if subjects is None else subjects
-    nb_subjects = subjects.shape[0]
-    for subject_id in tqdm(subjects, total=nb_subjects, desc='Breaking up diagnoses by subjects'):
-        dn = os.path.join(output_path, str(subject_id))
-        try:
-            os.makedirs(dn)
-        except:
-            pass
 
-        diagnoses[diagnoses.subject_id == subject_id].sort_values(by=['stay_id', 'seq_num'])\
-                                                     .to_csv(os.path.join(dn, 'diagnoses.csv'), index=False)
+def break_up_diagnoses_by_subject(diagnoses, output_path, subjects=None, workers=1):
+    write_partitions(diagnoses, 'subject_id', output_path, 'diagnoses.csv', keys=subjects, sort_by=['stay_id', 'seq_num'],
+                     workers=workers, desc='Breaking up diagnoses by subjects')
 
 
 def read_events_table_and_break_up_by_subject(mimic3_path, table, output_path,
-                                              items_to_keep=None, subjects_to_keep=None):
+                                              items_to_keep=None, subjects_to_keep=None, file_name='events.csv'):
     obs_header = ['subject_id', 'hadm_id', 'stay_id', 'charttime', 'itemid', 'value', 'valuenum']
     if items_to_keep is not None:
         items_to_keep = set([str(s) for s in items_to_keep])
@@ -186,13 +182,14 @@ def read_events_table_and_break_up_by_subject(mimic3_path, table, output_path,
             os.makedirs(dn)
         except:
             pass
-        fn = os.path.join(dn, 'events.csv')
+        fn = os.path.join(dn, file_name)
         if not os.path.exists(fn) or not os.path.isfile(fn):
             f = open(fn, 'w')
             f.write(','.join(obs_header) + '\n')
             f.close()
-        w = csv.DictWriter(open(fn, 'a'), fieldnames=obs_header, quoting=csv.QUOTE_MINIMAL)
-        w.writerows(data_stats.curr_obs)
+        with open(fn, 'a') as f:
+            w = csv.DictWriter(f, fieldnames=obs_header, quoting=csv.QUOTE_MINIMAL)
+            w.writerows(data_stats.curr_obs)
         data_stats.curr_obs = []
 
     # nb_rows_dict = {'chartevents': 330712484, 'labevents': 27854056, 'outputevents': 4349219}
@@ -225,3 +222,104 @@ def read_events_table_and_break_up_by_subject(mimic3_path, table, output_path,
 
     if data_stats.curr_subject_id != '':
         write_current_observations()
+
+
+class SubjectEventsFiles(object):
+    """ Appends rows to per-subject file_name files, keeping at most max_open_files of them open.
+
+    The least recently used file is closed when the limit is reached. A file gets the header when it is created.
+    """
+    def __init__(self, output_path, header, max_open_files=256, file_name='events.csv'):
+        self._output_path = output_path
+        self._header = header
+        self._max_open_files = max_open_files
+        self._file_name = file_name
+        self._files = OrderedDict()
+
+    def writer(self, subject_id):
+        if subject_id in self._files:
+            self._files.move_to_end(subject_id)
+            return self._files[subject_id][1]
+        if len(self._files) >= self._max_open_files:
+            _, (f, _) = self._files.popitem(last=False)
+            f.close()
+        dn = os.path.join(self._output_path, str(subject_id))
+        os.makedirs(dn, exist_ok=True)
+        fn = os.path.join(dn, self._file_name)
+        is_new = not os.path.isfile(fn)
+        f = open(fn, 'a')
+        if is_new:
+            f.write(','.join(self._header) + '\n')
+        w = csv.writer(f, quoting=csv.QUOTE_MINIMAL)
+        self._files[subject_id] = (f, w)
+        return w
+
+    def close(self):
+        for f, _ in self._files.values():
+            f.close()
+        self._files.clear()
+
+
+def read_events_table_in_chunks(mimic3_path, table, items_to_keep=None, subjects_to_keep=None, chunksize=1000000):
+    """ Reads an event table with pandas in chunks and yields the rows kept, with the columns of the per-subject
+    events.csv files. All fields are kept as the strings found in the csv file.
+    """
+    obs_header = ['subject_id', 'hadm_id', 'stay_id', 'charttime', 'itemid', 'value', 'valuenum']
+    read_columns = obs_header + ['valueuom']
+    if items_to_keep is not None:
+        items_to_keep = set([str(s) for s in items_to_keep])
+    if subjects_to_keep is not None:
+        subjects_to_keep = set([str(s) for s in subjects_to_keep])
+
+    nb_rows_dict = {'chartevents': 329499788, 'labevents': 122103667, 'outputevents': 4457381}
+    nb_rows = nb_rows_dict[table.lower()]
+
+    reader = pd.read_csv(os.path.join(mimic3_path, EVENTS_CSV_FILES[table.lower()]), usecols=lambda c: c in read_columns,
+                         dtype=str, keep_default_na=False, na_filter=False, chunksize=chunksize)
+    with tqdm(total=nb_rows, desc='Processing {} table'.format(table)) as pbar:
+        for chunk in reader:
+            pbar.update(chunk.shape[0])
+            if subjects_to_keep is not None:
+                chunk = chunk[chunk.subject_id.isin(subjects_to_keep)]
+            if items_to_keep is not None:
+                chunk = chunk[chunk.itemid.isin(items_to_keep)]
+            if 'stay_id' not in chunk:
+                chunk = chunk.assign(stay_id='')
+            if table == 'OUTPUTEVENTS':
+                chunk = chunk.assign(valuenum=chunk.valueuom)
+            yield chunk[obs_header]
+
+
+def read_events_table_in_chunks_and_break_up_by_subject(mimic3_path, table, output_path, items_to_keep=None,
+                                                        subjects_to_keep=None, chunksize=1000000, max_open_files=256,
+                                                        file_name='events.csv'):
+    """ Same output as read_events_table_and_break_up_by_subject, but the table is read with pandas in chunks.
+
+    Rows are filtered with isin and each chunk is written subject by subject, in the order of the table.
+    """
+    obs_header = ['subject_id', 'hadm_id', 'stay_id', 'charttime', 'itemid', 'value', 'valuenum']
+    files = SubjectEventsFiles(output_path, obs_header, max_open_files=max_open_files, file_name=file_name)
+    for chunk in read_events_table_in_chunks(mimic3_path, table, items_to_keep=items_to_keep,
+                                             subjects_to_keep=subjects_to_keep, chunksize=chunksize):
+        for subject_id, rows in chunk.groupby('subject_id', sort=False):
+            files.writer(subject_id).writerows(rows.values.tolist())
+    files.close()
+
+
+def write_stays_to_store(stays, store, subjects=None):
+    subjects = stays.subject_id.unique() if subjects is None else subjects
+    store.append('stays', stays[stays.subject_id.isin(subjects)].sort_values(by='intime'))
+
+
+def write_diagnoses_to_store(diagnoses, store, subjects=None):
+    subjects = diagnoses.subject_id.unique() if subjects is None else subjects
+    store.append('diagnoses', diagnoses[diagnoses.subject_id.isin(subjects)].sort_values(by=['stay_id', 'seq_num']))
+
+
+def read_events_table_into_store(mimic3_path, table, store, items_to_keep=None, subjects_to_keep=None,
+                                 chunksize=1000000):
+    """ Appends the events of a table to the Parquet store. Call store.compact('events') once all tables are read. """
+    from mimic3benchmark.parquet_store import EVENTS_SCHEMA, events_chunk_to_store
+    for chunk in read_events_table_in_chunks(mimic3_path, table, items_to_keep=items_to_keep,
+                                             subjects_to_keep=subjects_to_keep, chunksize=chunksize):
+        store.append('events', events_chunk_to_store(chunk), schema=EVENTS_SCHEMA)
@@ -0,0 +1,209 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from mimic3benchmark.checkpoints import PARTIAL_SUFFIX, combine_digests, file_digest, read_json, write_json
+from mimic3benchmark.checkpoints import read_subject_marker, write_subject_marker
+from mimic3benchmark.util import STORE_DIR
+
+
+SUBJECT_COLUMN = 'subject_id'
+
+EVENTS_SCHEMA = pa.schema([('subject_id', pa.int64()),
+                           ('hadm_id', pa.float64()),
+                           ('stay_id', pa.float64()),
+                           ('charttime', pa.timestamp('ns')),
+                           ('itemid', pa.int64()),
+                           ('value', pa.string()),
+                           ('valuenum', pa.string())])
+
+
+class SubjectStore(object):
+    """ Per-subject tables (stays, diagnoses, events) kept in one Parquet dataset per table.
+
+    Rows are bucketed by subject_id % n_buckets and laid out as <root>/parquet/<table>/<bucket>/part-<n>.parquet,
+    so reading one subject opens a single bucket and skips the row groups of other subjects.
+
+    Parts are written under a temporary name starting with '.', which the Parquet reader skips, and renamed once
+    complete. A bucket whose rows are replaced is written whole to the sibling directory .<bucket>.new and swapped with
+    the old one, so an interrupted write never leaves a bucket with a truncated part or with the old and new rows.
+    Opening the store completes or drops the swaps an interruption left halfway.
+    """
+    def __init__(self, subjects_root_path):
+        self._path = os.path.join(subjects_root_path, STORE_DIR)
+        meta = read_json(os.path.join(self._path, 'store.json'))
+        self.n_buckets = meta['n_buckets']
+        self._next_part = meta['next_part']
+        self._recover()
+
+    @classmethod
+    def create(cls, subjects_root_path, n_buckets=256):
+        path = os.path.join(subjects_root_path, STORE_DIR)
+        os.makedirs(path, exist_ok=True)
+        write_json(os.path.join(path, 'store.json'), {'n_buckets': n_buckets, 'next_part': 0})
+        return cls(subjects_root_path)
+
+    def _save_meta(self):
+        write_json(os.path.join(self._path, 'store.json'), {'n_buckets': self.n_buckets, 'next_part': self._next_part})
+
+    def _bucket_path(self, table, bucket):
+        return os.path.join(self._path, table, '{:05d}'.format(bucket))
+
+    def _recover(self):
+        for table in os.listdir(self._path):
+            table_path = os.path.join(self._path, table)
+            if not os.path.isdir(table_path):
+                continue
+            names = os.listdir(table_path)
+            # a complete .new bucket replaces the bucket moved away to .old, an incomplete one (bucket still in place)
+            # is dropped; then .old is put back if nothing replaced it, dropped otherwise
+            for suffix in ('.new', '.old'):
+                for name in names:
+                    if not (name.startswith('.') and name.endswith(suffix)):
+                        continue
+                    bucket_path = os.path.join(table_path, name[1:-len(suffix)])
+                    if os.path.exists(bucket_path):
+                        shutil.rmtree(os.path.join(table_path, name))
+                    else:
+                        os.rename(os.path.join(table_path, name), bucket_path)
+            # parts whose write was interrupted
+            for bucket in self.buckets(table):
+                dn = self._bucket_path(table, bucket)
+                for name in os.listdir(dn):
+                    if name.endswith(PARTIAL_SUFFIX):
+                        os.remove(os.path.join(dn, name))
+
+    def _write_part(self, table, bucket, arrow_table, dn=None):
+        if dn is None:
+            dn = self._bucket_path(table, bucket)
+        os.makedirs(dn, exist_ok=True)
+        name = 'part-{:08d}.parquet'.format(self._next_part)
+        tmp_path = os.path.join(dn, '.' + name + PARTIAL_SUFFIX)
+        pq.write_table(arrow_table, tmp_path, row_group_size=65536)
+        os.replace(tmp_path, os.path.join(dn, name))
+
+    def _swap_bucket(self, table, bucket, arrow_table):
+        """ Replaces all the parts of a bucket with one part holding arrow_table. """
+        dn = self._bucket_path(table, bucket)
+        new_dn = os.path.join(os.path.dirname(dn), '.' + os.path.basename(dn) + '.new')
+        old_dn = os.path.join(os.path.dirname(dn), '.' + os.path.basename(dn) + '.old')
+        if os.path.isdir(new_dn):
+            shutil.rmtree(new_dn)
+        self._write_part(table, bucket, arrow_table, dn=new_dn)
+        if os.path.isdir(dn):
+            os.rename(dn, old_dn)
+        os.rename(new_dn, dn)
+        if os.path.isdir(old_dn):
+            shutil.rmtree(old_dn)
+
+    def append(self, table, df, schema=None):
+        """ Appends the rows of df to table, one new part file per bucket. Rows keep their order within a subject. """
+        df = df.copy()
+        for column in df.columns[df.dtypes == object]:
+            df[column] = df[column].where(df[column].isnull(), df[column].astype(str))
+        if schema is None:
+            schema = pa.Schema.from_pandas(df, preserve_index=False)
+        buckets = df[SUBJECT_COLUMN].values % self.n_buckets
+        for bucket, rows in df.groupby(buckets, sort=False):
+            self._write_part(table, bucket, pa.Table.from_pandas(rows, schema=schema, preserve_index=False))
+        self._next_part += 1
+        self._save_meta()
+
+    def buckets(self, table):
+        table_path = os.path.join(self._path, table)
+        if not os.path.isdir(table_path):
+            return []
+        return sorted(int(x) for x in os.listdir(table_path) if x.isdigit())
+
+    def read_bucket(self, table, bucket):
+        return pq.read_table(self._bucket_path(table, bucket)).to_pandas()
+
+    def bucket_digest(self, table, bucket):
+        """ Digest of the content of the parts of a bucket, None if it does not exist. """
+        dn = self._bucket_path(table, bucket)
+        if not os.path.isdir(dn):
+            return None
+        return combine_digests([file_digest(os.path.join(dn, name)) for name in sorted(os.listdir(dn))
+                                if name.endswith('.parquet') and not name.startswith('.')])
+
+    def read_bucket_marker(self, table, bucket, stage):
+        """ :return: what write_bucket_marker stored for the bucket after stage, None if nothing is stored. """
+        return read_subject_marker(self._bucket_path(table, bucket), stage)
+
+    def write_bucket_marker(self, table, bucket, stage, marker):
+        """ Records that stage completed for a bucket, as write_subject_marker does for a subject directory. The marker
+        is a file starting with '.', which the Parquet reader skips, and goes away with the bucket when it is replaced.
+        """
+        write_subject_marker(self._bucket_path(table, bucket), stage, marker)
+
+    def replace_bucket(self, table, bucket, df, schema=None):
+        """ Replaces all the rows of a bucket with df. """
+        self._swap_bucket(table, bucket, pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        self._next_part += 1
+        self._save_meta()
+
+    def drop(self, table):
+        """ Removes all the rows of table, e.g. those an interrupted run appended before the table is written again. """
+        table_path = os.path.join(self._path, table)
+        if os.path.isdir(table_path):
+            shutil.rmtree(table_path)
+
+    def compact(self, table):
+        """ Rewrites every bucket of table as a single file sorted by subject_id (stable, so the order of the rows
+        of a subject is kept), which lets readers skip row groups by their subject_id statistics.
+        """
+        for bucket in self.buckets(table):
+            arrow_table = pq.read_table(self._bucket_path(table, bucket))
+            arrow_table = arrow_table.take(pc.sort_indices(arrow_table, sort_keys=[(SUBJECT_COLUMN, 'ascending')]))
+            self._swap_bucket(table, bucket, arrow_table)
+        self._next_part += 1
+        self._save_meta()
+
+    def read(self, table, subject_id):
+        """ Reads the rows of one subject, pushing the subject_id filter down to the Parquet reader. """
+        subject_id = int(subject_id)
+        return pq.read_table(self._bucket_path(table, subject_id % self.n_buckets),
+                             filters=[(SUBJECT_COLUMN, '=', subject_id)]).to_pandas()
+
+    def subjects(self):
+        """ Sorted subject_ids of the stays table. """
+        subject_ids = [pq.read_table(self._bucket_path('stays', bucket), columns=[SUBJECT_COLUMN])[SUBJECT_COLUMN]
+                       .to_numpy() for bucket in self.buckets('stays')]
+        return sorted(set(int(x) for ids in subject_ids for x in ids))
+
+
+def events_chunk_to_store(chunk):
+    """ Converts a chunk of events read as strings (see read_events_table_in_chunks) to the types of EVENTS_SCHEMA. """
+    chunk = chunk.replace('', None)
+    return pd.DataFrame({'subject_id': chunk.subject_id.astype('int64'),
+                         'hadm_id': pd.to_numeric(chunk.hadm_id).astype('float64'),
+                         'stay_id': pd.to_numeric(chunk.stay_id).astype('float64'),
+                         'charttime': pd.to_datetime(chunk.charttime),
+                         'itemid': chunk.itemid.astype('int64'),
+                         'value': chunk.value,
+                         'valuenum': chunk.valuenum})
+
+
+def infer_csv_dtype(column):
+    """ Gives a string column the dtype read_csv would give it: numeric if all its values are numbers. """
+    try:
+        return pd.to_numeric(column)
+    except (ValueError, TypeError):
+        return column
+
+
+_stores = {}
+
+
+def open_store(subjects_root_path):
+    subjects_root_path = os.path.abspath(subjects_root_path)
+    if subjects_root_path not in _stores:
+        _stores[subjects_root_path] = SubjectStore(subjects_root_path)
+    return _stores[subjects_root_path]
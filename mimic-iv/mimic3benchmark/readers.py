@@ -5,20 +5,59 @@ import os
 import numpy as np
 import random
 import glob
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from mimic3benchmark.episode_cache import open_episode_cache, read_discretizer_config, TimeseriesEncoder
+from mimic3benchmark.listfile_index import ListfileIndex, DecompensationListfileIndex, MultitaskListfileIndex
+
+
+# reader of the worker processes of Reader.iterate_batches
+worker_reader = None
+
+
+def init_batch_worker(reader):
+    global worker_reader
+    worker_reader = reader
+
+
+def read_batch_in_worker(indices, pad_value):
+    return worker_reader.read_batch(indices, pad_value)
 
 
 class Reader(object):
-    def __init__(self, dataset_dir, listfile=None):
+    def __init__(self, dataset_dir, listfile=None, index_class=None):
         self._dataset_dir = dataset_dir
         self._current_index = 0
         if listfile is None:
             listfile_path = os.path.join(dataset_dir, "listfile.csv")
         else:
             listfile_path = listfile
-        with open(listfile_path, "r") as lfile:
-            self._data = lfile.readlines()
-        self._listfile_header = self._data[0]
-        self._data = self._data[1:]
+        if index_class is not None:
+            # the rows are memory-mapped from a ListfileIndex instead of being parsed by the subclass
+            self._data = index_class(listfile_path)
+            self._listfile_header = self._data.header
+        else:
+            with open(listfile_path, "r") as lfile:
+                self._data = lfile.readlines()
+            self._listfile_header = self._data[0]
+            self._data = self._data[1:]
+        self._cache = None
+        self._numeric = False
+        self._discretizer_config = None
+        self._encoders = {}
+
+    def _load_cache(self, cache_dir):
+        """ Reads the timeseries from an EpisodeCache in cache_dir, built on first use, instead of the CSV files.
+        X is then a float64 view of the cache, with categorical channels coded by discretizer_config.json.
+        """
+        if cache_dir is not None:
+            if isinstance(self._data, ListfileIndex):
+                names = self._data.names
+            else:
+                names = [x[0] for x in self._data]
+            self._cache = open_episode_cache(self._dataset_dir, names, cache_dir)
 
     def get_number_of_examples(self):
         return len(self._data)
@@ -26,7 +65,10 @@ class Reader(object):
     def random_shuffle(self, seed=None):
         if seed is not None:
             random.seed(seed)
-        random.shuffle(self._data)
+        if isinstance(self._data, ListfileIndex):
+            self._data.shuffle()
+        else:
+            random.shuffle(self._data)
 
     def read_example(self, index):
         raise NotImplementedError()
@@ -38,19 +80,128 @@ class Reader(object):
             self._current_index = 0
         return self.read_example(to_read_index)
 
+    def _get_encoder(self, header):
+        # the channel lookups are built once per header, i.e. once per reader
+        key = tuple(header)
+        if key not in self._encoders:
+            if self._discretizer_config is None:
+                self._discretizer_config = read_discretizer_config()
+            is_categorical_channel, value_to_id = self._discretizer_config
+            self._encoders[key] = TimeseriesEncoder(header, is_categorical_channel, value_to_id)
+        return self._encoders[key]
+
+    def _to_numeric(self, X, header, name):
+        if X.dtype.kind not in ('U', 'S', 'O'):
+            # already numeric when read from an episode cache or by a numeric reader
+            return X
+        return self._get_encoder(header).encode(X, name)
+
+    def _numeric_example(self, example):
+        """ For numeric readers, converts X of the example to float32 and adds the codes of its categorical channels. """
+        if not self._numeric:
+            return example
+        values = self._to_numeric(example["X"], example["header"], example["name"])
+        example["X"] = values.astype(np.float32)
+        example["categorical"] = self._get_encoder(example["header"]).categorical_codes(values)
+        return example
+
+    def read_batch(self, indices, pad_value=0.0):
+        """ Reads the examples with the given indices as one padded batch.
+
+        :param indices: Indices of the lines of the listfile to read.
+        :param pad_value: Value of X after the last row of every example.
+        :return: Dictionary with the keys of read_example, where
+            X : np.array
+                float32 array of shape (number of examples, largest number of rows, number of columns).
+                Categorical channels are coded as in the episode cache and missing values are NaN.
+            lengths : np.array
+                Number of rows of every example.
+            t, y : np.array
+                Stacked values of the examples, when the reader returns them.
+            header : array of strings
+                Names of the columns, shared by all the examples.
+            The other keys hold the list of the values of the examples.
+        """
+        if len(indices) == 0:
+            # the header and the keys of a batch come from its examples
+            raise ValueError("read_batch needs at least one index")
+        examples = [self.read_example(index) for index in indices]
+        header = examples[0]["header"]
+        Xs = [self._to_numeric(example["X"], example["header"], example["name"]) for example in examples]
+        lengths = np.array([X.shape[0] for X in Xs], dtype=np.int64)
+        batch_X = np.full((len(Xs), lengths.max(), len(header)), pad_value, dtype=np.float32)
+        for i, X in enumerate(Xs):
+            batch_X[i, :X.shape[0]] = X
+
+        batch = {"X": batch_X, "lengths": lengths, "header": header}
+        for key in examples[0]:
+            if key in batch:
+                continue
+            values = [example[key] for example in examples]
+            batch[key] = np.array(values) if key in ("t", "y") else values
+        return batch
+
+    def iterate_batches(self, batch_size, epoch=0, seed=None, prefetch=2, workers=1, processes=False,
+                        drop_last=False, pad_value=0.0):
+        """ Yields the batches (see read_batch) of one epoch, read ahead by worker threads or processes.
+
+        :param epoch:     Number of the epoch, which selects the order of the examples when seed is given.
+        :param seed:      If given, the examples are shuffled with a permutation depending only on seed and epoch, so
+                          the order changes from epoch to epoch but is the same in every run. Otherwise the examples
+                          are read in the order of the listfile (which random_shuffle may have shuffled).
+        :param prefetch:  Number of batches read ahead of the one being consumed.
+        :param workers:   Number of threads (or processes) reading batches.
+        :param processes: Read in worker processes instead of threads. The reader is sent to every process.
+        :param drop_last: Skip the last batch if it has less than batch_size examples.
+        """
+        n = self.get_number_of_examples()
+        if seed is None:
+            order = np.arange(n)
+        else:
+            order = np.random.RandomState([seed, epoch]).permutation(n)
+        batches = [order[i:i + batch_size] for i in range(0, n, batch_size)]
+        if drop_last and len(batches) > 0 and len(batches[-1]) < batch_size:
+            batches = batches[:-1]
+
+        if processes:
+            pool = Pool(workers, initializer=init_batch_worker, initargs=(self,))
+            read = read_batch_in_worker
+        else:
+            pool = ThreadPool(workers)
+            read = self.read_batch
+        with pool:
+            pending = deque()
+            for indices in batches:
+                pending.append(pool.apply_async(read, (indices, pad_value)))
+                if len(pending) > prefetch:
+                    yield pending.popleft().get()
+            while len(pending) > 0:
+                yield pending.popleft().get()
+
 
 class DecompensationReader(Reader):
-    def __init__(self, dataset_dir, listfile=None):
+    def __init__(self, dataset_dir, listfile=None, cache_dir=None, numeric=False, listfile_index=False):
         """ Reader for decompensation prediction task.
         :param dataset_dir: Directory where timeseries files are stored.
         :param listfile:    Path to a listfile. If this parameter is left `None` then
                             `dataset_dir/listfile.csv` will be used.
+        :param cache_dir:   Directory of an EpisodeCache of the timeseries. If it is given, X is read from the cache
+                            as float64 (see Reader._load_cache).
+        :param numeric:     If True, X is float32 with categorical channels coded by discretizer_config.json and
+                            the example has a "categorical" key with the integer codes of these channels.
+        :param listfile_index: If True, the listfile rows are memory-mapped from a ListfileIndex built next to the
+                               listfile on first use instead of being parsed at every start.
         """
-        Reader.__init__(self, dataset_dir, listfile)
-        self._data = [line.split(',') for line in self._data]
-        self._data = [(x, float(t), int(y)) for (x, t, stay_id, y) in self._data]
+        Reader.__init__(self, dataset_dir, listfile, DecompensationListfileIndex if listfile_index else None)
+        if not listfile_index:
+            self._data = [line.split(',') for line in self._data]
+            self._data = [(x, float(t), int(y)) for (x, t, stay_id, y) in self._data]
+        self._load_cache(cache_dir)
+        self._numeric = numeric
 
     def _read_timeseries(self, ts_filename, time_bound):
+        if self._cache is not None:
+            return (self._cache.read(ts_filename, time_bound), list(self._cache.header))
         ret = []
         with open(os.path.join(self._dataset_dir, ts_filename), "r") as tsfile:
             header = tsfile.readline().strip().split(',')
@@ -89,28 +240,36 @@ class DecompensationReader(Reader):
         y = self._data[index][2]
         (X, header) = self._read_timeseries(name, t)
 
-        return {"X": X,
-                "t": t,
-                "y": y,
-                "header": header,
-                "name": name}
+        return self._numeric_example({"X": X,
+                                      "t": t,
+                                      "y": y,
+                                      "header": header,
+                                      "name": name})
 
 
 class InHospitalMortalityReader(Reader):
-    def __init__(self, dataset_dir, listfile=None, period_length=48.0):
+    def __init__(self, dataset_dir, listfile=None, period_length=48.0, cache_dir=None, numeric=False):
         """ Reader for in-hospital moratality prediction task.
 
         :param dataset_dir:   Directory where timeseries files are stored.
         :param listfile:      Path to a listfile. If this parameter is left `None` then
                               `dataset_dir/listfile.csv` will be used.
         :param period_length: Length of the period (in hours) from which the prediction is done.
+        :param cache_dir:     Directory of an EpisodeCache of the timeseries. If it is given, X is read from the cache
+                              as float64 (see Reader._load_cache).
+        :param numeric:       If True, X is float32 with categorical channels coded by discretizer_config.json and
+                              the example has a "categorical" key with the integer codes of these channels.
         """
         Reader.__init__(self, dataset_dir, listfile)
         self._data = [line.split(',') for line in self._data]
         self._data = [(x, int(y)) for (x, y) in self._data]
         self._period_length = period_length
+        self._load_cache(cache_dir)
+        self._numeric = numeric
 
     def _read_timeseries(self, ts_filename):
+        if self._cache is not None:
+            return (self._cache.read(ts_filename), list(self._cache.header))
         ret = []
         with open(os.path.join(self._dataset_dir, ts_filename), "r") as tsfile:
             header = tsfile.readline().strip().split(',')
@@ -146,26 +305,34 @@ class InHospitalMortalityReader(Reader):
         y = self._data[index][1]
         (X, header) = self._read_timeseries(name)
 
-        return {"X": X,
-                "t": t,
-                "y": y,
-                "header": header,
-                "name": name}
+        return self._numeric_example({"X": X,
+                                      "t": t,
+                                      "y": y,
+                                      "header": header,
+                                      "name": name})
 
 
 class LengthOfStayReader(Reader):
-    def __init__(self, dataset_dir, listfile=None):
+    def __init__(self, dataset_dir, listfile=None, cache_dir=None, numeric=False):
         """ Reader for length of stay prediction task.
 
         :param dataset_dir: Directory where timeseries files are stored.
         :param listfile:    Path to a listfile. If this parameter is left `None` then
                             `dataset_dir/listfile.csv` will be used.
+        :param cache_dir:   Directory of an EpisodeCache of the timeseries. If it is given, X is read from the cache
+                            as float64 (see Reader._load_cache).
+        :param numeric:     If True, X is float32 with categorical channels coded by discretizer_config.json and
+                            the example has a "categorical" key with the integer codes of these channels.
         """
         Reader.__init__(self, dataset_dir, listfile)
         self._data = [line.split(',') for line in self._data]
         self._data = [(x, float(t), float(y)) for (x, t, y) in self._data]
+        self._load_cache(cache_dir)
+        self._numeric = numeric
 
     def _read_timeseries(self, ts_filename, time_bound):
+        if self._cache is not None:
+            return (self._cache.read(ts_filename, time_bound), list(self._cache.header))
         ret = []
         with open(os.path.join(self._dataset_dir, ts_filename), "r") as tsfile:
             header = tsfile.readline().strip().split(',')
@@ -204,20 +371,24 @@ class LengthOfStayReader(Reader):
         y = self._data[index][2]
         (X, header) = self._read_timeseries(name, t)
 
-        return {"X": X,
-                "t": t,
-                "y": y,
-                "header": header,
-                "name": name}
+        return self._numeric_example({"X": X,
+                                      "t": t,
+                                      "y": y,
+                                      "header": header,
+                                      "name": name})
 
 
 class PhenotypingReader(Reader):
-    def __init__(self, dataset_dir, listfile=None):
+    def __init__(self, dataset_dir, listfile=None, cache_dir=None, numeric=False):
         """ Reader for phenotype classification task.
 
         :param dataset_dir: Directory where timeseries files are stored.
         :param listfile:    Path to a listfile. If this parameter is left `None` then
                             `dataset_dir/listfile.csv` will be used.
+        :param cache_dir:   Directory of an EpisodeCache of the timeseries. If it is given, X is read from the cache
+                            as float64 (see Reader._load_cache).
+        :param numeric:     If True, X is float32 with categorical channels coded by discretizer_config.json and
+                            the example has a "categorical" key with the integer codes of these channels.
         """
         Reader.__init__(self, dataset_dir, listfile)
         self._data = [line.split(',') for line in self._data]
@@ -231,8 +402,12 @@ class PhenotypingReader(Reader):
         }
 
         self._data = [(mas[0], float(mas[1]), list(map(int, mas[3:]))) for mas in self._data]
+        self._load_cache(cache_dir)
+        self._numeric = numeric
 
     def _read_timeseries(self, ts_filename):
+        if self._cache is not None:
+            return (self._cache.read(ts_filename), list(self._cache.header))
         ret = []
         with open(os.path.join(self._dataset_dir, ts_filename), "r") as tsfile:
             header = tsfile.readline().strip().split(',')
@@ -255,12 +430,12 @@ class PhenotypingReader(Reader):
         # y = self._data[index][2] 
         (X, header) = self._read_timeseries(index)
 
-        return {"X": X,
-                "t": t,
-                "y": y,
-                'stay_id': stay_id,
-                "header": header,
-                "name": index}
+        return self._numeric_example({"X": X,
+                                      "t": t,
+                                      "y": y,
+                                      'stay_id': stay_id,
+                                      "header": header,
+                                      "name": index})
 
     def read_example(self, index):
         """ Reads the example with given index.
@@ -288,47 +463,58 @@ class PhenotypingReader(Reader):
         y = self._data[index][2]
         (X, header) = self._read_timeseries(name)
 
-        return {"X": X,
-                "t": t,
-                "y": y,
-                "header": header,
-                "name": name}
+        return self._numeric_example({"X": X,
+                                      "t": t,
+                                      "y": y,
+                                      "header": header,
+                                      "name": name})
 
 
 class MultitaskReader(Reader):
-    def __init__(self, dataset_dir, listfile=None):
+    def __init__(self, dataset_dir, listfile=None, cache_dir=None, numeric=False, listfile_index=False):
         """ Reader for multitask learning.
 
         :param dataset_dir: Directory where timeseries files are stored.
         :param listfile:    Path to a listfile. If this parameter is left `None` then
                             `dataset_dir/listfile.csv` will be used.
+        :param cache_dir:   Directory of an EpisodeCache of the timeseries. If it is given, X is read from the cache
+                            as float64 (see Reader._load_cache).
+        :param numeric:     If True, X is float32 with categorical channels coded by discretizer_config.json and
+                            the example has a "categorical" key with the integer codes of these channels.
+        :param listfile_index: If True, the listfile rows are memory-mapped from a ListfileIndex built next to the
+                               listfile on first use instead of being parsed at every start.
         """
-        Reader.__init__(self, dataset_dir, listfile)
-        self._data = [line.split(',') for line in self._data]
-
-        def process_ihm(x):
-            return list(map(int, x.split(';')))
-
-        def process_los(x):
-            x = x.split(';')
-            if x[0] == '':
-                return ([], [])
-            return (list(map(int, x[:len(x)//2])), list(map(float, x[len(x)//2:])))
-
-        def process_ph(x):
-            return list(map(int, x.split(';')))
-
-        def process_decomp(x):
-            x = x.split(';')
-            if x[0] == '':
-                return ([], [])
-            return (list(map(int, x[:len(x)//2])), list(map(int, x[len(x)//2:])))
-
-        self._data = [(fname, float(t), process_ihm(ihm), process_los(los),
-                       process_ph(pheno), process_decomp(decomp))
-                      for fname, t, ihm, los, pheno, decomp in self._data]
+        Reader.__init__(self, dataset_dir, listfile, MultitaskListfileIndex if listfile_index else None)
+        if not listfile_index:
+            self._data = [line.split(',') for line in self._data]
+
+            def process_ihm(x):
+                return list(map(int, x.split(';')))
+
+            def process_los(x):
+                x = x.split(';')
+                if x[0] == '':
+                    return ([], [])
+                return (list(map(int, x[:len(x)//2])), list(map(float, x[len(x)//2:])))
+
+            def process_ph(x):
+                return list(map(int, x.split(';')))
+
+            def process_decomp(x):
+                x = x.split(';')
+                if x[0] == '':
+                    return ([], [])
+                return (list(map(int, x[:len(x)//2])), list(map(int, x[len(x)//2:])))
+
+            self._data = [(fname, float(t), process_ihm(ihm), process_los(los),
+                           process_ph(pheno), process_decomp(decomp))
+                          for fname, t, ihm, los, pheno, decomp in self._data]
+        self._load_cache(cache_dir)
+        self._numeric = numeric
 
     def _read_timeseries(self, ts_filename):
+        if self._cache is not None:
+            return (self._cache.read(ts_filename), list(self._cache.header))
         ret = []
         with open(os.path.join(self._dataset_dir, ts_filename), "r") as tsfile:
             header = tsfile.readline().strip().split(',')
@@ -368,11 +554,11 @@ class MultitaskReader(Reader):
         name = self._data[index][0]
         (X, header) = self._read_timeseries(name)
 
-        return {"X": X,
-                "t": self._data[index][1],
-                "ihm": self._data[index][2],
-                "los": self._data[index][3],
-                "pheno": self._data[index][4],
-                "decomp": self._data[index][5],
-                "header": header,
-                "name": name}
+        return self._numeric_example({"X": X,
+                                      "t": self._data[index][1],
+                                      "ihm": self._data[index][2],
+                                      "los": self._data[index][3],
+                                      "pheno": self._data[index][4],
+                                      "decomp": self._data[index][5],
+                                      "header": header,
+                                      "name": name})
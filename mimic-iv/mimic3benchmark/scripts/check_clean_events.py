@@ -0,0 +1,246 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import os
+import re
+import time
+import numpy as np
+import pandas as pd
+from pandas import DataFrame, Series
+from tqdm import tqdm
+
+from mimic3benchmark.preprocessing import read_itemid_to_variable_map, map_itemids_to_variables, clean_events
+from mimic3benchmark.subject import read_events
+
+
+###############################################################################################
+# The previous per-value cleaning functions of preprocessing.py, the reference of the parity check (with bool for the
+# np.bool alias that numpy removed)
+###############################################################################################
+
+# SBP: some are strings of type SBP/DBP
+def legacy_clean_sbp(df):
+    v = df.value.astype(str).copy()
+    idx = v.apply(lambda s: '/' in s)
+    v.loc[idx] = v[idx].apply(lambda s: re.match('^(\d+)/(\d+)$', s).group(1))
+    return v.astype(float)
+
+
+def legacy_clean_dbp(df):
+    v = df.value.astype(str).copy()
+    idx = v.apply(lambda s: '/' in s)
+    v.loc[idx] = v[idx].apply(lambda s: re.match('^(\d+)/(\d+)$', s).group(2))
+    return v.astype(float)
+
+
+# CRR: strings with brisk, <3 normal, delayed, or >3 abnormal
+def legacy_clean_crr(df):
+    v = Series(np.zeros(df.shape[0]), index=df.index)
+    v[:] = np.nan
+
+    # when df.value is empty, dtype can be float and comparision with string
+    # raises an exception, to fix this we change dtype to str
+    df_value_str = df.value.astype(str)
+
+    v.loc[(df_value_str == 'Normal <3 secs') | (df_value_str == 'Brisk')] = 0
+    v.loc[(df_value_str == 'Abnormal >3 secs') | (df_value_str == 'Delayed')] = 1
+    return v
+
+
+# FIO2: many 0s, some 0<x<0.2 or 1<x<20
+def legacy_clean_fio2(df):
+    v = df.value.astype(float).copy()
+
+    ''' The line below is the correct way of doing the cleaning, since we will not compare 'str' to 'float'.
+    If we use that line it will create mismatches from the data of the paper in ~50 ICU stays.
+    The next releases of the benchmark should use this line.
+    '''
+    # idx = df.valuenum.fillna('').apply(lambda s: 'torr' not in s.lower()) & (v>1.0)
+
+    ''' The line below was used to create the benchmark dataset that the paper used. Note this line will not work
+    in python 3, since it may try to compare 'str' to 'float'.
+    '''
+    # idx = df.valuenum.fillna('').apply(lambda s: 'torr' not in s.lower()) & (df.value > 1.0)
+
+    ''' The two following lines implement the code that was used to create the benchmark dataset that the paper used.
+    This works with both python 2 and python 3.
+    '''
+    is_str = np.array(map(lambda x: type(x) == str, list(df.value)), dtype=bool)
+    idx = df.valuenum.fillna('').apply(lambda s: 'torr' not in s.lower()) & (is_str | (~is_str & (v > 1.0)))
+
+    v.loc[idx] = v[idx] / 100.
+    return v
+
+
+# GLUCOSE, PH: sometimes have ERROR as value
+def legacy_clean_lab(df):
+    v = df.value.copy()
+    idx = v.apply(lambda s: type(s) is str and not re.match('^(\d+(\.\d*)?|\.\d+)$', s))
+    v.loc[idx] = np.nan
+    return v.astype(float)
+
+
+# O2SAT: small number of 0<x<=1 that should be mapped to 0-100 scale
+def legacy_clean_o2sat(df):
+    # change "ERROR" to NaN
+    v = df.value.copy()
+    idx = v.apply(lambda s: type(s) is str and not re.match('^(\d+(\.\d*)?|\.\d+)$', s))
+    v.loc[idx] = np.nan
+
+    v = v.astype(float)
+    idx = (v <= 1)
+    v.loc[idx] = v[idx] * 100.
+    return v
+
+
+# Temperature: map Farenheit to Celsius, some ambiguous 50<x<80
+def legacy_clean_temperature(df):
+    v = df.value.astype(float).copy()
+    idx = df.valuenum.fillna('').apply(lambda s: 'F' in s.lower()) | df.mimic_label.apply(lambda s: 'F' in s.lower()) | (v >= 79)
+    v.loc[idx] = (v[idx] - 32) * 5. / 9
+    return v
+
+
+# Weight: some really light/heavy adults: <50 lb, >450 lb, ambiguous oz/lb
+# Children are tough for height, weight
+def legacy_clean_weight(df):
+    v = df.value.astype(float).copy()
+    # ounces
+    idx = df.valuenum.fillna('').apply(lambda s: 'oz' in s.lower()) | df.mimic_label.apply(lambda s: 'oz' in s.lower())
+    v.loc[idx] = v[idx] / 16.
+    # pounds
+    idx = idx | df.valuenum.fillna('').apply(lambda s: 'lb' in s.lower()) | df.mimic_label.apply(lambda s: 'lb' in s.lower())
+    v.loc[idx] = v[idx] * 0.453592
+    return v
+
+
+# Height: some really short/tall adults: <2 ft, >7 ft)
+# Children are tough for height, weight
+def legacy_clean_height(df):
+    v = df.value.astype(float).copy()
+    idx = df.valuenum.fillna('').apply(lambda s: 'in' in s.lower()) | df.mimic_label.apply(lambda s: 'in' in s.lower())
+    v.loc[idx] = np.round(v[idx] * 2.54)
+    return v
+
+
+legacy_clean_fns = {
+    'Capillary refill rate': legacy_clean_crr,
+    'Diastolic blood pressure': legacy_clean_dbp,
+    'Systolic blood pressure': legacy_clean_sbp,
+    'Fraction inspired oxygen': legacy_clean_fio2,
+    'Oxygen saturation': legacy_clean_o2sat,
+    'Glucose': legacy_clean_lab,
+    'pH': legacy_clean_lab,
+    'Temperature': legacy_clean_temperature,
+    'Weight': legacy_clean_weight,
+    'Height': legacy_clean_height
+}
+
+
+def legacy_clean_events(events):
+    for var_name, clean_fn in legacy_clean_fns.items():
+        idx = (events.variable == var_name)
+        events.loc[idx, 'value'] = clean_fn(events[idx])
+    return events.loc[events.value.notnull()]
+
+
+def golden_events():
+    """ Events covering the cases the cleaning functions tell apart. With the previous functions, the FiO2 value 0.5
+    without unit becomes 0.005 (the FiO2 quirk documented in clean_fio2), while the torr one is kept.
+    """
+    rows = [('Systolic blood pressure', 'Arterial BP', '120/80', 'mmHg'),
+            ('Systolic blood pressure', 'Arterial BP', '118', 'mmHg'),
+            ('Systolic blood pressure', 'Arterial BP', 97.0, 'mmHg'),
+            ('Diastolic blood pressure', 'Arterial BP', '120/80', 'mmHg'),
+            ('Diastolic blood pressure', 'Arterial BP', 61.5, 'mmHg'),
+            ('Capillary refill rate', 'Capillary Refill', 'Brisk', ''),
+            ('Capillary refill rate', 'Capillary Refill', 'Normal <3 secs', ''),
+            ('Capillary refill rate', 'Capillary Refill', 'Delayed', ''),
+            ('Capillary refill rate', 'Capillary Refill', 'Abnormal >3 secs', ''),
+            ('Capillary refill rate', 'Capillary Refill', 'Other', ''),
+            ('Fraction inspired oxygen', 'FiO2 Set', '0.5', ''),
+            ('Fraction inspired oxygen', 'FiO2 Set', 0.5, ''),
+            ('Fraction inspired oxygen', 'FiO2 Set', '40', '%'),
+            ('Fraction inspired oxygen', 'FiO2 Set', 60.0, None),
+            ('Fraction inspired oxygen', 'FiO2 Set', '45', 'torr'),
+            ('Fraction inspired oxygen', 'FiO2 Set', 0.3, 'TORR'),
+            ('Glucose', 'Glucose', '105', 'mg/dL'),
+            ('Glucose', 'Glucose', '7.', 'mg/dL'),
+            ('Glucose', 'Glucose', '.5', 'mg/dL'),
+            ('Glucose', 'Glucose', 'ERROR', 'mg/dL'),
+            ('Glucose', 'Glucose', '-3', 'mg/dL'),
+            ('Glucose', 'Glucose', 99.0, 'mg/dL'),
+            ('pH', 'PH (Arterial)', '7.41', 'units'),
+            ('pH', 'PH (Arterial)', 'Error', 'units'),
+            ('Oxygen saturation', 'SpO2', '0.97', '%'),
+            ('Oxygen saturation', 'SpO2', '1', '%'),
+            ('Oxygen saturation', 'SpO2', 98.0, '%'),
+            ('Oxygen saturation', 'SpO2', 'ERROR', '%'),
+            ('Temperature', 'Temperature F', '98.6', '?F'),
+            ('Temperature', 'Temperature C', '37.2', '?C'),
+            ('Temperature', 'Temperature C', 79.0, ''),
+            ('Weight', 'Admit Wt', '80', 'kg'),
+            ('Weight', 'Previous WeightF', '176', 'lb'),
+            ('Weight', 'Birth Weight (oz)', '110', ''),
+            ('Weight', 'Daily Weight', 75.5, None),
+            ('Height', 'Height Inches', '70', 'inch'),
+            ('Height', 'Height (cm)', '178', 'cm'),
+            ('Heart Rate', 'Heart Rate', '88', 'bpm'),
+            ('Glascow coma scale eye opening', 'GCS - Eye Opening', '4 Spontaneously', '')]
+    events = DataFrame(rows, columns=['variable', 'mimic_label', 'value', 'valuenum'])
+    events.index = events.index * 3 + 7
+    return events
+
+
+def check_parity(events):
+    """ Cleans copies of events with clean_events and with the previous functions and checks that they agree.
+
+    :return: (seconds taken by clean_events, seconds taken by the previous functions)
+    """
+    start = time.perf_counter()
+    expected = legacy_clean_events(events.copy())
+    legacy_time = time.perf_counter() - start
+    start = time.perf_counter()
+    actual = clean_events(events.copy())
+    new_time = time.perf_counter() - start
+    pd.testing.assert_frame_equal(actual, expected)
+    assert [type(x) for x in actual.value] == [type(x) for x in expected.value]
+    return new_time, legacy_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check that clean_events gives the same events as the previous '
+                                                 'per-value cleaning functions.')
+    parser.add_argument('subjects_root_path', type=str, nargs='?', default=None,
+                        help='Directory containing subject sub-directories whose events are checked as well.')
+    parser.add_argument('--variable_map_file', type=str,
+                        default=os.path.join(os.path.dirname(__file__), '../resources/itemid_to_variable_map.csv'),
+                        help='CSV containing ITEMID-to-variable map.')
+    parser.add_argument('--n_subjects', type=int, default=None, help='Number of subjects checked, all by default.')
+    args = parser.parse_args()
+
+    golden = golden_events()
+    check_parity(golden)
+    fio2 = legacy_clean_events(golden.copy())
+    fio2 = fio2[fio2.variable == 'Fraction inspired oxygen'].value.tolist()
+    assert np.allclose(fio2, [0.005, 0.005, 0.4, 0.6, 45., 0.3]), fio2
+    print('golden events: same output')
+
+    if args.subjects_root_path is None:
+        return
+    var_map = read_itemid_to_variable_map(args.variable_map_file)
+    subject_dirs = sorted(filter(str.isdigit, os.listdir(args.subjects_root_path)), key=int)[:args.n_subjects]
+    n_events, new_time, legacy_time = 0, 0., 0.
+    for subject_dir in tqdm(subject_dirs, desc='Checking subjects'):
+        events = map_itemids_to_variables(read_events(os.path.join(args.subjects_root_path, subject_dir)), var_map)
+        times = check_parity(events)
+        n_events += events.shape[0]
+        new_time += times[0]
+        legacy_time += times[1]
+    print('{} subjects, {} events: same output, clean_events {:.2f} s, previous functions {:.2f} s'.format(
+        len(subject_dirs), n_events, new_time, legacy_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,10 @@ parser.add_argument('--itemids_file', '-i', type=str, help='CSV containing list
 parser.add_argument('--verbose', '-v', dest='verbose', action='store_true', help='Verbosity in output')
 parser.add_argument('--quiet', '-q', dest='verbose', action='store_false', help='Suspend printing of details')
 parser.set_defaults(verbose=True)
+parser.add_argument('--events_chunksize', type=int, default=0,
+                    help='Read event tables with pandas in chunks of this many rows (0: read row by row).')
+parser.add_argument('--max_open_files', type=int, default=256,
+                    help='Maximum number of per-subject event files kept open by the chunked reader.')
 parser.add_argument('--test', action='store_true', help='TEST MODE: process only 1000 subjects, 1000000 events.')
 args, _ = parser.parse_known_args()
 
@@ -76,5 +80,11 @@ break_up_diagnoses_by_subject(phenotypes, args.output_path, subjects=subjects)
 items_to_keep = set(
     [int(itemid) for itemid in dataframe_from_csv(args.itemids_file)['ITEMID'].unique()]) if args.itemids_file else None
 for table in args.event_tables:
-    read_events_table_and_break_up_by_subject(args.mimic3_path, table, args.output_path, items_to_keep=items_to_keep,
-                                              subjects_to_keep=subjects)
+    if args.events_chunksize > 0:
+        read_events_table_in_chunks_and_break_up_by_subject(args.mimic3_path, table, args.output_path,
+                                                            items_to_keep=items_to_keep, subjects_to_keep=subjects,
+                                                            chunksize=args.events_chunksize,
+                                                            max_open_files=args.max_open_files)
+    else:
+        read_events_table_and_break_up_by_subject(args.mimic3_path, table, args.output_path,
+                                                  items_to_keep=items_to_keep, subjects_to_keep=subjects)
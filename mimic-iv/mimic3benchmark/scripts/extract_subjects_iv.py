@@ -4,9 +4,11 @@ from __future__ import print_function
 import argparse
 import yaml
 
+from mimic3benchmark.checkpoints import StageRunner, clear_partial_files, commit_partial_files, frame_digest
+from mimic3benchmark.checkpoints import partial_name
 from mimic3benchmark.mimic3csv import *
 from mimic3benchmark.preprocessing import add_hcup_ccs_2015_groups, make_phenotype_label_matrix
-from mimic3benchmark.util import dataframe_from_csv
+from mimic3benchmark.util import dataframe_from_csv, has_store
 
 parser = argparse.ArgumentParser(description='Extract per-subject data from MIMIC-III CSV files.')
 parser.add_argument('mimic3_path', type=str, help='Directory containing MIMIC-III CSV files.')
@@ -21,7 +23,17 @@ parser.add_argument('--itemids_file', '-i', type=str,default=os.path.join(os.pat
 parser.add_argument('--verbose', '-v', dest='verbose', action='store_true', help='Verbosity in output')
 parser.add_argument('--quiet', '-q', dest='verbose', action='store_false', help='Suspend printing of details')
 parser.set_defaults(verbose=True)
+parser.add_argument('--events_chunksize', type=int, default=0,
+                    help='Read event tables with pandas in chunks of this many rows (0: read row by row).')
+parser.add_argument('--max_open_files', type=int, default=256,
+                    help='Maximum number of per-subject event files kept open by the chunked reader.')
+parser.add_argument('--storage', type=str, default='csv', choices=['csv', 'parquet'],
+                    help='Write per-subject csv files or a single Parquet store bucketed by subject_id.')
+parser.add_argument('--n_buckets', type=int, default=256, help='Number of subject_id buckets of the Parquet store.')
+parser.add_argument('--workers', type=int, default=1, help='Number of processes writing per-subject files.')
 parser.add_argument('--test', action='store_true', help='TEST MODE: process only 1000 subjects, 1000000 events.')
+parser.add_argument('--force', action='store_true',
+                    help='Write the per-subject tables and events again even if a previous run completed them.')
 args, _ = parser.parse_known_args()
 
 try:
@@ -86,11 +98,58 @@ if args.test:
     # print('Using only', stays.shape[0], 'stays and only', args.event_tables[0], 'table')
 
 subjects = stays.subject_id.unique()
-break_up_stays_by_subject(stays, args.output_path, subjects=subjects)
-break_up_diagnoses_by_subject(phenotypes, args.output_path, subjects=subjects)
 items_to_keep = set(
     [int(itemid) for itemid in dataframe_from_csv(args.itemids_file)['ITEMID'].unique()]) if args.itemids_file else None
 
-for table in args.event_tables:
-    read_events_table_and_break_up_by_subject(f'{args.mimic3_path}', table, args.output_path, items_to_keep=items_to_keep,
-                                              subjects_to_keep=subjects)
+if args.storage == 'parquet':
+    from mimic3benchmark.parquet_store import SubjectStore
+    if has_store(args.output_path) and SubjectStore(args.output_path).n_buckets == args.n_buckets:
+        store = SubjectStore(args.output_path)
+    else:
+        store = SubjectStore.create(args.output_path, n_buckets=args.n_buckets)
+
+
+def write_subject_tables():
+    if args.storage == 'parquet':
+        store.drop('stays')
+        store.drop('diagnoses')
+        write_stays_to_store(stays, store, subjects=subjects)
+        write_diagnoses_to_store(phenotypes, store, subjects=subjects)
+    else:
+        break_up_stays_by_subject(stays, args.output_path, subjects=subjects, workers=args.workers)
+        break_up_diagnoses_by_subject(phenotypes, args.output_path, subjects=subjects, workers=args.workers)
+
+
+def write_events():
+    if args.storage == 'parquet':
+        store.drop('events')
+        for table in args.event_tables:
+            read_events_table_into_store(f'{args.mimic3_path}', table, store, items_to_keep=items_to_keep,
+                                         subjects_to_keep=subjects, chunksize=args.events_chunksize or 1000000)
+        store.compact('events')
+        return
+    # the events of all the tables are appended to partial files, which replace the events.csv files once complete
+    clear_partial_files(args.output_path, 'events.csv')
+    for table in args.event_tables:
+        if args.events_chunksize > 0:
+            read_events_table_in_chunks_and_break_up_by_subject(f'{args.mimic3_path}', table, args.output_path,
+                                                                items_to_keep=items_to_keep, subjects_to_keep=subjects,
+                                                                chunksize=args.events_chunksize,
+                                                                max_open_files=args.max_open_files,
+                                                                file_name=partial_name('events.csv'))
+        else:
+            read_events_table_and_break_up_by_subject(f'{args.mimic3_path}', table, args.output_path,
+                                                      items_to_keep=items_to_keep, subjects_to_keep=subjects,
+                                                      file_name=partial_name('events.csv'))
+    commit_partial_files(args.output_path, 'events.csv')
+
+
+runner = StageRunner(args.output_path, force=args.force)
+runner.run('subject_tables', write_subject_tables,
+           params=[frame_digest(stays), frame_digest(phenotypes), args.storage, args.n_buckets])
+runner.run('events', write_events,
+           files=[os.path.join(args.mimic3_path, EVENTS_CSV_FILES[table.lower()]) for table in args.event_tables]
+           + ([args.itemids_file] if args.itemids_file else []),
+           # validate_events filters the events in place against the stays, so new stays need the events extracted again
+           params=[sorted(int(x) for x in subjects), args.event_tables, args.storage, args.n_buckets,
+                   runner.digest('subject_tables')])
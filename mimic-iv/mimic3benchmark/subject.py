@@ -5,12 +5,38 @@ import numpy as np
 import os
 import pandas as pd
 
-from mimic3benchmark.util import dataframe_from_csv
+from mimic3benchmark.util import dataframe_from_csv, has_store
+
+
+def subject_store(subject_path):
+    """ Returns the Parquet store holding the tables of this subject and its subject_id, or (None, None) when the
+    tables are per-subject csv files.
+    """
+    subjects_root_path, subject_dir = os.path.split(os.path.normpath(subject_path))
+    if not has_store(subjects_root_path):
+        return None, None
+    from mimic3benchmark.parquet_store import open_store
+    return open_store(subjects_root_path), int(subject_dir)
+
+
+def read_from_store(store, table, subject_id):
+    """ Reads the rows of a subject from the Parquet store with the dtypes read_csv gives the columns of its csv file,
+    e.g. codes made only of digits are numbers.
+    """
+    from mimic3benchmark.parquet_store import infer_csv_dtype
+    df = store.read(table, subject_id)
+    for column in df.columns[df.dtypes == object]:
+        df[column] = infer_csv_dtype(df[column])
+    return df
 
 
 def read_stays(subject_path):
     # import pdb;pdb.set_trace()
-    stays = dataframe_from_csv(os.path.join(subject_path, 'stays.csv'), index_col=None)
+    store, subject_id = subject_store(subject_path)
+    if store is not None:
+        stays = read_from_store(store, 'stays', subject_id)
+    else:
+        stays = dataframe_from_csv(os.path.join(subject_path, 'stays.csv'), index_col=None)
     stays.intime = pd.to_datetime(stays.intime)
     stays.outtime = pd.to_datetime(stays.outtime)
     # stays.dob = pd.to_datetime(stays.dob) missing in mimic-iv
@@ -21,11 +47,21 @@ def read_stays(subject_path):
 
 
 def read_diagnoses(subject_path):
+    store, subject_id = subject_store(subject_path)
+    if store is not None:
+        return read_from_store(store, 'diagnoses', subject_id)
     return dataframe_from_csv(os.path.join(subject_path, 'diagnoses.csv'), index_col=None)
 
 
 def read_events(subject_path, remove_null=True):
-    events = dataframe_from_csv(os.path.join(subject_path, 'events.csv'), index_col=None)
+    store, subject_id = subject_store(subject_path)
+    if store is not None:
+        from mimic3benchmark.parquet_store import infer_csv_dtype
+        events = store.read('events', subject_id)
+        events.value = infer_csv_dtype(events.value)
+        events.valuenum = infer_csv_dtype(events.valuenum)
+    else:
+        events = dataframe_from_csv(os.path.join(subject_path, 'events.csv'), index_col=None)
     if remove_null:
         events = events[events.value.notnull()]
     events.charttime = pd.to_datetime(events.charttime)
@@ -68,6 +104,100 @@ def convert_events_to_timeseries(events, variable_column='variable', variables=[
     return timeseries
 
 
+class SubjectTimeseries(object):
+    """ The timeseries of convert_events_to_timeseries held as a dense matrix with an index of the rows of every stay.
+
+    The events are pivoted with a single lexsort on the codes of their charttime, variable and value: the matrix holds,
+    for every (charttime, stay_id) row and variable, the code of the value (the last by value order if several events
+    share the time and the variable, as after the sort of convert_events_to_timeseries) or -1. Codes are kept instead
+    of floats because some variables hold text values. The rows are sorted by charttime, so the rows of a stay window
+    are found with searchsorted, and the rows of every stay_id are indexed once, which makes get_stay a slice of the
+    matrix instead of a scan of all the rows.
+    """
+    def __init__(self, events, variable_column='variable', variables=[]):
+        time_values, time_codes = np.unique(events.charttime.values, return_inverse=True)
+        variable_codes, variables_present = pd.factorize(events[variable_column], sort=True)
+        value_codes, value_uniques = pd.factorize(events.value, sort=True)
+        # missing values sort last, as with sort_values
+        value_codes = np.where(value_codes < 0, len(value_uniques), value_codes)
+
+        order = np.lexsort((value_codes, variable_codes, time_codes))
+        cells = time_codes[order] * len(variables_present) + variable_codes[order]
+        last = order[np.r_[cells[1:] != cells[:-1], True]]
+        codes = np.full((len(time_values), len(variables_present)), -1, dtype=np.int64)
+        codes[time_codes[last], variable_codes[last]] = np.where(value_codes[last] < len(value_uniques),
+                                                                 value_codes[last], -1)
+
+        # one row per (charttime, stay_id) pair, like the merge with the metadata
+        stays = events.stay_id.values
+        order = np.lexsort((stays, time_codes))
+        first = order[np.r_[True, (time_codes[order][1:] != time_codes[order][:-1]) |
+                                  (stays[order][1:] != stays[order][:-1])]]
+        self._row_times = time_codes[first]
+        self.charttimes = time_values[self._row_times]
+        self.stay_ids = stays[first]
+        self._codes = codes
+
+        # values of the codes, with NaN last so that the code -1 of missing cells takes it
+        self._values = np.asarray(value_uniques)
+        if (codes < 0).any():
+            if self._values.dtype.kind in 'iu':
+                # the pivot turns integer values to floats when some cell is missing
+                self._values = self._values.astype(np.float64)
+            self._values = np.append(self._values, np.array([np.nan], dtype=self._values.dtype))
+        self.variables = list(variables_present)
+        self._missing_variables = [v for v in variables if v not in variables_present]
+
+        stay_order = np.argsort(self.stay_ids, kind='stable')
+        stay_ids, starts = np.unique(self.stay_ids[stay_order], return_index=True)
+        self._stay_rows = dict(zip(stay_ids.tolist(), np.split(stay_order, starts[1:])))
+
+    def __len__(self):
+        return len(self.charttimes)
+
+    def _frame(self, rows):
+        index = rows if isinstance(rows, np.ndarray) else np.arange(len(self))[rows]
+        frame = pd.DataFrame(self._values[self._codes[self._row_times[rows]]], index=index, columns=self.variables)
+        frame.insert(0, 'charttime', self.charttimes[rows])
+        for variable in self._missing_variables:
+            frame[variable] = np.nan
+        return frame
+
+    def stay_rows(self, icustayid, intime=None, outtime=None):
+        """ The rows get_events_for_stay selects: those of icustayid and those charted between intime and outtime.
+        :return: a slice when they are contiguous, an array of row positions otherwise.
+        """
+        rows = self._stay_rows.get(icustayid, np.zeros(0, dtype=np.int64))
+        if intime is None or outtime is None or pd.isnull(intime) or pd.isnull(outtime):
+            return rows
+        start = np.searchsorted(self.charttimes, pd.Timestamp(intime).to_datetime64(), side='left')
+        end = np.searchsorted(self.charttimes, pd.Timestamp(outtime).to_datetime64(), side='right')
+        before = rows[:np.searchsorted(rows, start)]
+        after = rows[np.searchsorted(rows, end):]
+        if len(before) == 0 and len(after) == 0:
+            return slice(start, max(start, end))
+        return np.concatenate([before, np.arange(start, max(start, end)), after])
+
+    def get_stay(self, icustayid, intime=None, outtime=None):
+        """ The same frame as get_events_for_stay(convert_events_to_timeseries(events), icustayid, intime, outtime). """
+        return self._frame(self.stay_rows(icustayid, intime, outtime))
+
+    def to_frame(self):
+        """ The same frame as convert_events_to_timeseries(events), up to the order of rows sharing their charttime. """
+        frame = self._frame(slice(0, len(self)))
+        frame.insert(len(self.variables) + 1, 'stay_id', self.stay_ids)
+        return frame
+
+
+def get_first_valid_from_timeseries(timeseries, variable):
+    if variable in timeseries:
+        idx = timeseries[variable].notnull()
+        if idx.any():
+            loc = np.where(idx)[0][0]
+            return timeseries[variable].iloc[loc]
+    return np.nan
+
+
 def get_first_valid_from_timeseries(timeseries, variable):
     if variable in timeseries:
         idx = timeseries[variable].notnull()
@@ -1,4 +1,5 @@
 import os
+import csv
 import json
 import argparse
 import pandas as pd
@@ -7,6 +8,34 @@ import yaml
 from tqdm import tqdm
 import math
 
+from mimic3benchmark.util import CsvAppender
+
+
+def category_index(values):
+    """ Index of every possible value of a categorical channel, the first one of a repeated value (as list.index). """
+    value_to_id = {}
+    for i, value in enumerate(values):
+        value_to_id.setdefault(value, i)
+    return value_to_id
+
+
+def to_category_ids(values, value_to_id):
+    """ Indexes of values in the possible values of their channel, raises ValueError if one is not there. """
+    category_ids = pd.Series(values).map(value_to_id)
+    unknown = category_ids.isnull().values
+    if unknown.any():
+        raise ValueError('{} is not in list'.format(repr(np.asarray(values)[unknown].tolist()[0])))
+    return category_ids.values.astype(int)
+
+
+def one_hot(category_ids, n_values):
+    """ One-hot rows of category_ids, all NaN for the rows whose id is -1 (missing value). """
+    data = np.full([len(category_ids), n_values], np.nan)
+    rows = np.flatnonzero(category_ids >= 0)
+    data[rows] = 0
+    data[rows, category_ids[rows]] = 1
+    return data
+
 
 class TSDiscretizer:
     def __init__(self, timestep=1.0, config_path=os.path.join(os.path.dirname(__file__), 'resources/discretizer_config.json')):
@@ -20,79 +49,90 @@ class TSDiscretizer:
         self._header = ["Hours"] + self._id_to_channel
         self._timestep = timestep
 
+        # columns of each channel in the discretized data, the index of every possible value of the categorical
+        # channels and the header of the discretized data
+        self._begin_pos = []
+        self._end_pos = []
+        self._value_to_id = {}
+        self._new_header = []
+        cur_len = 0
+        for channel in self._id_to_channel:
+            self._begin_pos.append(cur_len)
+            if self._is_categorical_channel[channel]:
+                values = self._possible_values[channel]
+                self._value_to_id[channel] = category_index(values)
+                self._new_header += [channel + "->" + value for value in values]
+                cur_len += len(values)
+            else:
+                self._new_header.append(channel)
+                cur_len += 1
+            self._end_pos.append(cur_len)
+
+    def get_header(self):
+        return list(self._new_header)
+
     def preprocess(self, X, header=None, end=None):
         if header is None:
             header = self._header
         assert header[0] == "Hours"
         eps = 1e-6
 
-        N_channels = len(self._id_to_channel)
         x = X.values
-        ts = [float(row[0]) for row in x]
-        for i in range(len(ts) - 1):
-            assert ts[i] < ts[i+1] + eps
+        ts = x[:, 0].astype(float)
+        assert np.all(ts[:-1] < ts[1:] + eps)
         first_time = ts[0]
         if end is None:
-            max_hours = max(ts) - first_time
+            max_hours = ts.max() - first_time
         else:
             max_hours = end - first_time
 
         N_bins = int(max_hours / self._timestep + 1.0)
+        data = np.full([N_bins, self._end_pos[-1]], np.nan)
 
-        cur_len = 0
-        begin_pos = [0 for i in range(N_channels)]
-        end_pos = [0 for i in range(N_channels)]
-        for i in range(N_channels):
-            channel = self._id_to_channel[i]
-            begin_pos[i] = cur_len
-            if self._is_categorical_channel[channel]:
-                end_pos[i] = begin_pos[i] + len(self._possible_values[channel])
-            else:
-                end_pos[i] = begin_pos[i] + 1
-            cur_len = end_pos[i]
-        
-        data = np.full([N_bins, cur_len], np.nan)
+        t = ts - first_time
+        kept = ~(t > max_hours + eps)
+        x = x[kept]
+        bin_ids = (t[kept] / self._timestep - eps).astype(int)
+        assert np.all((0 <= bin_ids) & (bin_ids < N_bins))
 
-        def write(data, bin_id, channel, value, begin_pos):
+        for j in range(1, x.shape[1]):
+            rows = np.flatnonzero(x[:, j] != "")
+            if rows.size == 0:
+                continue
+            channel = header[j]
             channel_id = self._channel_to_id[channel]
-            if self._is_categorical_channel[channel]:
-                category_id = self._possible_values[channel].index(value)
-                N_values = len(self._possible_values[channel])
-                one_hot = np.zeros((N_values,))
-                one_hot[category_id] = 1
-                for pos in range(N_values):
-                    data[bin_id, begin_pos[channel_id] + pos] = one_hot[pos]
-            else:
-                data[bin_id, begin_pos[channel_id]] = float(value)
+            values = x[rows, j]
 
-        for row in x:
-            t = float(row[0]) - first_time
-            if t > max_hours + eps:
-                continue
-            bin_id = int(t / self._timestep - eps)
-            assert 0 <= bin_id < N_bins
-            for j in range(1, len(row)):
-                if row[j] == "":
-                    continue
-                channel = header[j]
+            # a later row overwrites the earlier rows of the same bin
+            bins, last = np.unique(bin_ids[rows][::-1], return_index=True)
+            last = rows.size - 1 - last
 
-                write(data, bin_id, channel, row[j], begin_pos)
-        
-        # create new header
-        new_header = []
-        for channel in self._id_to_channel:
+            begin = self._begin_pos[channel_id]
             if self._is_categorical_channel[channel]:
-                values = self._possible_values[channel]
-                for value in values:
-                    new_header.append(channel + "->" + value)
+                category_ids = to_category_ids(values, self._value_to_id[channel])[last]
+                data[bins, begin:self._end_pos[channel_id]] = one_hot(category_ids, self._end_pos[channel_id] - begin)
             else:
-                new_header.append(channel)
+                data[bins, begin] = values.astype(float)[last]
+
+        new_header = list(self._new_header)
         ts_df = pd.DataFrame(data, columns=new_header)
         ts_df.insert(0, "RecordTime", np.arange(math.ceil(first_time), math.ceil(first_time)+N_bins))
 
         return ts_df, new_header
 
 
+def read_episode_timeseries(tsfile, los, eps=1e-6):
+    """ Reads an episode timeseries file with all cells as strings ("" when missing) and keeps the rows recorded in
+    the ICU, i.e. -eps < Hours < los + eps. Fields are split on every comma, like line.split(',').
+
+    :return: (timeseries DataFrame with a RangeIndex, list of the Hours of the rows kept)
+    """
+    ts_df = pd.read_csv(tsfile, dtype=str, keep_default_na=False, na_filter=False, quoting=csv.QUOTE_NONE)
+    event_times = ts_df.iloc[:, 0].values.astype(float)
+    in_icu = (-eps < event_times) & (event_times < los + eps)
+    return ts_df[in_icu].reset_index(drop=True), list(event_times[in_icu])
+
+
 def layout_csv(pid, n_episode, icustay, ts, stay, readmission):
     admission_time = stay[stay['stay_id'] == icustay]['intime'].values[0]
     discharge_time = stay[stay['stay_id'] == icustay]['outtime'].values[0]
@@ -145,7 +185,18 @@ def extract_to_csv(args, eps=1e-6, decom_future_time_interval=24.0):
     phneo_cols = [x for x in id_to_group
                   if definitions[x]['use_in_benchmark']]
 
-    all_patient_ts = pd.DataFrame()
+    discretizer = TSDiscretizer()
+    # format the csv file
+    basic_cols = ['PatientID', 'RecordTime', 'AdmissionTime', 'DischargeTime']
+    task_cols = ['Outcome', 'LOS', 'Readmission', 'Decompensation'] + phneo_cols
+    demo_cols = ['Sex', 'Age']
+    lab_cols = discretizer.get_header()
+    cate_cols = [_ for _ in lab_cols if '->' in _]
+    num_cols = [_ for _ in lab_cols if '->' not in _]
+    columns = basic_cols + task_cols + demo_cols + cate_cols + num_cols
+    writer = CsvAppender(os.path.join(output_dir, 'format_mimic4_ehr.csv'), columns,
+                         max_memory=int(args.max_memory * 2**20))
+
     patients = list(filter(str.isdigit, os.listdir(args.root_path)))
     for patient in tqdm(patients, desc='Iterating over patients'):
         patient_folder = os.path.join(args.root_path, patient)
@@ -192,26 +243,14 @@ def extract_to_csv(args, eps=1e-6, decom_future_time_interval=24.0):
                     if (deadtime - outtime).astype('timedelta64[D]') <= np.timedelta64(30, 'D'):
                         readmission = 1
                 
-                ts_lines = tsfile.read().splitlines()
-                header = ts_lines[0]
-                ts_lines = ts_lines[1:]
-                event_times = [float(line.split(',')[0]) for line in ts_lines]
-
-                ts_lines = [line for (line, t) in zip(ts_lines, event_times)
-                            if -eps < t < los + eps]
-                event_times = [t for t in event_times
-                               if -eps < t < los + eps]
-                
+                ts_df, event_times = read_episode_timeseries(tsfile, los, eps=eps)
+
                 # no measurements in ICU
-                if len(ts_lines) == 0:
+                if ts_df.shape[0] == 0:
                     print("\n\t(no events in ICU) ", patient, ts_filename)
                     continue
-                
+
                 # time series
-                ts_df = pd.DataFrame(columns=header.split(','))
-                for i in range(len(ts_lines)):
-                    ts_df.loc[i] = ts_lines[i].split(',')
-                discretizer = TSDiscretizer()
                 ts_df, new_header = discretizer.preprocess(ts_df)
 
                 out_df = layout_csv(patient, n_episode, icustay, ts_df, stay_df, readmission)
@@ -250,19 +289,12 @@ def extract_to_csv(args, eps=1e-6, decom_future_time_interval=24.0):
                 # merge four tasks data
                 out_df = pd.merge(out_df, decom_df, how='left', on=['PatientID', 'RecordTime'])
                 out_df[phneo_cols] = cur_labels
-                all_patient_ts = pd.concat([all_patient_ts, out_df], ignore_index=True)
-                
-    # format the csv file
-    basic_cols = ['PatientID', 'RecordTime', 'AdmissionTime', 'DischargeTime']
-    task_cols = ['Outcome', 'LOS', 'Readmission', 'Decompensation'] + phneo_cols
-    demo_cols = ['Sex', 'Age']
-    # lab_cols = all_patient_ts.columns[len(demo_cols):]
-    lab_cols = new_header
-    cate_cols = [_ for _ in lab_cols if '->' in _]
-    num_cols = [_ for _ in lab_cols if '->' not in _]
-    columns = basic_cols + task_cols + demo_cols + cate_cols + num_cols
-    all_patient_ehr = all_patient_ts[columns]
-    all_patient_ehr.to_csv(os.path.join(output_dir, 'format_mimic4_ehr.csv'), index=False)
+                # float for every episode, as in the concatenation of all episodes (rows without decompensation
+                # label are NaN), so that the frames flushed separately are written the same way
+                out_df['Decompensation'] = out_df['Decompensation'].astype(float)
+                writer.append(out_df)
+
+    writer.close()
 
 
 def main():
@@ -272,6 +304,8 @@ def main():
     parser.add_argument('--phenotype_definitions', '-p', type=str,
                         default=os.path.join(os.path.dirname(__file__), './mimic3benchmark/resources/icd_9_10_definitions_2.yaml'),
                         help='YAML file with phenotype definitions.')
+    parser.add_argument('--max_memory', type=float, default=1024,
+                        help='Megabytes of formatted episodes kept in memory before they are appended to the csv file.')
     args, _ = parser.parse_known_args()
 
     if not os.path.exists(args.output_path):
@@ -1,4 +1,5 @@
 import copy
+import json
 import math
 
 import numpy as np
@@ -84,6 +85,97 @@ def forward_fill_pipeline(
     return all_x, all_y, all_pid
 
 
+###################################################################
+# vectorized forward fill
+###################################################################
+
+def sort_by_patient(df: pd.DataFrame):
+    """
+    sort the whole dataframe once by (PatientID, RecordTime) and locate every patient's rows
+
+    returns the sorted dataframe, the start row of each patient and the number of rows of each patient
+    """
+    sorted_df = df.sort_values(by=["PatientID", "RecordTime"], ascending=True, kind="mergesort")
+    pid = sorted_df["PatientID"].to_numpy()
+    is_start = np.ones(len(pid), dtype=bool)
+    is_start[1:] = pid[1:] != pid[:-1]
+    starts = np.flatnonzero(is_start)
+    lengths = np.diff(np.append(starts, len(pid)))
+    return sorted_df, starts, lengths
+
+
+def groupwise_ffill(values: np.ndarray, starts: np.ndarray):
+    """
+    forward fill a (rows, features) float array inside each group of consecutive rows
+
+    values before the first observation of a group stay NaN
+    """
+    n_rows = values.shape[0]
+    last_valid = np.where(np.isnan(values), 0, np.arange(n_rows)[:, None])
+    # a group start is its own anchor, so observations never leak into the next patient
+    last_valid[starts] = starts[:, None]
+    np.maximum.accumulate(last_valid, axis=0, out=last_valid)
+    return np.take_along_axis(values, last_valid, axis=0)
+
+
+def pad_groups(values: np.ndarray, starts: np.ndarray, lengths: np.ndarray, dtype=np.float32):
+    """
+    scatter (rows, features) values into a zero padded (patients, max_len, features) array
+    """
+    max_len = int(lengths.max()) if len(lengths) else 0
+    padded = np.zeros((len(lengths), max_len, values.shape[1]), dtype=dtype)
+    group_idx = np.repeat(np.arange(len(lengths)), lengths)
+    visit_idx = np.arange(values.shape[0]) - np.repeat(starts, lengths)
+    padded[group_idx, visit_idx] = values
+    return padded
+
+
+def forward_fill_pipeline_vectorized(
+    df: pd.DataFrame,
+    default_fill: pd.DataFrame,
+    demographic_features: list[str],
+    labtest_features: list[str],
+    target_features: list[str],
+    require_impute_features: list[str],
+    legacy_output: bool = False,
+):
+    """
+    columnar version of forward_fill_pipeline
+
+    the dataframe is sorted once, each feature is forward filled inside every patient and the values
+    before the first observation are filled with default_fill (-1 for features not in default_fill)
+
+    returns (all_x, all_y, lengths, all_pid) where all_x and all_y are zero padded float32 arrays of
+    shape (patients, max_len, features) and lengths holds the number of visits of each patient.
+    Offsets of the patients in the sorted frame are np.cumsum(lengths) - lengths.
+    With legacy_output=True, returns (all_x, all_y, all_pid) as nested lists, like forward_fill_pipeline
+    """
+    sorted_df, starts, lengths = sort_by_patient(df)
+    sorted_df = sorted_df.copy()
+
+    if len(require_impute_features) > 0:
+        # if the f is not in the default_fill, then default to -1 (normally categorical features)
+        to_fill_values = np.array([default_fill[f] if f in default_fill else -1 for f in require_impute_features],
+                                  dtype=np.float64)
+        values = groupwise_ffill(sorted_df[require_impute_features].to_numpy(dtype=np.float64), starts)
+        values = np.where(np.isnan(values), to_fill_values, values)
+        sorted_df[require_impute_features] = values
+
+    x = sorted_df[demographic_features + labtest_features].to_numpy(dtype=np.float64)
+    y = sorted_df[target_features].to_numpy(dtype=np.float64)
+    all_pid = sorted_df["PatientID"].to_numpy()[starts].tolist()
+
+    if legacy_output:
+        split_points = starts[1:]
+        all_x = [patient_x.tolist() for patient_x in np.split(x, split_points)]
+        all_y = [patient_y.tolist() for patient_y in np.split(y, split_points)]
+        return all_x, all_y, all_pid
+
+    all_x = pad_groups(x, starts, lengths)
+    all_y = pad_groups(y, starts, lengths)
+    return all_x, all_y, lengths, all_pid
+
+
 # outlier processing
 def filter_outlier(element):
     if np.abs(float(element)) > 1e4:
@@ -91,54 +183,144 @@ def filter_outlier(element):
     else:
         return element
 
-def normalize_dataframe(train_df, val_df, test_df, normalize_features):
-    # Calculate the quantiles
-    q_low = train_df[normalize_features].quantile(0.05)
-    q_high = train_df[normalize_features].quantile(0.95)
-
-    # Filter the DataFrame based on the quantiles
-    filtered_df = train_df[(train_df[normalize_features] > q_low) & (
-        train_df[normalize_features] < q_high)]
-
-    # Calculate the mean and standard deviation and median of the filtered data, also the default fill value
-    train_mean = filtered_df[normalize_features].mean()
-    train_std = filtered_df[normalize_features].std()
-    train_median = filtered_df[normalize_features].median()
 
-    # if certain feature's mean/std/median is NaN, then set it as 0. This feature will be filled with 0 in the following steps
-    train_mean = train_mean.fillna(0)
-    train_std = train_std.fillna(0)
-    train_median = train_median.fillna(0)
+def filter_outlier_array(values):
+    # same rule as filter_outlier on a whole array, NaN values are kept
+    return np.where(np.abs(values) > 1e4, 0, values)
 
-    default_fill: pd.DataFrame = (train_median-train_mean)/(train_std+1e-12)
 
-    # LOS info
-    los_info = {"los_mean": train_mean["LOS"].item(
-    ), "los_std": train_std["LOS"].item(), "los_median": train_median["LOS"].item()}
+class NormalizationStats:
+    """
+    train set statistics used to normalize the train, val and test sets
 
-    # Calculate large los and threshold (optional, designed for covid-19 benchmark)
-    los_array = train_df.groupby('PatientID')['LOS'].max().values
-    los_p95 = np.percentile(los_array, 95)
-    los_p5 = np.percentile(los_array, 5)
-    filtered_los = los_array[(los_array >= los_p5) & (los_array <= los_p95)]
-    los_info.update({"large_los": los_p95.item(), "threshold": filtered_los.mean().item()*0.5})
+    compute it once with from_dataframe (or from_csv, chunk by chunk), save it to a json file and reuse it
+    across folds or for the calibration sets
+    """
 
+    def __init__(self, mean: pd.Series, std: pd.Series, median: pd.Series, los_info: dict):
+        self.mean = mean
+        self.std = std
+        self.median = median
+        self.los_info = los_info
+
+    @property
+    def features(self):
+        return list(self.mean.index)
+
+    @property
+    def default_fill(self):
+        return (self.median - self.mean) / (self.std + 1e-12)
+
+    @classmethod
+    def from_columns(cls, columns: dict, los_array: np.ndarray):
+        """
+        columns maps each normalize feature to the Series of its train values, los_array holds the max LOS of every
+        train patient
+        """
+        mean, std, median = {}, {}, {}
+        for f, values in columns.items():
+            # Calculate the quantiles and filter the values based on the quantiles
+            q_low = values.quantile(0.05)
+            q_high = values.quantile(0.95)
+            filtered = values.where((values > q_low) & (values < q_high))
+            mean[f] = filtered.mean()
+            std[f] = filtered.std()
+            median[f] = filtered.median()
+
+        # if certain feature's mean/std/median is NaN, then set it as 0. This feature will be filled with 0 in the following steps
+        mean = pd.Series(mean, dtype=np.float64).fillna(0)
+        std = pd.Series(std, dtype=np.float64).fillna(0)
+        median = pd.Series(median, dtype=np.float64).fillna(0)
+
+        los_info = {}
+        if "LOS" in columns:
+            los_info.update({"los_mean": mean["LOS"].item(), "los_std": std["LOS"].item(),
+                             "los_median": median["LOS"].item()})
+
+            # Calculate large los and threshold (optional, designed for covid-19 benchmark)
+            los_p95 = np.percentile(los_array, 95)
+            los_p5 = np.percentile(los_array, 5)
+            filtered_los = los_array[(los_array >= los_p5) & (los_array <= los_p95)]
+            los_info.update({"large_los": los_p95.item(), "threshold": filtered_los.mean().item()*0.5})
+        return cls(mean, std, median, los_info)
+
+    @classmethod
+    def from_dataframe(cls, train_df: pd.DataFrame, normalize_features: list[str]):
+        columns = {f: train_df[f] for f in normalize_features}
+        los_array = train_df.groupby('PatientID')['LOS'].max().values if "LOS" in columns else None
+        return cls.from_columns(columns, los_array)
+
+    @classmethod
+    def from_csv(cls, path, normalize_features: list[str], patient_ids=None, chunksize=1_000_000):
+        """
+        compute the statistics from a formatted csv file chunk by chunk
+
+        only the observed values of normalize_features (and the per-patient max LOS) are kept in memory.
+        patient_ids selects the train patients, all rows are used when it is None
+        """
+        values = {f: [] for f in normalize_features}
+        los_max = []
+        usecols = ["PatientID"] + [f for f in normalize_features if f != "PatientID"]
+        for chunk in pd.read_csv(path, usecols=usecols, chunksize=chunksize):
+            if patient_ids is not None:
+                chunk = chunk[chunk["PatientID"].isin(patient_ids)]
+            for f in normalize_features:
+                v = chunk[f].to_numpy(dtype=np.float64)
+                values[f].append(v[~np.isnan(v)])
+            if "LOS" in values:
+                los_max.append(chunk.groupby("PatientID")["LOS"].max())
+
+        columns = {f: pd.Series(np.concatenate(v) if v else [], dtype=np.float64) for f, v in values.items()}
+        los_array = pd.concat(los_max).groupby(level=0).max().values if los_max else None
+        return cls.from_columns(columns, los_array)
+
+    def normalize(self, df: pd.DataFrame, normalize_features: list[str] = None):
+        """
+        Z-score normalize df in place with the train mean and std, then set the outliers to 0
+        """
+        if normalize_features is None:
+            normalize_features = self.features
+        mean = self.mean[normalize_features].to_numpy()
+        std = self.std[normalize_features].to_numpy()
+        values = df[normalize_features].to_numpy(dtype=np.float64)
+        df.loc[:, normalize_features] = filter_outlier_array((values - mean) / (std + 1e-12))
+        return df
+
+    def to_dict(self):
+        return {"mean": self.mean.to_dict(), "std": self.std.to_dict(), "median": self.median.to_dict(),
+                "los_info": self.los_info}
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        return cls(pd.Series(data["mean"], dtype=np.float64), pd.Series(data["std"], dtype=np.float64),
+                   pd.Series(data["median"], dtype=np.float64), data["los_info"])
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump(self.to_dict(), f, indent=4)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "r") as f:
+            return cls.from_dict(json.load(f))
+
+
+def normalize_dataframe(train_df, val_df, test_df, normalize_features, stats: NormalizationStats = None):
+    # the statistics are computed on the train set unless precomputed ones are given
+    if stats is None:
+        stats = NormalizationStats.from_dataframe(train_df, normalize_features)
 
     # Z-score normalize the train, val, and test sets with train_mean and train_std
-    train_df.loc[:, normalize_features] = (train_df.loc[:, normalize_features] - train_mean) / (train_std+1e-12)
-    val_df.loc[:, normalize_features] = (val_df.loc[:, normalize_features] - train_mean) / (train_std+1e-12)
-    test_df.loc[:, normalize_features] = (test_df.loc[:, normalize_features] - train_mean) / (train_std+1e-12)
+    train_df = stats.normalize(train_df, normalize_features)
+    val_df = stats.normalize(val_df, normalize_features)
+    test_df = stats.normalize(test_df, normalize_features)
 
-    train_df.loc[:, normalize_features] = train_df.loc[:, normalize_features].map(filter_outlier)
-    val_df.loc[:, normalize_features] = val_df.loc[:, normalize_features].map(filter_outlier)
-    test_df.loc[:, normalize_features] = test_df.loc[:, normalize_features].map(filter_outlier)
-
-    return train_df, val_df, test_df, default_fill, los_info, train_mean, train_std
+    return train_df, val_df, test_df, stats.default_fill, stats.los_info, stats.mean, stats.std
 
 
 def normalize_df_with_statistics(df, normalize_features, train_mean, train_std):
     df.loc[:, normalize_features] = (df.loc[:, normalize_features] - train_mean) / (train_std+1e-12)
-    df.loc[:, normalize_features] = df.loc[:, normalize_features].map(filter_outlier)
+    df.loc[:, normalize_features] = filter_outlier_array(df.loc[:, normalize_features].to_numpy(dtype=np.float64))
     return df
 
 
@@ -290,4 +472,81 @@ def get_time_interval_term(all_missing_mask_string):
                     cur_feat.append(all_missing_mask_string[pid][feature_id][visit_id])
             cur_td.append(cur_feat)
         td.append(cur_td)
-    return td
\ No newline at end of file
+    return td
+
+###################################################################
+# vectorized missing mask generation
+###################################################################
+
+def last_observed_time_delta(values: np.ndarray, times: pd.Series, starts: np.ndarray, lengths: np.ndarray):
+    """
+    for every (visit, feature) cell of patients sorted by time, compute
+
+    existence: whether the value is observed ('E' in export_missing_mask_string)
+    before_first: whether the patient has no observation of the feature yet ('D')
+    delta: the time since the last observation of the feature (the float entries), NaN elsewhere
+
+    integer RecordTime is counted in hours and converted to days, other times are parsed once
+    with pd.to_datetime and counted in whole days, as in export_missing_mask_string
+    """
+    n_rows = values.shape[0]
+    existence = ~np.isnan(values)
+    # groupwise cumulative max of the observation positions
+    last_observed = np.where(existence, np.arange(n_rows)[:, None], -1)
+    np.maximum.accumulate(last_observed, axis=0, out=last_observed)
+    row_start = np.repeat(starts, lengths)[:, None]
+    before_first = last_observed < row_start
+
+    if times.dtype == np.int64:
+        t = times.to_numpy(dtype=np.float64)
+        elapsed = (t[:, None] - t[np.maximum(last_observed, 0)]) / 24
+    else:
+        t = pd.to_datetime(times).to_numpy().astype("datetime64[ns]").astype(np.int64)
+        elapsed = np.floor_divide(t[:, None] - t[np.maximum(last_observed, 0)], 86400 * 10**9).astype(np.float64)
+    delta = np.where(existence | before_first, np.nan, elapsed)
+    return existence, before_first, delta
+
+
+def export_missing_mask_vectorized(
+    df: pd.DataFrame,
+    feature_missing_array: list[float],
+    demographic_features: list[str],
+    labtest_features: list[str],
+    b: float = 0.3,
+    legacy_output: bool = False,
+):
+    """
+    array version of export_missing_mask_pipeline + get_time_interval_term
+
+    returns (mask_value, td, lengths, all_pid) where mask_value and td are zero padded float32 arrays of
+    shape (patients, max_len, features):
+        mask_value is 1 for observed values, the 'd' mapping of the feature missing rate before the
+        first observation and the 'e' decay of the elapsed days after it
+        td is 0 for observed values, inf before the first observation and the elapsed days after it
+    With legacy_output=True, returns (local_missing_mask_value, td, all_pid) as nested lists shaped
+    patient x visit x feature, like export_missing_mask_pipeline and get_time_interval_term
+    """
+    sorted_df, starts, lengths = sort_by_patient(df)
+    features = demographic_features + labtest_features
+    values = sorted_df[features].to_numpy(dtype=np.float64)
+    existence, before_first, delta = last_observed_time_delta(values, sorted_df["RecordTime"], starts, lengths)
+
+    missing_rate = np.asarray(feature_missing_array, dtype=np.float64)
+    # the elapsed days take few distinct values, so the decay is evaluated once per value with math.exp
+    decayed = ~(existence | before_first)
+    unique_delta, inverse = np.unique(delta[decayed], return_inverse=True)
+    decay = np.full(delta.shape, np.nan)
+    decay[decayed] = np.array([missing_rate_mapping(x, 'e', b) for x in unique_delta])[inverse]
+    mask_value = np.where(existence, 1.0, np.where(before_first, -b * missing_rate + b, decay))
+    td = np.where(existence, 0.0, np.where(before_first, np.inf, delta))
+    all_pid = sorted_df["PatientID"].to_numpy()[starts].tolist()
+
+    if legacy_output:
+        split_points = starts[1:]
+        local_missing_mask_value = [patient_mask.tolist() for patient_mask in np.split(mask_value, split_points)]
+        all_td = [patient_td.tolist() for patient_td in np.split(td, split_points)]
+        return local_missing_mask_value, all_td, all_pid
+
+    mask_value = pad_groups(mask_value, starts, lengths)
+    td = pad_groups(td, starts, lengths)
+    return mask_value, td, lengths, all_pid